@@ -1,10 +1,45 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from .models import Category, Tag, Kitob, Comment, Reservation, Rating, Author
+from . import reservations
 
 admin.site.register(Category)
 admin.site.register(Tag)
 admin.site.register(Kitob)
 admin.site.register(Comment)
-admin.site.register(Reservation)
 admin.site.register(Rating)
-admin.site.register(Author)
\ No newline at end of file
+admin.site.register(Author)
+
+
+@admin.register(Reservation)
+class ReservationAdmin(admin.ModelAdmin):
+    """Status changes go through books.reservations so stock and queue stay consistent."""
+    list_display = ('id', 'user', 'book', 'status', 'place', 'c_at', 'reserved_until')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'place', 'approved_at', 'reserved_from', 'reserved_until', 'returned_at')
+    actions = ('approve', 'give', 'return_book', 'cancel')
+
+    def _transition(self, request, queryset, transition):
+        done = 0
+        for reservation_id in queryset.values_list('pk', flat=True):
+            try:
+                transition(reservation_id)
+                done += 1
+            except reservations.TransitionError as e:
+                self.message_user(request, f'#{reservation_id}: {e}', level=messages.WARNING)
+        self.message_user(request, f'{done} reservation(s) updated.')
+
+    @admin.action(description='Approve selected reservations')
+    def approve(self, request, queryset):
+        self._transition(request, queryset, reservations.approve)
+
+    @admin.action(description='Mark selected reservations as given')
+    def give(self, request, queryset):
+        self._transition(request, queryset, reservations.give)
+
+    @admin.action(description='Mark selected reservations as returned')
+    def return_book(self, request, queryset):
+        self._transition(request, queryset, reservations.return_book)
+
+    @admin.action(description='Cancel selected reservations')
+    def cancel(self, request, queryset):
+        self._transition(request, queryset, reservations.cancel)
@@ -0,0 +1,163 @@
+"""
+Circulation analytics.
+
+CirculationFact holds one row per (day, book). It counts the loans handed out,
+returned, due and overdue that day, and the approvals, with loan and
+queue-wait durations summed so averages come out right over any range. The
+book's category is copied onto the row so category reports need no join.
+
+``refresh_facts()`` runs from Celery beat. It finds the reservations whose
+``u_at`` moved past the stored watermark, collects every day their dates fall
+on, and rebuilds those days from the reservations table. Each rebuild is a
+few grouped queries over indexed (status, date) ranges, so the cost follows
+the amount of change and not the size of the history. ``circulation()``
+answers the analytics endpoint from the fact rows alone.
+"""
+import datetime
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Kitob, Reservation, CirculationFact, RollupWatermark
+
+ROLLUP = 'circulation_facts'
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+LOAN_STATUSES = ('given', 'returned', 'not_returned')
+APPROVED_STATUSES = ('approved', 'given', 'returned', 'not_returned', 'cancelled')
+DATE_FIELDS = ('reserved_from', 'returned_at', 'reserved_until', 'approved_at')
+
+COUNT_FIELDS = ('loans', 'returns', 'due', 'overdue', 'approvals')
+DURATION_FIELDS = ('loan_time', 'wait_time')
+GROUPINGS = {
+    'day': ('day',),
+    'book': ('book_id', 'book__name'),
+    'category': ('category_id', 'category__name'),
+}
+MAX_LIMIT = 1000  # rows per book/category report
+
+
+def _duration(end, start):
+    return Sum(ExpressionWrapper(F(end) - F(start), output_field=DurationField()))
+
+
+def _day_ranges(days):
+    """Merge sorted local dates into [start, end) datetime ranges of consecutive days."""
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    tz = timezone.get_current_timezone()
+    return [
+        (timezone.make_aware(datetime.datetime.combine(start, datetime.time()), tz),
+         timezone.make_aware(datetime.datetime.combine(end, datetime.time()), tz))
+        for start, end in ranges
+    ]
+
+
+def _events(field, statuses, ranges, **aggregates):
+    in_days = Q()
+    for start, end in ranges:
+        in_days |= Q(**{f'{field}__gte': start, f'{field}__lt': end})
+    return (
+        Reservation.objects.filter(in_days, status__in=statuses)
+        .annotate(day=TruncDate(field))
+        .values('day', 'book_id')
+        .annotate(**aggregates)
+        .order_by()
+    )
+
+
+def rebuild_days(days, now=None):
+    """Recompute every CirculationFact row of the given local dates."""
+    days = set(days)
+    if not days:
+        return 0
+    now = now or timezone.now()
+    ranges = _day_ranges(days)
+    late = Q(returned_at__gt=F('reserved_until')) | Q(returned_at__isnull=True, reserved_until__lt=now)
+    queries = (
+        _events('reserved_from', LOAN_STATUSES, ranges, loans=Count('pk')),
+        _events('returned_at', ('returned',), ranges, returns=Count('pk'),
+                loan_time=_duration('returned_at', 'reserved_from')),
+        _events('reserved_until', LOAN_STATUSES, ranges, due=Count('pk'), overdue=Count('pk', filter=late)),
+        _events('approved_at', APPROVED_STATUSES, ranges, approvals=Count('pk'),
+                wait_time=_duration('approved_at', 'c_at')),
+    )
+
+    facts = {}
+    for rows in queries:
+        for row in rows:
+            fact = facts.get((row['day'], row['book_id']))
+            if fact is None:
+                fact = facts[row['day'], row['book_id']] = CirculationFact(day=row['day'], book_id=row['book_id'])
+            for name in COUNT_FIELDS + DURATION_FIELDS:
+                if row.get(name) is not None:
+                    setattr(fact, name, row[name])
+
+    categories = dict(Kitob.objects.filter(pk__in={book_id for _, book_id in facts}).values_list('pk', 'category_id'))
+    for (_, book_id), fact in facts.items():
+        fact.category_id = categories.get(book_id)
+    with transaction.atomic():
+        CirculationFact.objects.filter(day__in=days).delete()
+        CirculationFact.objects.bulk_create(facts.values(), batch_size=1000)
+    return len(facts)
+
+
+def refresh_facts(batch_size=100):
+    """Rebuild the days touched by reservations changed since the last run."""
+    mark = RollupWatermark.objects.filter(name=ROLLUP).values_list('last_u_at', flat=True).first()
+    changed = Reservation.objects.all()
+    if mark:
+        changed = changed.filter(u_at__gt=mark - WATERMARK_OVERLAP)
+    newest, days = mark, set()
+    for *dates, u_at in changed.values_list(*DATE_FIELDS, 'u_at').order_by().iterator(chunk_size=1000):
+        days.update(timezone.localdate(value) for value in dates if value)
+        newest = max(newest, u_at) if newest else u_at
+    rebuilt = 0
+    days = sorted(days)
+    for offset in range(0, len(days), batch_size):
+        rebuilt += rebuild_days(days[offset:offset + batch_size])
+    if newest and newest != mark:
+        RollupWatermark.objects.update_or_create(name=ROLLUP, defaults={'last_u_at': newest})
+    return rebuilt
+
+
+def circulation(start, end, group_by='day', limit=None):
+    """
+    Sum the facts between two dates (inclusive) per day, book or category.
+    Returns (totals, rows); rows are ordered by day, or by loans for the other groupings.
+    """
+    facts = CirculationFact.objects.filter(day__gte=start, day__lte=end)
+    sums = {name: Sum(name) for name in COUNT_FIELDS + DURATION_FIELDS}
+    rows = facts.values(*GROUPINGS[group_by]).annotate(**sums)
+    rows = rows.order_by('day') if group_by == 'day' else rows.order_by('-loans', GROUPINGS[group_by][0])
+    if limit is not None:
+        rows = rows[:max(0, min(limit, MAX_LIMIT))]
+    return _summarize(facts.aggregate(**sums)), [_summarize(row) for row in rows]
+
+
+def _summarize(row):
+    """Turn summed fact columns into the reported counts, averages and rates."""
+    counts = {name: row.pop(name) or 0 for name in COUNT_FIELDS}
+    loan_time, wait_time = row.pop('loan_time'), row.pop('wait_time')
+    row.update(counts)
+    row['avg_loan_days'] = round(loan_time.total_seconds() / 86400 / counts['returns'], 2) if counts['returns'] and loan_time else None
+    row['overdue_rate'] = round(counts['overdue'] / counts['due'], 4) if counts['due'] else None
+    row['avg_wait_hours'] = round(wait_time.total_seconds() / 3600 / counts['approvals'], 2) if counts['approvals'] and wait_time else None
+    return row
+
+
+@receiver(post_delete, sender=Reservation, dispatch_uid='analytics-reservation-delete')
+def rebuild_deleted_reservation_days(sender, instance, **kwargs):
+    # A deleted row leaves no u_at behind for refresh_facts to find.
+    days = {timezone.localdate(getattr(instance, name)) for name in DATE_FIELDS if getattr(instance, name)}
+    if days:
+        transaction.on_commit(lambda: rebuild_days(days))
@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+# drf-spectacular imports
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.types import OpenApiTypes
+
+from users.permissions import LibrarianPermission, AdminPermission, SuperAdminPermission
+from . import analytics
+
+
+class circulationAnalytics(APIView):
+    """
+    API endpoint for circulation trends, read from the daily circulation facts.
+    """
+    permission_classes = [LibrarianPermission | AdminPermission | SuperAdminPermission]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='start_date', type=OpenApiTypes.DATE, description='First day (YYYY-MM-DD), default 30 days ago'),
+            OpenApiParameter(name='end_date', type=OpenApiTypes.DATE, description='Last day (YYYY-MM-DD), default today'),
+            OpenApiParameter(name='group_by', type=OpenApiTypes.STR, enum=list(analytics.GROUPINGS), description='Group rows by day (default), book or category'),
+            OpenApiParameter(name='limit', type=OpenApiTypes.INT, description=f'Maximum number of rows for book/category grouping (default 100, at most {analytics.MAX_LIMIT})'),
+        ],
+        responses={200: 'Totals and per-group loans, returns, average loan days, overdue rate and average queue wait.'},
+        description="Circulation analytics for librarians. Figures lag live data by up to the rollup interval (5 minutes)."
+    )
+    def get(self, request):
+        group_by = request.query_params.get('group_by', 'day')
+        if group_by not in analytics.GROUPINGS:
+            return Response({'error': f"group_by must be one of {', '.join(analytics.GROUPINGS)}."}, status=400)
+        try:
+            end = parse_date(request.query_params.get('end_date') or '') or timezone.localdate()
+            start = parse_date(request.query_params.get('start_date') or '') or end - timedelta(days=30)
+            limit = int(request.query_params.get('limit', 100))
+        except ValueError:
+            return Response({'error': 'Dates must be YYYY-MM-DD and limit an integer.'}, status=400)
+        if limit < 1:
+            return Response({'error': 'limit must be a positive integer.'}, status=400)
+        limit = min(limit, analytics.MAX_LIMIT)
+        if start > end:
+            return Response({'error': 'start_date must not be after end_date.'}, status=400)
+
+        totals, rows = analytics.circulation(start, end, group_by, limit=None if group_by == 'day' else limit)
+        return Response({
+            'start_date': start,
+            'end_date': end,
+            'group_by': group_by,
+            'totals': totals,
+            'results': rows,
+        })
@@ -0,0 +1,104 @@
+import os
+
+from django.conf import settings
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.http import content_disposition_header
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+# drf-spectacular imports
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.types import OpenApiTypes
+
+from users.permissions import LibrarianPermission, AdminPermission, SuperAdminPermission
+from . import exports
+from .models import ExportJob, EXPORT_KIND_CHOICES, EXPORT_FORMAT_CHOICES
+from .serializers import ExportJobSerializer
+
+# Parameters of the export itself; everything else is passed to the filters.
+EXPORT_PARAMS = ('file_format', 'background')
+
+
+class dataExport(APIView):
+    """
+    API endpoint to export the catalog or the reservation history as CSV, JSON Lines or XLSX.
+    """
+    permission_classes = [LibrarianPermission | AdminPermission | SuperAdminPermission]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='kind', type=OpenApiTypes.STR, location=OpenApiParameter.PATH,
+                             enum=list(dict(EXPORT_KIND_CHOICES))),
+            OpenApiParameter(name='file_format', type=OpenApiTypes.STR, enum=list(dict(EXPORT_FORMAT_CHOICES)),
+                             description='Output format (default csv)'),
+            OpenApiParameter(name='background', type=OpenApiTypes.BOOL,
+                             description='Write the file in the background even if it is small'),
+        ],
+        responses={200: OpenApiTypes.BINARY, 202: ExportJobSerializer},
+        description="Takes the filter, search and sort parameters of /api/kitob/ or /api/reservations/. "
+                    "The file is streamed unless it has more than EXPORT_STREAM_MAX_ROWS rows or background=1 "
+                    "is given; then a job is returned (202) and the user is notified when its file is ready."
+    )
+    def get(self, request, kind):
+        file_format = request.query_params.get('file_format', 'csv')
+        params = request.query_params.copy()
+        for name in EXPORT_PARAMS:
+            params.pop(name, None)
+        try:
+            exports.check_format(file_format)
+            queryset = exports.filter_queryset(kind, params)
+        except exports.ExportError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        background = request.query_params.get('background', '').lower() in ('1', 'true', 'yes')
+        max_rows = getattr(settings, 'EXPORT_STREAM_MAX_ROWS', 100_000)
+        if background or queryset.count() > max_rows:
+            job = exports.start(request.user, kind, file_format, params)
+            return Response(ExportJobSerializer(job, context={'request': request}).data, status=status.HTTP_202_ACCEPTED)
+
+        response = StreamingHttpResponse(
+            exports.stream(kind, queryset, file_format), content_type=exports.CONTENT_TYPES[file_format],
+        )
+        response['Content-Disposition'] = content_disposition_header(True, exports.filename(kind, file_format))
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+class exportJobDetail(APIView):
+    """
+    API endpoint to check on a background export.
+    """
+    permission_classes = [LibrarianPermission | AdminPermission | SuperAdminPermission]
+
+    @extend_schema(
+        responses={200: ExportJobSerializer},
+        description="State of a background export; `download` is set once the file is written."
+    )
+    def get(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user)
+        return Response(ExportJobSerializer(job, context={'request': request}).data)
+
+
+class exportJobFile(APIView):
+    """
+    API endpoint to download the file of a finished background export.
+    """
+    permission_classes = [LibrarianPermission | AdminPermission | SuperAdminPermission]
+
+    @extend_schema(
+        responses={200: OpenApiTypes.BINARY, 404: OpenApiTypes.OBJECT},
+        description="The exported file, for the user who requested it."
+    )
+    def get(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user, status='done')
+        path = exports.file_path(job)
+        if not os.path.exists(path):
+            raise Http404("The export file has expired.")
+        response = FileResponse(
+            open(path, 'rb'), as_attachment=True, filename=exports.filename(job.kind, job.file_format, job.c_at),
+            content_type=exports.CONTENT_TYPES[job.file_format],
+        )
+        response['Cache-Control'] = 'no-store'
+        return response
@@ -0,0 +1,46 @@
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponseRedirect
+from django.utils.cache import patch_cache_control
+from PIL import Image
+from rest_framework.permissions import AllowAny
+from rest_framework.views import APIView
+
+# drf-spectacular imports
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.types import OpenApiTypes
+
+from common import images
+
+
+class imageVariant(APIView):
+    """
+    API endpoint that redirects to a resized cover/photo, building it on first request.
+    """
+    permission_classes = [AllowAny]
+    # Public and hit once per image in a srcset: skip token parsing and rate limits.
+    authentication_classes = []
+    throttle_classes = []
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='width', type=OpenApiTypes.INT, location=OpenApiParameter.PATH, enum=list(images.WIDTHS)),
+            OpenApiParameter(name='fmt', type=OpenApiTypes.STR, location=OpenApiParameter.PATH, enum=list(images.FORMATS)),
+        ],
+        responses={302: None},
+        description="Redirect to the stored variant of an uploaded image. URLs come from the *_srcset fields."
+    )
+    def get(self, request, width, fmt, name):
+        if width not in images.WIDTHS or fmt not in images.FORMATS or not images.is_source(name):
+            raise Http404
+        variant = images.variant_name(name, width, fmt)
+        if not default_storage.exists(variant):
+            if not default_storage.exists(name):
+                raise Http404
+            try:
+                images.generate(name, [width], [fmt])
+            except (OSError, Image.DecompressionBombError):
+                # Not an image Pillow can read: fall back to the original.
+                variant = name
+        response = HttpResponseRedirect(default_storage.url(variant))
+        patch_cache_control(response, public=True, max_age=86400)
+        return response
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from rest_framework import status
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+# drf-spectacular imports
+from drf_spectacular.utils import extend_schema
+from drf_spectacular.types import OpenApiTypes
+
+from users.permissions import AdminPermission, SuperAdminPermission
+from . import importer
+from .models import ImportJob
+from .serializers import ImportJobSerializer
+
+
+class catalogImport(APIView):
+    """
+    API endpoint to bulk-import books from an uploaded CSV, JSON Lines or MARC file.
+    """
+    permission_classes = [AdminPermission | SuperAdminPermission]
+    parser_classes = [MultiPartParser]
+
+    @extend_schema(
+        request={'multipart/form-data': {
+            'type': 'object',
+            'properties': {
+                'file': {'type': 'string', 'format': 'binary'},
+                'format': {'type': 'string', 'enum': list(importer.FORMATS)},
+                'category': {'type': 'string', 'description': 'Category for records that have none'},
+                'subcategory': {'type': 'string', 'description': 'Subcategory for records that have none'},
+                'quantity': {'type': 'integer', 'description': 'Copies for records that give no quantity (default 1)'},
+                'dry_run': {'type': 'boolean'},
+                'background': {'type': 'boolean', 'description': 'Import in the background even if the file is small'},
+            },
+            'required': ['file', 'format'],
+        }},
+        responses={200: OpenApiTypes.OBJECT, 202: ImportJobSerializer},
+        description="Import books in batches and report created, duplicate and rejected records (first 1000 rejects). "
+                    "Files over IMPORT_INLINE_MAX_BYTES, or any with background=1, are imported by a worker: "
+                    "a job is returned (202), its report is set when it is done and the user is notified."
+    )
+    def post(self, request):
+        upload = request.FILES.get('file')
+        fmt = request.data.get('format')
+        if upload is None or fmt not in importer.FORMATS:
+            return Response({'error': f"file and format ({', '.join(importer.FORMATS)}) are required."}, status=400)
+        try:
+            quantity = int(request.data.get('quantity') or 1)
+        except ValueError:
+            return Response({'error': 'quantity must be an integer.'}, status=400)
+        options = {
+            'default_category': request.data.get('category') or None,
+            'default_subcategory': request.data.get('subcategory') or None,
+            'default_quantity': quantity,
+            'dry_run': str(request.data.get('dry_run', '')).lower() in ('1', 'true', 'yes'),
+        }
+        background = str(request.data.get('background', '')).lower() in ('1', 'true', 'yes')
+        if background or upload.size > getattr(settings, 'IMPORT_INLINE_MAX_BYTES', 5 * 1024 ** 2):
+            job = importer.start(request.user, upload, fmt, options)
+            return Response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        return Response(importer.import_catalog(upload, fmt, **options))
+
+
+class importJobDetail(APIView):
+    """
+    API endpoint to check on a background catalog import.
+    """
+    permission_classes = [AdminPermission | SuperAdminPermission]
+
+    @extend_schema(
+        responses={200: ImportJobSerializer},
+        description="State of a background import; `report` is set once it is done."
+    )
+    def get(self, request, pk):
+        job = get_object_or_404(ImportJob, pk=pk, user=request.user)
+        return Response(ImportJobSerializer(job).data)
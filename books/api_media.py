@@ -0,0 +1,193 @@
+"""
+Protected delivery of book PDFs and audio.
+
+``kitobFile`` serves ``Kitob.pdf``/``Kitob.audio`` to authenticated users
+only, the same rule ``KitobSerializer`` uses to mask their URLs. Django only
+checks access; the bytes are moved by the front-end server when
+``MEDIA_ACCEL`` is set:
+
+* ``'nginx'``: ``X-Accel-Redirect`` to ``MEDIA_ACCEL_PREFIX`` + file name,
+  an ``internal`` location aliased to MEDIA_ROOT;
+* ``'sendfile'``: ``X-Sendfile`` with the absolute path (Apache mod_xsendfile,
+  lighttpd).
+
+Both servers handle Range and conditional requests themselves. Without a
+front-end server the file is served here: single byte ranges (206/416),
+``If-None-Match``/``If-Modified-Since``/``If-Range`` against an ETag built
+from the file's size and mtime, and a FileResponse over the open file so a
+WSGI server with ``wsgi.file_wrapper`` (gunicorn) can sendfile() it.
+
+The same files are not served from MEDIA_URL (see ``serve_public``).
+"""
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from django.views.static import serve
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.types import OpenApiTypes
+
+from users.permissions import LibrarianPermission, AdminPermission, SuperAdminPermission
+from .models import Kitob
+
+FILE_FIELDS = ('pdf', 'audio')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def protected_prefixes():
+    return tuple(Kitob._meta.get_field(name).upload_to for name in FILE_FIELDS)
+
+
+def serve_public(request, path, document_root=None, show_indexes=False):
+    """django.views.static.serve for MEDIA_URL, minus the protected book files."""
+    # serve() resolves "./" and "../" itself, so check the path it will open.
+    if posixpath.normpath(path).lstrip('/').startswith(protected_prefixes()):
+        raise Http404
+    return serve(request, path, document_root, show_indexes)
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single satisfiable byte range, None to
+    send the whole file (no header, or one we do not handle) and False if it
+    cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        # Multiple ranges are allowed to be answered with the full file.
+        return None
+    first, last = match.groups()
+    if not first:
+        # "bytes=-N": the last N bytes.
+        length = int(last)
+        if not length or not size:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, mtime):
+    value = request.META.get('HTTP_IF_RANGE')
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        return value == etag
+    return parse_http_date_safe(value) == int(mtime)
+
+
+class FileRange:
+    """Read-only view of ``length`` bytes of an open file from ``start``."""
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        # Lets gunicorn sendfile() Content-Length bytes from the current offset.
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+class kitobFile(APIView):
+    """
+    API endpoint to download or stream a book's PDF or audio file.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='kind', type=OpenApiTypes.STR, location=OpenApiParameter.PATH, enum=FILE_FIELDS),
+            OpenApiParameter(name='Range', type=OpenApiTypes.STR, location=OpenApiParameter.HEADER, required=False,
+                             description='A single byte range, e.g. bytes=1048576-'),
+        ],
+        responses={(200, 'application/octet-stream'): OpenApiTypes.BINARY,
+                   (206, 'application/octet-stream'): OpenApiTypes.BINARY},
+        description="Stream a book's PDF or audio file. Supports byte ranges and conditional requests."
+    )
+    def get(self, request, pk, kind):
+        if kind not in FILE_FIELDS:
+            raise Http404
+        books = Kitob.objects.filter(pk=pk)
+        if not (LibrarianPermission | AdminPermission | SuperAdminPermission)().has_permission(request, self):
+            # Hidden books are only reachable by the staff who manage them.
+            books = books.filter(visible=True)
+        name = books.values_list(kind, flat=True).first()
+        if not name:
+            raise Http404
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        filename = os.path.basename(name)
+
+        accel = getattr(settings, 'MEDIA_ACCEL', None)
+        if accel:
+            response = HttpResponse(content_type=content_type)
+            if accel == 'nginx':
+                response['X-Accel-Redirect'] = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/') + name
+            else:
+                response['X-Sendfile'] = os.path.join(settings.MEDIA_ROOT, name)
+            return self.finish(response, filename)
+
+        path = Kitob._meta.get_field(kind).storage.path(name)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            raise Http404
+        stat = os.fstat(file.fileno())
+        size, mtime = stat.st_size, stat.st_mtime
+        etag = quote_etag(f'{size:x}-{int(mtime * 1000):x}')
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=int(mtime))
+        if not_modified is not None:
+            file.close()
+            return self.finish(not_modified, filename)
+
+        span = parse_range(request.META.get('HTTP_RANGE'), size) if if_range_matches(request, etag, mtime) else None
+        if span is False:
+            file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return self.finish(response, filename)
+
+        start, end = span or (0, size - 1)
+        length = end - start + 1 if size else 0
+        if request.method == 'HEAD':
+            file.close()
+            response = HttpResponse(content_type=content_type)
+        elif span:
+            response = FileResponse(FileRange(file, start, length), content_type=content_type)
+        else:
+            response = FileResponse(file, content_type=content_type)
+        if span:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = length
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        return self.finish(response, filename)
+
+    def finish(self, response, filename):
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = content_disposition_header(False, filename)
+        patch_cache_control(response, private=True, max_age=3600)
+        return response
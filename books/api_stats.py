@@ -1,18 +1,26 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.db.models import Count, Q
-from django.contrib.auth import get_user_model
 from rest_framework.permissions import AllowAny
-from datetime import datetime, timedelta
-from django.utils.dateparse import parse_datetime
+from django.utils.dateparse import parse_date
 
 # drf-spectacular imports
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from drf_spectacular.types import OpenApiTypes
 
-from .models import Kitob, Reservation, Bookmark, Rating, Category, subCategory
+from . import stats
+from .cache import cache_response
+
+
+def date_param(request, name):
+    """The YYYY-MM-DD query parameter ``name``, or None when it is absent; ValueError when it does not parse."""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(f'{name} is not a date.')
+    return date
 
-User = get_user_model()
 
 class profileStats(APIView):
     """
@@ -31,45 +39,18 @@ class profileStats(APIView):
     )
     def get(self, request):
         user_id = request.query_params.get('user_id')
-        start_date_str = request.query_params.get('start_date')
-        end_date_str = request.query_params.get('end_date')
-
         if not user_id:
             return Response({'error': 'user_id parameter is required.'}, status=400)
 
         try:
-            user = User.objects.get(id=user_id)
-        except User.DoesNotExist:
+            start_date = date_param(request, 'start_date')
+            end_date = date_param(request, 'end_date')
+            counts = stats.user_counts(int(user_id), start_date, end_date)
+        except ValueError:
+            return Response({'error': 'user_id must be an integer and dates YYYY-MM-DD.'}, status=400)
+        if counts is None:
             return Response({'error': 'User not found.'}, status=404)
-
-        # Parse date parameters
-        start_date = parse_datetime(start_date_str) if start_date_str else None
-        end_date = parse_datetime(end_date_str) if end_date_str else None
-
-        # Filter reservations based on date range
-        reservations = Reservation.objects.filter(user=user)
-        if start_date:
-            reservations = reservations.filter(reservation_date__gte=start_date)
-        if end_date:
-            reservations = reservations.filter(reservation_date__lte=end_date)
-
-        total_reservations = reservations.count()
-        active_reservations = reservations.filter(status__in=['approved', 'given']).count()
-        pending_reservations = reservations.filter(status='pending').count()
-        returned_reservations = reservations.filter(status='returned').count()
-        bookmarks = Bookmark.objects.filter(user=user).count()
-        ratings = Rating.objects.filter(user=user).count()
-        stats = {
-            'total_reservations': total_reservations,
-            'active_reservations': active_reservations,
-            'bookmarks': bookmarks,
-            'ratings': ratings,
-            'pending_reservations': pending_reservations,
-            'returned_reservations': returned_reservations,
-        
-        }
-
-        return Response(stats)
+        return Response(counts)
 class mainPageStats(APIView):
     """
     API endpoint to get statistics for the main page.
@@ -80,15 +61,11 @@ class mainPageStats(APIView):
         responses={200: 'A JSON object containing the main page statistics.'},
         description="Get statistics for the main page, including total books, active reservations, and most reserved books."
     )
+    @cache_response('stats')
     def get(self, request):
-        total_books = Kitob.objects.count()
-        active_users = User.objects.filter(is_active=True).count()
-        category_counts = Category.objects.count()
-        category_counts += subCategory.objects.count()
-        stats = {
-            'total_books': total_books,
-            'active_users': active_users,
-            'category_counts': category_counts,
-        }
-
-        return Response(stats)
\ No newline at end of file
+        counts = stats.global_counts()
+        return Response({
+            'total_books': counts['books'],
+            'active_users': counts['active_users'],
+            'category_counts': counts['categories'],
+        })
\ No newline at end of file
@@ -0,0 +1,85 @@
+from django.shortcuts import get_object_or_404
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+# drf-spectacular imports
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.types import OpenApiTypes
+
+from users.permissions import LibrarianPermission, SuperAdminPermission
+from . import uploads
+from .models import UploadSession
+from .serializers import UploadSessionSerializer
+
+
+class uploadSessions(APIView):
+    """
+    API endpoint to start a resumable upload of a book's PDF or audio file.
+    """
+    # The same roles that may edit a book's files through /api/kitob/.
+    permission_classes = [LibrarianPermission | SuperAdminPermission]
+
+    @extend_schema(
+        request=UploadSessionSerializer,
+        responses={201: UploadSessionSerializer},
+        description="Open an upload session for a book's pdf or audio. Then PUT the file in chunks to /api/uploads/{id}/."
+    )
+    def post(self, request):
+        serializer = UploadSessionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            session = uploads.start(request.user, **serializer.validated_data)
+        except uploads.UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+
+class uploadSessionDetail(APIView):
+    """
+    API endpoint to resume, send chunks to, or cancel an upload session.
+    """
+    permission_classes = [LibrarianPermission | SuperAdminPermission]
+
+    def get_session(self, request, pk):
+        return get_object_or_404(UploadSession, pk=pk, user=request.user)
+
+    @extend_schema(
+        responses={200: UploadSessionSerializer},
+        description="Current state of an upload; resume by sending the chunk that starts at `received`."
+    )
+    def get(self, request, pk):
+        return Response(UploadSessionSerializer(self.get_session(request, pk)).data)
+
+    @extend_schema(
+        request={'application/octet-stream': OpenApiTypes.BINARY},
+        parameters=[
+            OpenApiParameter(name='Content-Range', type=OpenApiTypes.STR, location=OpenApiParameter.HEADER, required=True,
+                             description='Byte range of this chunk, e.g. bytes 0-8388607/524288000'),
+        ],
+        responses={200: UploadSessionSerializer, 202: UploadSessionSerializer},
+        description="Send the next chunk as the raw request body. 409 with `received` if it does not start where the upload stands. "
+                    "The last chunk returns 202 while the file is verified; poll the session until it is complete or failed."
+    )
+    def put(self, request, pk):
+        session = self.get_session(request, pk)
+        try:
+            first, last, total = uploads.parse_content_range(request.headers.get('Content-Range'))
+            if total != session.size:
+                raise uploads.UploadError(f'Content-Range size must be {session.size}.')
+            # Django gives no stream for a request without a body.
+            if request.stream is None:
+                raise uploads.UploadError('The chunk must be sent as the request body.')
+            uploads.write_chunk(session, first, last, request.stream)
+        except uploads.OffsetMismatch as e:
+            return Response({'error': str(e), 'received': e.received}, status=status.HTTP_409_CONFLICT)
+        except uploads.UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        session.refresh_from_db()
+        code = status.HTTP_202_ACCEPTED if session.status == 'verifying' else status.HTTP_200_OK
+        return Response(UploadSessionSerializer(session).data, status=code)
+
+    @extend_schema(responses={204: None}, description="Cancel an upload and discard its stored bytes.")
+    def delete(self, request, pk):
+        uploads.cancel(self.get_session(request, pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
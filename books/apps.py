@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class BooksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'books'
+
+    def ready(self):
+        # Importing these modules connects their signal handlers.
+        from . import search, cache, reservations, stats, analytics, pdf, comments  # noqa: F401
+        from common import images
+        from .models import Kitob, Journals
+        images.track(Kitob)
+        images.track(Journals)
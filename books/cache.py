@@ -0,0 +1,178 @@
+"""
+Response cache for the public catalog endpoints.
+
+Cached responses are keyed on the URL, the normalized query string, whether
+the caller is authenticated (anonymous responses mask pdf/audio in
+KitobSerializer) and the current version of every namespace the endpoint
+reads. A post_save/post_delete on a model bumps the versions of the
+namespaces that embed it, so stale entries are simply never looked up again
+and expire on their own.
+
+The same version tokens give every response an ETag, and the time of the
+last bump (taken from the changed row's ``u_at``) is sent as Last-Modified,
+so clients can revalidate with If-None-Match / If-Modified-Since and get a
+304 without the view running at all.
+
+Right after a bump a read replica may still hold the old rows, and a body
+read from it would be cached under the new version until it expires. So for
+REPLICA_PIN_SECONDS after the newest bump the view that fills the cache
+reads from the primary (see common/replicas.py).
+
+The cache is an optimization only: if the backend is unreachable the view is
+executed normally.
+"""
+import contextlib
+import functools
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+from common.replicas import use_replicas
+from .models import Kitob, Rating, Category, subCategory, Tag, Author
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_KEY = 'ns:%s'
+RESPONSE_KEY = 'resp:%s'
+
+# Which cached namespaces embed each model.
+MODEL_NAMESPACES = {
+    Kitob: ('kitob', 'stats'),
+    Rating: ('kitob',),
+    Category: ('kitob', 'category', 'stats'),
+    subCategory: ('kitob', 'category', 'stats'),
+    Tag: ('kitob', 'tag'),
+    Author: ('kitob', 'author'),
+    get_user_model(): ('stats',),
+}
+
+
+def _cache_call(func, *args):
+    try:
+        return func(*args)
+    except Exception:
+        logger.warning("Response cache unavailable", exc_info=True)
+        return None
+
+
+def bump(*namespaces, modified_at=None):
+    """Invalidate every cached response that reads any of ``namespaces``."""
+    stamp = modified_at.timestamp() if modified_at else time.time()
+    _cache_call(cache.set_many, {
+        NAMESPACE_KEY % name: (time.time_ns(), stamp) for name in namespaces
+    }, None)
+
+
+def namespace_versions(namespaces):
+    """Return {namespace: (version, last_modified)}, creating missing entries, or None if the cache is down."""
+    keys = [NAMESPACE_KEY % name for name in namespaces]
+    found = _cache_call(cache.get_many, keys)
+    if found is None:
+        return None
+    missing = {key: (time.time_ns(), time.time()) for key in keys if key not in found}
+    if missing:
+        for key, value in missing.items():
+            # add() so a concurrent bump is never overwritten.
+            if not _cache_call(cache.add, key, value, None):
+                value = _cache_call(cache.get, key) or value
+            found[key] = value
+    return {name: found[NAMESPACE_KEY % name] for name in namespaces}
+
+
+def response_key(request, versions):
+    params = sorted(
+        (key, value) for key in request.query_params for value in request.query_params.getlist(key)
+    )
+    parts = [
+        request.build_absolute_uri(request.path),
+        repr(params),
+        'auth' if request.user and request.user.is_authenticated else 'anon',
+        repr(sorted(versions.items())),
+    ]
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = parse_etags(if_none_match)
+        return '*' in tags or any(tag.replace('W/', '', 1) == etag.replace('W/', '', 1) for tag in tags)
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since') or '')
+    return if_modified_since is not None and int(last_modified) <= if_modified_since
+
+
+def _set_validators(response, request, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    visibility = 'private' if request.user and request.user.is_authenticated else 'public'
+    response['Cache-Control'] = f'{visibility}, max-age=0, must-revalidate'
+    patch_vary_headers(response, ('Authorization',))
+    return response
+
+
+def cache_response(*namespaces):
+    """
+    Cache a GET handler's 200 responses until one of ``namespaces`` is bumped.
+
+        @cache_response('kitob')
+        def list(self, request, *args, **kwargs): ...
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(self, request, *args, **kwargs):
+            if request.method != 'GET':
+                return handler(self, request, *args, **kwargs)
+            versions = namespace_versions(namespaces)
+            if versions is None:
+                return handler(self, request, *args, **kwargs)
+
+            key = response_key(request, versions)
+            etag = f'W/"{key}"'
+            last_modified = max(stamp for _, stamp in versions.values())
+            if _not_modified(request, etag, last_modified):
+                return _set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), request, etag, last_modified)
+
+            data = _cache_call(cache.get, RESPONSE_KEY % key)
+            if data is None:
+                # Versions are bump times in ns; replicas may still lag behind a recent one.
+                bumped_at = max(version for version, _ in versions.values()) / 1e9
+                recent = time.time() - bumped_at < getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+                with use_replicas(False) if recent else contextlib.nullcontext():
+                    response = handler(self, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                _cache_call(cache.set, RESPONSE_KEY % key, response.data)
+            else:
+                response = Response(data)
+            return _set_validators(response, request, etag, last_modified)
+        return wrapper
+    return decorator
+
+
+def invalidate_for_instance(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    # Saves carry the row's u_at; a delete has no newer row, so it stamps now.
+    saved = 'created' in kwargs
+    bump(*MODEL_NAMESPACES[sender], modified_at=getattr(instance, 'u_at', None) if saved else None)
+
+
+def invalidate_for_relation(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump('kitob')
+
+
+for model in MODEL_NAMESPACES:
+    post_save.connect(invalidate_for_instance, sender=model, dispatch_uid=f'response-cache-save-{model._meta.label}')
+    post_delete.connect(invalidate_for_instance, sender=model, dispatch_uid=f'response-cache-delete-{model._meta.label}')
+m2m_changed.connect(invalidate_for_relation, sender=Kitob.author.through, dispatch_uid='response-cache-kitob-author')
+m2m_changed.connect(invalidate_for_relation, sender=Kitob.tags.through, dispatch_uid='response-cache-kitob-tags')
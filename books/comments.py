@@ -0,0 +1,53 @@
+"""
+Comment threads.
+
+A comment answers the comment in ``reply_to`` or, failing that, ``parent``;
+one with neither is a top-level comment. Every reply also stores the
+thread's top-level comment in ``root``, set here before it is saved, so a
+whole thread is one ``root_id IN (...)`` query however deep it goes.
+
+``thread`` builds the nested replies of a page of top-level comments with
+that single query and assembles the tree in Python.
+"""
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from .models import Comment
+
+
+def predecessor_id(comment):
+    return comment.reply_to_id or comment.parent_id
+
+
+@receiver(pre_save, sender=Comment, dispatch_uid='comment-root')
+def set_root(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not {'reply_to', 'parent'} & set(update_fields)):
+        return
+    answered = predecessor_id(instance)
+    if answered is None:
+        instance.root_id = None
+    else:
+        root_id = Comment.objects.filter(pk=answered).values_list('root_id', flat=True).first()
+        instance.root_id = root_id or answered
+
+
+def thread(top_level, serialize):
+    """
+    Nest the replies of ``top_level`` (a list of top-level comments) under
+    them. ``serialize`` turns a list of comments into a list of dicts; each
+    dict gets a ``replies`` list, oldest first.
+    """
+    replies = list(
+        Comment.objects.filter(root_id__in=[comment.pk for comment in top_level])
+        .select_related('user').order_by('c_at', 'id')
+    )
+    comments = top_level + replies
+    nodes = {}
+    for comment, data in zip(comments, serialize(comments)):
+        data['replies'] = []
+        nodes[comment.pk] = data
+    for comment in replies:
+        # A reply whose comment was answered across threads hangs off its root.
+        parent = nodes.get(predecessor_id(comment)) or nodes[comment.root_id]
+        parent['replies'].append(nodes[comment.pk])
+    return [nodes[comment.pk] for comment in top_level]
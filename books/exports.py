@@ -0,0 +1,289 @@
+"""
+CSV, JSON Lines and XLSX exports of the catalog and the reservation history.
+
+An export takes the same filter, search and sort parameters as the list
+endpoint of its viewset: ``filter_queryset`` runs the viewset's own filter
+backends against them. Rows are read with ``.iterator(chunk_size=CHUNK_SIZE)``,
+a server-side cursor on PostgreSQL, and encoded as they arrive, so memory
+stays flat however many rows there are. ``stream`` feeds a
+StreamingHttpResponse.
+
+Exports of more than EXPORT_STREAM_MAX_ROWS rows, or any with
+``background=1``, become an ExportJob instead: ``books.task.run_export``
+writes the file to ``<EXPORT_DIR>/<job id>.<format>`` and notifies the user,
+who downloads it from the job. ``purge()`` runs from Celery beat and removes
+jobs and files older than EXPORT_TTL.
+
+The catalog export covers hidden books too (it is for audits); only the
+filters of the list endpoint are reused, not its ``visible=True`` base.
+Its columns are the ones books/importer.py reads, so a CSV or JSON Lines
+export can be imported into another instance. Text cells of a CSV that
+Excel would read as a formula are prefixed with ``'``.
+"""
+import csv
+import datetime
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from rest_framework.request import Request
+
+from common import xlsx
+from users.notifications import create_notifications
+from .models import Kitob, Reservation, ExportJob, EXPORT_KIND_CHOICES, EXPORT_FORMAT_CHOICES
+from .views import KitobViewSet, ReservationViewSet
+
+CHUNK_SIZE = 2000
+LINES_PER_YIELD = 500
+LIST_SEPARATOR = '; '
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'xlsx': xlsx.CONTENT_TYPE,
+}
+
+CATALOG_HEADER = (
+    'id', 'name', 'isbn', 'description', 'authors', 'tags', 'category', 'subcategory',
+    'quantity', 'published_date', 'pages', 'is_physical', 'location', 'read_time',
+    'is_available', 'rating', 'rating_count', 'c_at', 'u_at',
+)
+RESERVATION_FIELDS = (
+    ('id', 'id'),
+    ('user_id', 'user_id'),
+    ('username', 'user__username'),
+    ('first_name', 'user__first_name'),
+    ('last_name', 'user__last_name'),
+    ('book_id', 'book_id'),
+    ('book', 'book__name'),
+    ('isbn', 'book__isbn'),
+    ('status', 'status'),
+    ('place', 'place'),
+    ('c_at', 'c_at'),
+    ('approved_at', 'approved_at'),
+    ('reserved_from', 'reserved_from'),
+    ('reserved_until', 'reserved_until'),
+    ('returned_at', 'returned_at'),
+)
+
+
+VIEWSETS = {'kitob': KitobViewSet, 'reservations': ReservationViewSet}
+BASE_QUERYSETS = {'kitob': Kitob.objects.all, 'reservations': Reservation.objects.all}
+# Leading characters that make a spreadsheet evaluate a cell.
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class ExportError(Exception):
+    """Raised for an export that cannot be produced; the message says why."""
+
+
+def filter_queryset(kind, params):
+    """The rows the ``kind`` list endpoint would return for the query parameters ``params``."""
+    check_kind(kind)
+    if isinstance(params, str):
+        params = QueryDict(params)
+    http_request = HttpRequest()
+    http_request.method = 'GET'
+    http_request.GET = params
+    viewset = VIEWSETS[kind]
+    view = viewset(action='export', args=(), kwargs={}, format_kwarg=None, request=Request(http_request))
+    queryset = view.filter_queryset(BASE_QUERYSETS[kind]())
+    if not queryset.ordered:
+        queryset = queryset.order_by('pk')
+    return queryset
+
+
+def catalog_rows(queryset):
+    queryset = queryset.select_related('category', 'subcategory').prefetch_related('author', 'tags')
+    for book in queryset.iterator(chunk_size=CHUNK_SIZE):
+        yield (
+            book.pk, book.name, book.isbn, book.description,
+            [author.name for author in book.author.all()],
+            [tag.name for tag in book.tags.all()],
+            book.category.name if book.category else None,
+            book.subcategory.name if book.subcategory else None,
+            book.quantity, book.published_date, book.pages, book.is_physical, book.location,
+            book.read_time, book.is_available, book.rating, book.rating_count, book.c_at, book.u_at,
+        )
+
+
+def reservation_rows(queryset):
+    return queryset.values_list(*(lookup for _, lookup in RESERVATION_FIELDS)).iterator(chunk_size=CHUNK_SIZE)
+
+
+def header_and_rows(kind, queryset):
+    if kind == 'kitob':
+        return CATALOG_HEADER, catalog_rows(queryset)
+    return tuple(name for name, _ in RESERVATION_FIELDS), reservation_rows(queryset)
+
+
+def _flat(value):
+    """A cell for CSV and XLSX: lists are joined, dates written as ISO 8601."""
+    if isinstance(value, list):
+        return LIST_SEPARATOR.join(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _csv_cell(value):
+    value = _flat(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class _Echo:
+    """csv.writer target that hands back each encoded line."""
+
+    def write(self, value):
+        return value
+
+
+def _grouped(lines):
+    # One small chunk per row makes the WSGI server do a write per row.
+    group = []
+    for line in lines:
+        group.append(line)
+        if len(group) == LINES_PER_YIELD:
+            yield ''.join(group).encode()
+            group = []
+    if group:
+        yield ''.join(group).encode()
+
+
+def stream_csv(header, rows):
+    writer = csv.writer(_Echo())
+    # The BOM makes Excel read the file as UTF-8; the importer skips it.
+    yield '\ufeff'.encode()
+    yield writer.writerow(header).encode()
+    yield from _grouped(writer.writerow([_csv_cell(value) for value in row]) for row in rows)
+
+
+def stream_jsonl(header, rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    yield from _grouped(encoder.encode(dict(zip(header, row))) + '\n' for row in rows)
+
+
+def stream_xlsx(header, rows):
+    return xlsx.stream_xlsx(header, ([_flat(value) for value in row] for row in rows), sheet_name='Export')
+
+
+WRITERS = {'csv': stream_csv, 'jsonl': stream_jsonl, 'xlsx': stream_xlsx}
+
+
+def stream(kind, queryset, file_format):
+    """Yield the export of ``queryset`` as bytes."""
+    header, rows = header_and_rows(kind, queryset)
+    return WRITERS[file_format](header, rows)
+
+
+def check_kind(kind):
+    if kind not in dict(EXPORT_KIND_CHOICES):
+        raise ExportError(f'kind must be one of {", ".join(dict(EXPORT_KIND_CHOICES))}.')
+
+
+def check_format(file_format):
+    if file_format not in dict(EXPORT_FORMAT_CHOICES):
+        raise ExportError(f'file_format must be one of {", ".join(dict(EXPORT_FORMAT_CHOICES))}.')
+
+
+def filename(kind, file_format, now=None):
+    return f'{kind}-{(now or timezone.now()):%Y%m%d-%H%M%S}.{file_format}'
+
+
+# Background exports
+
+def export_dir():
+    return str(getattr(settings, 'EXPORT_DIR', settings.BASE_DIR / 'exports'))
+
+
+def file_path(job):
+    return os.path.join(export_dir(), f'{job.pk}.{job.file_format}')
+
+
+def start(user, kind, file_format, params):
+    """Create an ExportJob for ``params`` (a QueryDict) and queue it once the transaction commits."""
+    check_kind(kind)
+    check_format(file_format)
+    job = ExportJob.objects.create(user=user, kind=kind, file_format=file_format, query=params.urlencode())
+    transaction.on_commit(lambda: queue(job.pk))
+    return job
+
+
+def queue(job_id):
+    from .task import run_export
+    try:
+        run_export.delay(str(job_id))
+    except Exception:
+        logger.warning("Could not queue export %s", job_id, exc_info=True)
+        ExportJob.objects.filter(pk=job_id).update(status='failed', u_at=timezone.now())
+
+
+class _Counted:
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+def run(job_id):
+    """Write the file of a pending job; returns the row count, or None if the job is gone or taken."""
+    if not ExportJob.objects.filter(pk=job_id, status='pending').update(status='running', u_at=timezone.now()):
+        return None
+    job = ExportJob.objects.get(pk=job_id)
+    path = file_path(job)
+    partial = path + '.part'
+    try:
+        header, rows = header_and_rows(job.kind, filter_queryset(job.kind, job.query))
+        counted = _Counted(rows)
+        os.makedirs(export_dir(), exist_ok=True)
+        with open(partial, 'wb') as output:
+            for data in WRITERS[job.file_format](header, counted):
+                output.write(data)
+        os.replace(partial, path)
+    except Exception:
+        ExportJob.objects.filter(pk=job.pk).update(status='failed', u_at=timezone.now())
+        _remove(partial)
+        raise
+    ExportJob.objects.filter(pk=job.pk).update(status='done', rows=counted.count, u_at=timezone.now())
+    create_notifications(
+        [(job.user_id, "Export ready",
+          f"Your {job.get_kind_display().lower()} export ({counted.count} rows) is ready to download.")],
+        dedup_window=None,
+    )
+    return counted.count
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def purge(ttl=None, now=None):
+    """Delete jobs older than ``ttl`` and their files; return the job count."""
+    ttl = ttl or getattr(settings, 'EXPORT_TTL', timedelta(days=7))
+    cutoff = (now or timezone.now()) - ttl
+    expired = ExportJob.objects.filter(c_at__lt=cutoff)
+    for job in expired.only('pk', 'file_format'):
+        _remove(file_path(job))
+    deleted, _ = expired.delete()
+    # Files left by a crashed worker have no job to find them by.
+    if os.path.isdir(export_dir()):
+        for entry in os.scandir(export_dir()):
+            if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff.timestamp():
+                _remove(entry.path)
+    return deleted
@@ -0,0 +1,451 @@
+"""
+Bulk catalog import from CSV, JSON Lines or MARC 21 (ISO 2709).
+
+Input is read as a stream, one record at a time, and written in batches of
+``batch_size`` books. Each batch takes a fixed number of queries: one
+``bulk_create`` per lookup table for names not seen before, one for the
+books and one per many-to-many through table. Authors, tags, categories and
+subcategories are matched by case- and space-insensitive name against maps
+loaded once at the start and extended as rows are created. Books whose ISBN
+is already in the catalog (or earlier in the file) are skipped, so a file
+can be re-imported after a partial failure.
+
+Bulk writes bypass the model signals, so every batch also does what they
+would have: the search documents are built, the global counters adjusted and
+the response-cache namespaces bumped. A batch is one transaction.
+
+Records are plain dicts with these keys (any may be missing except ``name``):
+
+    name, isbn, description, authors, tags, category, subcategory,
+    quantity, published_date, pages, is_physical, location, read_time
+
+In CSV files ``authors`` and ``tags`` are separated by ``;`` or ``|``; in
+JSON Lines they may also be lists. MARC records are mapped as 245 $a$b
+title, 100/700 $a authors, 650 $a tags, 020 $a ISBN, 520 $a description,
+260/264 $c year and 300 $a pages. MARC records are split at the record
+terminator, so a corrupt record is rejected on its own.
+
+An upload larger than IMPORT_INLINE_MAX_BYTES becomes an ImportJob: the
+file is saved to ``<IMPORT_DIR>/<job id>.<format>``, ``books.task.run_import``
+imports it, stores the report on the job and notifies the user. ``purge()``
+runs from Celery beat and removes jobs older than IMPORT_TTL with any file
+a crashed worker left behind.
+"""
+import codecs
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from users.notifications import create_notifications
+from .cache import bump
+from .models import Kitob, Author, Tag, Category, subCategory, ImportJob
+from . import search, stats
+
+FORMATS = ('csv', 'jsonl', 'marc')
+LIST_SEPARATOR_RE = re.compile(r'[;|]')
+MAX_REJECTS_KEPT = 1000
+MARC_RECORD_TERMINATOR = b'\x1d'
+
+logger = logging.getLogger(__name__)
+
+
+class RejectedRow(Exception):
+    """Raised for a record that cannot be imported; the message says why."""
+
+
+def _key(name):
+    return ' '.join(name.split()).casefold()
+
+
+def _isbn(value):
+    return re.sub(r'[\s-]', '', value)
+
+
+def _names(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = LIST_SEPARATOR_RE.split(value)
+    return [' '.join(str(name).split()) for name in value if str(name).strip()]
+
+
+# Readers: each yields (record number, dict or RejectedRow).
+
+def read_csv(stream):
+    rows = csv.DictReader(codecs.getreader('utf-8-sig')(stream))
+    for number, row in enumerate(rows, 1):
+        yield number, {key.strip().lower(): value for key, value in row.items() if key}
+
+
+def read_jsonl(stream):
+    for number, line in enumerate(codecs.getreader('utf-8-sig')(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, RejectedRow(f'Invalid JSON: {e}')
+            continue
+        yield number, record if isinstance(record, dict) else RejectedRow('Expected a JSON object.')
+
+
+def _marc_fields(record):
+    """Parse one ISO 2709 record into {tag: [ {code: [values]} ]} for data fields."""
+    leader = record[:24]
+    encoding = 'utf-8' if leader[9:10] == b'a' else 'latin-1'
+    base = int(leader[12:17])
+    directory = record[24:base - 1]
+    fields = {}
+    for offset in range(0, len(directory) - len(directory) % 12, 12):
+        entry = directory[offset:offset + 12]
+        tag, length, start = entry[:3].decode('ascii'), int(entry[3:7]), int(entry[7:12])
+        data = record[base + start:base + start + length].rstrip(b'\x1e')
+        if tag < '010':
+            continue
+        subfields = {}
+        for chunk in data.split(b'\x1f')[1:]:
+            if chunk:
+                subfields.setdefault(chunk[:1].decode('ascii', 'replace'), []).append(
+                    chunk[1:].decode(encoding, 'replace').strip())
+        fields.setdefault(tag, []).append(subfields)
+    return fields
+
+
+def _marc_first(fields, tag, code):
+    for subfields in fields.get(tag, ()):
+        if subfields.get(code):
+            return subfields[code][0]
+    return None
+
+
+def _marc_record(fields):
+    title = ' '.join(filter(None, [_marc_first(fields, '245', 'a'), _marc_first(fields, '245', 'b')]))
+    year = re.search(r'\d{4}', _marc_first(fields, '264', 'c') or _marc_first(fields, '260', 'c') or '')
+    pages = re.search(r'\d+', _marc_first(fields, '300', 'a') or '')
+    isbn = re.match(r'[\dXx-]+', _marc_first(fields, '020', 'a') or '')
+    return {
+        # Strip ISBD punctuation that ends MARC subfields (" /", " :", ".").
+        'name': title.rstrip(' /:;,.'),
+        'isbn': isbn.group().replace('-', '') if isbn else '',
+        'authors': [value.rstrip(' ,.') for tag in ('100', '700') for sub in fields.get(tag, ()) for value in sub.get('a', ())],
+        'tags': [value.rstrip(' .') for sub in fields.get('650', ()) for value in sub.get('a', ())],
+        'description': _marc_first(fields, '520', 'a') or '',
+        'published_date': year.group() if year else None,
+        'pages': pages.group() if pages else None,
+    }
+
+
+def _marc_records(stream, chunk_size=64 * 1024):
+    # Records are split at the record terminator rather than by the length in
+    # their leader, so one corrupt record cannot derail the ones after it.
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        *records, rest = (rest + chunk).split(MARC_RECORD_TERMINATOR)
+        yield from (record.lstrip() for record in records if record.strip())
+    if rest.strip():
+        yield rest.lstrip()
+
+
+def read_marc(stream):
+    for number, record in enumerate(_marc_records(stream), 1):
+        try:
+            parsed = _marc_record(_marc_fields(record))
+        except (ValueError, IndexError) as e:
+            # Also covers UnicodeDecodeError in the directory.
+            parsed = RejectedRow(f'Malformed MARC record: {e}')
+        yield number, parsed
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'marc': read_marc}
+
+
+def _int(value, name, default=None):
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RejectedRow(f'{name} must be an integer.')
+
+
+def _date(value):
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        if re.fullmatch(r'\d{4}', value):
+            return datetime.date(int(value), 1, 1)
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise RejectedRow('published_date must be YYYY or YYYY-MM-DD.')
+
+
+def _bool(value, default):
+    if value in (None, ''):
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+class Importer:
+    """Holds the lookup maps and counts of one import run."""
+
+    def __init__(self, batch_size=2000, default_category=None, default_subcategory=None, default_quantity=1, dry_run=False):
+        self.batch_size = batch_size
+        self.default_category = default_category
+        self.default_subcategory = default_subcategory
+        self.default_quantity = default_quantity
+        self.dry_run = dry_run
+        self.authors = self._load((_key(name), pk) for name, pk in Author.objects.values_list('name', 'pk'))
+        self.tags = self._load((_key(name), pk) for name, pk in Tag.objects.values_list('name', 'pk'))
+        self.categories = self._load((_key(name), pk) for name, pk in Category.objects.values_list('name', 'pk'))
+        self.subcategories = self._load(
+            ((category_id, _key(name)), pk) for name, category_id, pk in subCategory.objects.values_list('name', 'category_id', 'pk')
+        )
+        self.isbns = {_isbn(isbn) for isbn in Kitob.objects.exclude(isbn='').values_list('isbn', flat=True).iterator()}
+        self.counts = {
+            'read': 0, 'created': 0, 'duplicates': 0, 'rejected': 0,
+            'authors': 0, 'tags': 0, 'categories': 0, 'subcategories': 0,
+        }
+        self.rejects = []
+
+    @staticmethod
+    def _load(pairs):
+        # Existing duplicate names resolve to the oldest row.
+        found = {}
+        for key, pk in pairs:
+            found.setdefault(key, pk)
+        return found
+
+    def run(self, records):
+        """Import an iterable of (number, record) pairs; returns the report."""
+        start = time.perf_counter()
+        # A dry run imports everything in one transaction and rolls it back.
+        with transaction.atomic() if self.dry_run else contextlib.nullcontext():
+            self._run(records)
+            if self.dry_run:
+                transaction.set_rollback(True)
+        elapsed = time.perf_counter() - start
+        return {
+            **self.counts,
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(self.counts['read'] / elapsed) if elapsed else None,
+            'dry_run': self.dry_run,
+            'rejects': self.rejects,
+        }
+
+    def _run(self, records):
+        batch = []
+        for number, record in records:
+            self.counts['read'] += 1
+            try:
+                if isinstance(record, RejectedRow):
+                    raise record
+                book = self.clean(record)
+            except RejectedRow as e:
+                self.reject(number, str(e))
+                continue
+            if book['isbn']:
+                if book['isbn'] in self.isbns:
+                    self.counts['duplicates'] += 1
+                    continue
+                self.isbns.add(book['isbn'])
+            batch.append(book)
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        self.write(batch)
+
+    def reject(self, number, reason):
+        self.counts['rejected'] += 1
+        if len(self.rejects) < MAX_REJECTS_KEPT:
+            self.rejects.append({'record': number, 'reason': reason})
+
+    def clean(self, record):
+        name = ' '.join(str(record.get('name') or '').split())
+        if not name:
+            raise RejectedRow('name is required.')
+        if len(name) > 255:
+            raise RejectedRow('name is longer than 255 characters.')
+        isbn = _isbn(str(record.get('isbn') or ''))
+        if len(isbn) > 20:
+            raise RejectedRow('isbn is longer than 20 characters.')
+        category = ' '.join(str(record.get('category') or self.default_category or '').split())
+        subcategory = ' '.join(str(record.get('subcategory') or self.default_subcategory or '').split())
+        if subcategory and not category:
+            raise RejectedRow('subcategory needs a category.')
+        authors, tags = _names(record.get('authors')), _names(record.get('tags'))
+        if any(len(value) > 255 for value in authors + tags + [category, subcategory]):
+            raise RejectedRow('author, tag and category names are limited to 255 characters.')
+        quantity = _int(record.get('quantity'), 'quantity', self.default_quantity)
+        if quantity < 0:
+            raise RejectedRow('quantity must not be negative.')
+        return {
+            'name': name,
+            'isbn': isbn,
+            'description': str(record.get('description') or ''),
+            'authors': authors,
+            'tags': tags,
+            'category': category,
+            'subcategory': subcategory,
+            'quantity': quantity,
+            'published_date': _date(record.get('published_date')),
+            'pages': _int(record.get('pages'), 'pages'),
+            'read_time': _int(record.get('read_time'), 'read_time', 14),
+            'is_physical': _bool(record.get('is_physical'), True),
+            'location': str(record.get('location') or '')[:255] or None,
+        }
+
+    def _resolve(self, model, lookup, names, counter, build=None):
+        """Make sure every name in ``names`` has an id in ``lookup``, creating the missing rows."""
+        missing = {}
+        for key, name in names:
+            if key not in lookup:
+                missing.setdefault(key, name)
+        if not missing:
+            return 0
+        build = build or (lambda key, name: model(name=name))
+        created = model.objects.bulk_create([build(key, name) for key, name in missing.items()], batch_size=1000)
+        for key, row in zip(missing, created):
+            lookup[key] = row.pk
+        self.counts[counter] += len(created)
+        return len(created)
+
+    def write(self, batch):
+        if not batch:
+            return
+        with transaction.atomic():
+            new_categories = self._resolve(Category, self.categories, ((_key(b['category']), b['category']) for b in batch if b['category']), 'categories')
+            new_categories += self._resolve(
+                subCategory, self.subcategories,
+                (((self.categories[_key(b['category'])], _key(b['subcategory'])), b['subcategory']) for b in batch if b['subcategory']),
+                'subcategories',
+                build=lambda key, name: subCategory(category_id=key[0], name=name),
+            )
+            self._resolve(Author, self.authors, ((_key(name), name) for b in batch for name in b['authors']), 'authors')
+            self._resolve(Tag, self.tags, ((_key(name), name) for b in batch for name in b['tags']), 'tags')
+
+            books = []
+            for b in batch:
+                category_id = self.categories[_key(b['category'])] if b['category'] else None
+                books.append(Kitob(
+                    name=b['name'], isbn=b['isbn'], description=b['description'],
+                    category_id=category_id,
+                    subcategory_id=self.subcategories[category_id, _key(b['subcategory'])] if b['subcategory'] else None,
+                    quantity=b['quantity'], is_available=b['quantity'] > 0, is_frequent=False,
+                    published_date=b['published_date'], pages=b['pages'], read_time=b['read_time'],
+                    is_physical=b['is_physical'], location=b['location'],
+                ))
+            Kitob.objects.bulk_create(books, batch_size=1000)
+
+            author_links = {(book.pk, self.authors[_key(name)]) for book, b in zip(books, batch) for name in b['authors']}
+            tag_links = {(book.pk, self.tags[_key(name)]) for book, b in zip(books, batch) for name in b['tags']}
+            Kitob.author.through.objects.bulk_create(
+                [Kitob.author.through(kitob_id=book_id, author_id=author_id) for book_id, author_id in author_links],
+                batch_size=1000, ignore_conflicts=True,
+            )
+            Kitob.tags.through.objects.bulk_create(
+                [Kitob.tags.through(kitob_id=book_id, tag_id=tag_id) for book_id, tag_id in tag_links],
+                batch_size=1000, ignore_conflicts=True,
+            )
+
+            # What the post_save/m2m_changed signals would have done per row.
+            search.index_books(book.pk for book in books)
+            stats.adjust('books', len(books))
+            stats.adjust('categories', new_categories)
+            transaction.on_commit(lambda: bump('kitob', 'category', 'tag', 'author', 'stats'))
+            self.counts['created'] += len(books)
+
+
+def import_catalog(stream, fmt, **options):
+    """Import a binary stream in ``fmt`` (csv, jsonl or marc); returns the report of ``Importer.run``."""
+    if fmt not in READERS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}.')
+    return Importer(**options).run(READERS[fmt](stream))
+
+
+# Background imports
+
+def import_dir():
+    return str(getattr(settings, 'IMPORT_DIR', settings.BASE_DIR / 'imports'))
+
+
+def file_path(job):
+    return os.path.join(import_dir(), f'{job.pk}.{job.file_format}')
+
+
+def start(user, upload, fmt, options):
+    """Save ``upload`` for an ImportJob and queue the job once the transaction commits."""
+    if fmt not in READERS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}.')
+    job = ImportJob.objects.create(user=user, file_format=fmt, options=options)
+    os.makedirs(import_dir(), exist_ok=True)
+    with open(file_path(job), 'wb') as output:
+        for chunk in upload.chunks():
+            output.write(chunk)
+    transaction.on_commit(lambda: queue(job.pk))
+    return job
+
+
+def queue(job_id):
+    from .task import run_import
+    try:
+        run_import.delay(str(job_id))
+    except Exception:
+        logger.warning("Could not queue import %s", job_id, exc_info=True)
+        ImportJob.objects.filter(pk=job_id).update(status='failed', u_at=timezone.now())
+
+
+def run(job_id):
+    """Import the file of a pending job; returns the report, or None if the job is gone or taken."""
+    if not ImportJob.objects.filter(pk=job_id, status='pending').update(status='running', u_at=timezone.now()):
+        return None
+    job = ImportJob.objects.get(pk=job_id)
+    path = file_path(job)
+    try:
+        with open(path, 'rb') as stream:
+            report = import_catalog(stream, job.file_format, **job.options)
+    except Exception:
+        ImportJob.objects.filter(pk=job.pk).update(status='failed', u_at=timezone.now())
+        raise
+    finally:
+        _remove(path)
+    ImportJob.objects.filter(pk=job.pk).update(status='done', report=report, u_at=timezone.now())
+    create_notifications(
+        [(job.user_id, "Import finished",
+          f"Your catalog import has finished: {report['created']} books created, "
+          f"{report['duplicates']} duplicates and {report['rejected']} rejected records.")],
+        dedup_window=None,
+    )
+    return report
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def purge(ttl=None, now=None):
+    """Delete jobs older than ``ttl`` with any file left behind; return the job count."""
+    ttl = ttl or getattr(settings, 'IMPORT_TTL', timedelta(days=7))
+    expired = ImportJob.objects.filter(c_at__lt=(now or timezone.now()) - ttl)
+    for job in expired.only('pk', 'file_format'):
+        _remove(file_path(job))
+    deleted, _ = expired.delete()
+    return deleted
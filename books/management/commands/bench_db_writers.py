@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+
+from books import reservations
+from books.models import Kitob, Reservation
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ("Measure concurrent writer throughput of the reservation path (reserve, then cancel) against the "
+            "configured database. Run it once per mode, e.g. DB_SQLITE_TUNED=0, the default SQLite mode, "
+            "DB_ENGINE=postgres and DB_ENGINE=postgres DB_POOL=pgbouncer, and compare the numbers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--ops', type=int, default=50, help="Reserve/cancel cycles per thread.")
+        parser.add_argument('--books', type=int, default=4)
+
+    def describe_mode(self):
+        db = settings.DATABASES['default']
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+                synchronous = cursor.execute('PRAGMA synchronous').fetchone()[0]
+            return f"sqlite journal_mode={journal} synchronous={synchronous} timeout={db['OPTIONS'].get('timeout')}s"
+        pool = os.environ.get('DB_POOL') or 'none'
+        return f"{connection.vendor} CONN_MAX_AGE={db.get('CONN_MAX_AGE')} pool={pool}"
+
+    def handle(self, *args, **options):
+        threads, ops = options['threads'], options['ops']
+        self.stdout.write(self.describe_mode())
+
+        books = [
+            Kitob.objects.create(name=f'bench-writer-{i}', quantity=threads, description='', isbn='0', is_frequent=False)
+            for i in range(options['books'])
+        ]
+        users = User.objects.bulk_create(User(username=f'bench-writer-{i}') for i in range(threads))
+        completed, errors = [0] * threads, [0] * threads
+        barrier = threading.Barrier(threads)
+
+        def writer(index):
+            try:
+                barrier.wait()
+                for op in range(ops):
+                    try:
+                        reservation = Reservation.objects.create(user=users[index], book=books[op % len(books)])
+                        reservations.cancel(reservation.pk)
+                        completed[index] += 1
+                    except (OperationalError, reservations.TransitionError):
+                        errors[index] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        Kitob.objects.filter(pk__in=[book.pk for book in books]).delete()
+        User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        done = sum(completed)
+        self.stdout.write(f"{threads} threads x {ops} cycles: {done} done, {sum(errors)} failed "
+                          f"in {elapsed:.2f}s ({done / elapsed:,.0f} cycles/s)")
@@ -0,0 +1,53 @@
+import statistics
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from books.models import Kitob, Rating
+from books.serializers import KitobSerializer, KitobListSerializer
+
+
+class Command(BaseCommand):
+    help = "Measure payload size and serialization time of one catalog page for the full and the list serializer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--fields', default='', help="Value for ?fields= passed to the list serializer.")
+
+    def measure(self, serializer_class, queryset, request, repeat):
+        timings = []
+        size = 0
+        for _ in range(repeat):
+            books = list(queryset)
+            start = time.perf_counter()
+            data = serializer_class(books, many=True, context={'request': request}).data
+            body = JSONRenderer().render(data)
+            timings.append((time.perf_counter() - start) * 1000)
+            size = len(body)
+        return size, statistics.median(timings)
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        query = {'fields': options['fields']} if options['fields'] else {}
+        request = Request(APIRequestFactory().get('/api/kitob/', query))
+        request.user = AnonymousUser()
+
+        base = Kitob.objects.filter(visible=True).order_by('-c_at')
+        full = base.select_related('category', 'subcategory').prefetch_related(
+            'author', 'tags', Prefetch('ratings', queryset=Rating.objects.select_related('user'))
+        )[:page_size]
+        lean = base.select_related('category').prefetch_related('author')[:page_size]
+
+        self.stdout.write(f"page of {page_size} books, median of {options['repeat']} runs")
+        for label, serializer_class, queryset in (
+            ('KitobSerializer', KitobSerializer, full),
+            ('KitobListSerializer', KitobListSerializer, lean),
+        ):
+            size, ms = self.measure(serializer_class, queryset, request, options['repeat'])
+            self.stdout.write(f"{label:<22}{size:>12,} bytes{ms:>10.2f} ms")
@@ -0,0 +1,49 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from books import search
+from books.models import Kitob
+
+
+class Command(BaseCommand):
+    help = "Compare the full-text index against the LIKE search used by DRF's SearchFilter."
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help="Queries to run. Defaults to words taken from book names.")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def like_search(self, query):
+        queryset = Kitob.objects.filter(visible=True)
+        for term in query.split():
+            queryset = queryset.filter(Q(name__icontains=term) | Q(author__name__icontains=term))
+        return list(queryset.distinct().values_list('pk', flat=True)[:50])
+
+    def index_search(self, query):
+        ranked = search.search_queryset(Kitob.objects.filter(visible=True), query)
+        return list(ranked.order_by('search_rank', 'pk').values_list('pk', flat=True)[:50])
+
+    def timed(self, func, query, repeat):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            hits = func(query)
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples), len(hits)
+
+    def handle(self, *args, **options):
+        if not search.index_available():
+            self.stderr.write("This database has no full-text index; nothing to compare.")
+            return
+        queries = options['queries']
+        if not queries:
+            names = Kitob.objects.order_by('?').values_list('name', flat=True)[:10]
+            queries = [name.split()[0][:4] for name in names if name.split()]
+        self.stdout.write(f"{Kitob.objects.count()} books, median of {options['repeat']} runs")
+        self.stdout.write(f"{'query':<20}{'like ms':>10}{'hits':>6}{'index ms':>10}{'hits':>6}")
+        for query in queries:
+            like_ms, like_hits = self.timed(self.like_search, query, options['repeat'])
+            index_ms, index_hits = self.timed(self.index_search, query, options['repeat'])
+            self.stdout.write(f"{query:<20}{like_ms:>10.2f}{like_hits:>6}{index_ms:>10.2f}{index_hits:>6}")
@@ -0,0 +1,56 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books import importer
+
+
+class Command(BaseCommand):
+    help = "Import books from a CSV, JSON Lines or MARC (ISO 2709) file in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import; '-' reads standard input.")
+        parser.add_argument('--format', choices=importer.FORMATS, help="Defaults to the file extension (.csv, .jsonl, .mrc).")
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--category', help="Category for records that have none.")
+        parser.add_argument('--subcategory', help="Subcategory for records that have none.")
+        parser.add_argument('--quantity', type=int, default=1, help="Copies for records that give no quantity.")
+        parser.add_argument('--rejects', help="Write rejected records (number and reason) to this JSON Lines file.")
+        parser.add_argument('--dry-run', action='store_true', help="Validate and count without keeping anything.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or {'csv': 'csv', 'jsonl': 'jsonl', 'json': 'jsonl', 'mrc': 'marc', 'marc': 'marc'}.get(
+            path.rsplit('.', 1)[-1].lower())
+        if fmt is None:
+            raise CommandError("Cannot tell the format from the file name; pass --format.")
+
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        try:
+            report = importer.import_catalog(
+                stream, fmt,
+                batch_size=options['batch_size'],
+                default_category=options['category'],
+                default_subcategory=options['subcategory'],
+                default_quantity=options['quantity'],
+                dry_run=options['dry_run'],
+            )
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+        rejects = report.pop('rejects')
+        if options['rejects']:
+            with open(options['rejects'], 'w') as out:
+                for reject in rejects:
+                    out.write(json.dumps(reject) + '\n')
+        for reject in rejects[:20]:
+            self.stdout.write(self.style.WARNING(f"record {reject['record']}: {reject['reason']}"))
+        self.stdout.write(
+            f"Read {report['read']} records in {report['seconds']}s ({report['rows_per_second']}/s): "
+            f"{report['duplicates']} duplicate ISBNs, {report['rejected']} rejected. New authors {report['authors']}, "
+            f"tags {report['tags']}, categories {report['categories']}, subcategories {report['subcategories']}."
+        )
+        action = "Would create" if options['dry_run'] else "Created"
+        self.stdout.write(self.style.SUCCESS(f"{action} {report['created']} books."))
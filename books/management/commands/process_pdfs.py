@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from books import pdf
+from books.models import Kitob
+
+
+class Command(BaseCommand):
+    help = "Extract page count, text and preview of book PDFs that have not been processed yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Reprocess every book with a PDF.")
+        parser.add_argument('--sync', action='store_true', help="Process here instead of queueing Celery tasks.")
+
+    def handle(self, *args, **options):
+        books = Kitob.objects.exclude(pdf='').exclude(pdf__isnull=True)
+        if not options['all']:
+            books = books.filter(page_texts__isnull=True)
+        done = 0
+        for book_id, name in books.order_by('pk').values_list('pk', 'pdf').iterator():
+            if options['sync']:
+                pages = pdf.process(book_id, name)
+                self.stdout.write(f"{book_id}: {pages} pages")
+            else:
+                pdf.queue(book_id, name)
+            done += 1
+        action = "Processed" if options['sync'] else "Queued"
+        self.stdout.write(self.style.SUCCESS(f"{action} {done} PDFs."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from books import search
+
+
+class Command(BaseCommand):
+    help = "Regenerate the full-text search documents for every book."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = search.rebuild(batch_size=options['batch_size'])
+        if not search.index_available():
+            self.stdout.write(self.style.WARNING("This database has no full-text index; search will use LIKE queries."))
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} books."))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from books.models import Kitob, Rating
+
+
+class Command(BaseCommand):
+    help = "Recompute rating_count, rating_sum and rating for every book and fix any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without writing.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        totals = {
+            row['book_id']: (row['n'], row['total'])
+            for row in Rating.objects.values('book_id').annotate(n=Count('id'), total=Sum('score')).order_by()
+        }
+
+        drifted = []
+        checked = 0
+        books = Kitob.objects.values_list('id', 'rating_count', 'rating_sum', 'rating').order_by('id')
+        for book_id, count, total, rating in books.iterator(chunk_size=batch_size):
+            checked += 1
+            real_count, real_sum = totals.get(book_id, (0, 0))
+            real_rating = real_sum / real_count if real_count else None
+            same_rating = (rating is None and real_rating is None) or (
+                rating is not None and real_rating is not None and abs(rating - real_rating) < 1e-9
+            )
+            if count != real_count or total != real_sum or not same_rating:
+                drifted.append(Kitob(pk=book_id, rating_count=real_count, rating_sum=real_sum, rating=real_rating))
+
+        if drifted and not options['dry_run']:
+            Kitob.objects.bulk_update(drifted, ['rating_count', 'rating_sum', 'rating'], batch_size=batch_size)
+
+        action = "would fix" if options['dry_run'] else "fixed"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} books, {action} {len(drifted)}."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from books import stats
+
+
+class Command(BaseCommand):
+    help = "Recount the global stats counters and fix any drift; optionally rebuild the daily user stats."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without writing.")
+        parser.add_argument('--rebuild-rollup', action='store_true', help="Recompute UserDailyStats from scratch.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        drifted = stats.reconcile(dry_run=options['dry_run'])
+        for name, (stored, actual) in drifted.items():
+            self.stdout.write(f"{name}: {stored} -> {actual}")
+        action = "would fix" if options['dry_run'] else "fixed"
+        self.stdout.write(self.style.SUCCESS(f"Checked {len(stats.COUNTERS)} counters, {action} {len(drifted)}."))
+
+        if options['rebuild_rollup'] and not options['dry_run']:
+            rows = stats.rebuild_rollup(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} daily stats rows."))
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:43
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Kitob = apps.get_model('books', 'Kitob')
+    Rating = apps.get_model('books', 'Rating')
+    totals = Rating.objects.values('book_id').annotate(n=Count('id'), total=Sum('score')).order_by()
+    books = []
+    for row in totals:
+        books.append(Kitob(pk=row['book_id'], rating_count=row['n'], rating_sum=row['total'],
+                           rating=row['total'] / row['n']))
+    Kitob.objects.bulk_update(books, ['rating_count', 'rating_sum', 'rating'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0013_reservation_returned_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kitob',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='kitob',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='kitob',
+            name='rating',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.utils import OperationalError
+
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE books_kitob_fts USING fts5(
+        name, authors, tags,
+        content='books_kitobsearchdocument', content_rowid='kitob_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER books_kitob_fts_ai AFTER INSERT ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(rowid, name, authors, tags)
+        VALUES (new.kitob_id, new.name, new.authors, new.tags);
+    END""",
+    """CREATE TRIGGER books_kitob_fts_ad AFTER DELETE ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(books_kitob_fts, rowid, name, authors, tags)
+        VALUES ('delete', old.kitob_id, old.name, old.authors, old.tags);
+    END""",
+    """CREATE TRIGGER books_kitob_fts_au AFTER UPDATE ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(books_kitob_fts, rowid, name, authors, tags)
+        VALUES ('delete', old.kitob_id, old.name, old.authors, old.tags);
+        INSERT INTO books_kitob_fts(rowid, name, authors, tags)
+        VALUES (new.kitob_id, new.name, new.authors, new.tags);
+    END""",
+]
+SQLITE_FTS_DROP = [
+    'DROP TRIGGER IF EXISTS books_kitob_fts_ai',
+    'DROP TRIGGER IF EXISTS books_kitob_fts_ad',
+    'DROP TRIGGER IF EXISTS books_kitob_fts_au',
+    'DROP TABLE IF EXISTS books_kitob_fts',
+]
+POSTGRES_INDEX = """CREATE INDEX books_kitobsearchdocument_tsv ON books_kitobsearchdocument USING GIN (
+    (setweight(to_tsvector('simple', name), 'A')
+     || setweight(to_tsvector('simple', authors), 'B')
+     || setweight(to_tsvector('simple', tags), 'C'))
+)"""
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            for statement in SQLITE_FTS:
+                schema_editor.execute(statement)
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE queries.
+            for statement in SQLITE_FTS_DROP:
+                schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_INDEX)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for statement in SQLITE_FTS_DROP:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS books_kitobsearchdocument_tsv')
+
+
+def build_documents(apps, schema_editor):
+    from books.search import normalize
+
+    Kitob = apps.get_model('books', 'Kitob')
+    KitobSearchDocument = apps.get_model('books', 'KitobSearchDocument')
+    authors, tags = {}, {}
+    for book_id, name in Kitob.author.through.objects.values_list('kitob_id', 'author__name'):
+        authors.setdefault(book_id, []).append(name)
+    for book_id, name in Kitob.tags.through.objects.values_list('kitob_id', 'tag__name'):
+        tags.setdefault(book_id, []).append(name)
+    KitobSearchDocument.objects.bulk_create(
+        (
+            KitobSearchDocument(
+                kitob_id=book_id,
+                name=normalize(name),
+                authors=normalize(' '.join(authors.get(book_id, []))),
+                tags=normalize(' '.join(tags.get(book_id, []))),
+            )
+            for book_id, name in Kitob.objects.values_list('pk', 'name').iterator()
+        ),
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0014_kitob_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KitobSearchDocument',
+            fields=[
+                ('kitob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='books.kitob')),
+                ('name', models.TextField(blank=True, default='')),
+                ('authors', models.TextField(blank=True, default='')),
+                ('tags', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.RunPython(create_index, drop_index),
+        migrations.RunPython(build_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_kitob_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reservation',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('approved', 'Approved'), ('given', 'Given'), ('returned', 'Returned'), ('not_returned', 'Not Returned'), ('cancelled', 'Cancelled')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0016_reservation_cancelled_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kitob',
+            index=models.Index(condition=models.Q(('visible', True)), fields=['c_at', 'id'], name='kitob_visible_c_at'),
+        ),
+        migrations.AddIndex(
+            model_name='kitob',
+            index=models.Index(condition=models.Q(('visible', True)), fields=['rating', 'id'], name='kitob_visible_rating'),
+        ),
+        migrations.AddIndex(
+            model_name='kitob',
+            index=models.Index(condition=models.Q(('visible', True)), fields=['name', 'id'], name='kitob_visible_name'),
+        ),
+        migrations.AddIndex(
+            model_name='kitob',
+            index=models.Index(condition=models.Q(('visible', True)), fields=['published_date', 'id'], name='kitob_visible_published'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['book', 'place'], name='reservation_pending_queue'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user', 'status'], name='reservation_user_status'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'reserved_until'], name='reservation_status_until'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'approved_at'], name='reservation_status_approved'),
+        ),
+    ]
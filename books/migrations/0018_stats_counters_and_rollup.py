@@ -0,0 +1,59 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_counters(apps, schema_editor):
+    GlobalCounter = apps.get_model('books', 'GlobalCounter')
+    Kitob = apps.get_model('books', 'Kitob')
+    Category = apps.get_model('books', 'Category')
+    subCategory = apps.get_model('books', 'subCategory')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    GlobalCounter.objects.bulk_create([
+        GlobalCounter(name='books', value=Kitob.objects.count()),
+        GlobalCounter(name='active_users', value=User.objects.filter(is_active=True).count()),
+        GlobalCounter(name='categories', value=Category.objects.count() + subCategory.objects.count()),
+    ])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('books', '0017_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlobalCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_u_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('total_reservations', models.IntegerField(default=0)),
+                ('active_reservations', models.IntegerField(default=0)),
+                ('pending_reservations', models.IntegerField(default=0)),
+                ('returned_reservations', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userdailystats',
+            constraint=models.UniqueConstraint(fields=('user', 'day'), name='user_daily_stats_unique'),
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:00
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0018_stats_counters_and_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CirculationFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('loans', models.IntegerField(default=0)),
+                ('returns', models.IntegerField(default=0)),
+                ('loan_time', models.DurationField(default=datetime.timedelta)),
+                ('due', models.IntegerField(default=0)),
+                ('overdue', models.IntegerField(default=0)),
+                ('approvals', models.IntegerField(default=0)),
+                ('wait_time', models.DurationField(default=datetime.timedelta)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'reserved_from'], name='reservation_status_from'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'returned_at'], name='reservation_status_returned'),
+        ),
+        migrations.AddField(
+            model_name='circulationfact',
+            name='book',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='circulation_facts', to='books.kitob'),
+        ),
+        migrations.AddField(
+            model_name='circulationfact',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.category'),
+        ),
+        migrations.AddConstraint(
+            model_name='circulationfact',
+            constraint=models.UniqueConstraint(fields=('day', 'book'), name='circulation_fact_unique'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:14
+
+import importlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.utils import OperationalError
+
+# The FTS table and triggers of 0015, with the PDF text as a fourth column.
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE books_kitob_fts USING fts5(
+        name, authors, tags, content,
+        content='books_kitobsearchdocument', content_rowid='kitob_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER books_kitob_fts_ai AFTER INSERT ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(rowid, name, authors, tags, content)
+        VALUES (new.kitob_id, new.name, new.authors, new.tags, new.content);
+    END""",
+    """CREATE TRIGGER books_kitob_fts_ad AFTER DELETE ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(books_kitob_fts, rowid, name, authors, tags, content)
+        VALUES ('delete', old.kitob_id, old.name, old.authors, old.tags, old.content);
+    END""",
+    """CREATE TRIGGER books_kitob_fts_au AFTER UPDATE ON books_kitobsearchdocument BEGIN
+        INSERT INTO books_kitob_fts(books_kitob_fts, rowid, name, authors, tags, content)
+        VALUES ('delete', old.kitob_id, old.name, old.authors, old.tags, old.content);
+        INSERT INTO books_kitob_fts(rowid, name, authors, tags, content)
+        VALUES (new.kitob_id, new.name, new.authors, new.tags, new.content);
+    END""",
+]
+POSTGRES_INDEX = """CREATE INDEX books_kitobsearchdocument_tsv ON books_kitobsearchdocument USING GIN (
+    (setweight(to_tsvector('simple', name), 'A')
+     || setweight(to_tsvector('simple', authors), 'B')
+     || setweight(to_tsvector('simple', tags), 'C')
+     || setweight(to_tsvector('simple', content), 'D'))
+)"""
+
+search_index = importlib.import_module('books.migrations.0015_kitob_search_index')
+
+
+def replace_index(statements, postgres_index):
+    def run(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'sqlite':
+            # Replace the table and every trigger: they all list the columns.
+            for statement in search_index.SQLITE_FTS_DROP:
+                schema_editor.execute(statement)
+            try:
+                for statement in statements:
+                    schema_editor.execute(statement)
+            except OperationalError:
+                # SQLite built without FTS5: search falls back to LIKE queries.
+                for statement in search_index.SQLITE_FTS_DROP:
+                    schema_editor.execute(statement)
+                return
+            schema_editor.execute("INSERT INTO books_kitob_fts(books_kitob_fts) VALUES ('rebuild')")
+        elif vendor == 'postgresql':
+            schema_editor.execute('DROP INDEX IF EXISTS books_kitobsearchdocument_tsv')
+            schema_editor.execute(postgres_index)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0020_upload_sessions'),
+    ]
+
+    operations = [
+        # Reversed last, once the content column is gone: the triggers read it.
+        migrations.RunPython(migrations.RunPython.noop, replace_index(search_index.SQLITE_FTS, search_index.POSTGRES_INDEX)),
+        migrations.AddField(
+            model_name='kitob',
+            name='preview',
+            field=models.ImageField(blank=True, null=True, upload_to='book_previews/'),
+        ),
+        migrations.AddField(
+            model_name='kitobsearchdocument',
+            name='content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.CreateModel(
+            name='KitobPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('text', models.TextField(blank=True, default='')),
+                ('kitob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='page_texts', to='books.kitob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='kitobpage',
+            constraint=models.UniqueConstraint(fields=('kitob', 'number'), name='kitob_page_unique'),
+        ),
+        migrations.RunPython(replace_index(SQLITE_FTS, POSTGRES_INDEX), search_index.drop_index),
+    ]
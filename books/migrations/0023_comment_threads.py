@@ -0,0 +1,42 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_comment_roots(apps, schema_editor):
+    Comment = apps.get_model('books', 'Comment')
+    predecessors = {
+        pk: reply_to_id or parent_id
+        for pk, reply_to_id, parent_id in Comment.objects.values_list('id', 'reply_to_id', 'parent_id')
+    }
+
+    def root_of(pk):
+        seen = set()
+        while predecessors.get(pk) and pk not in seen:
+            seen.add(pk)
+            pk = predecessors[pk]
+        return pk
+
+    comments = [Comment(pk=pk, root_id=root_of(pk)) for pk, predecessor in predecessors.items() if predecessor]
+    Comment.objects.bulk_update(comments, ['root'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0022_export_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='root',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_comments', to='books.comment'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('root__isnull', True)), fields=['book', 'c_at', 'id'], name='comment_top_level'),
+        ),
+        migrations.RunPython(backfill_comment_roots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0024_import_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('verifying', 'Verifying'), ('complete', 'Complete'), ('failed', 'Failed')], default='uploading', max_length=10),
+        ),
+    ]
@@ -1,18 +1,21 @@
+import uuid
+
 from django.db import models
 from django.conf import settings
 from common.models import BaseModel
-from django.db.models.signals import post_save, pre_save, post_delete
+from django.db.models.signals import post_save, post_delete, post_init
 from django.dispatch import receiver
-from django.db.models import F, Avg, Max
-from django.db import transaction
-from django.core.exceptions import ValidationError
+from django.db.models import F, Case, When, Value, FloatField
+from django.db.models.functions import Cast
 from django.utils import timezone
+from datetime import timedelta
 RESERV_STATUS_CHOICES = (
     ('pending', 'Pending'),
     ('approved', 'Approved'),
     ('given', 'Given'),
     ('returned', 'Returned'),
     ('not_returned', 'Not Returned'),
+    ('cancelled', 'Cancelled'),
 
 )
 class Journals(BaseModel):
@@ -52,7 +55,9 @@ class Kitob(BaseModel):
     read_time = models.IntegerField(default=14, null=True, blank=True)
     quantity = models.IntegerField()
     visible = models.BooleanField(default=True)
-    rating = models.IntegerField(null=True, blank=True)
+    rating = models.FloatField(null=True, blank=True)
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
     description = models.TextField()
     author = models.ManyToManyField(Author)
     location = models.CharField(max_length=255, null=True,blank=True)
@@ -66,6 +71,18 @@ class Kitob(BaseModel):
     audio = models.FileField(upload_to='book_audios/', null=True, blank=True)
     is_physical = models.BooleanField(default=True)
     pages = models.IntegerField(null=True, blank=True)
+    # First page of the PDF, rendered by books/pdf.py.
+    preview = models.ImageField(upload_to='book_previews/', null=True, blank=True)
+
+    class Meta:
+        # The catalog only lists visible books, sorted with id as tie-breaker.
+        indexes = [
+            models.Index(fields=['c_at', 'id'], condition=models.Q(visible=True), name='kitob_visible_c_at'),
+            models.Index(fields=['rating', 'id'], condition=models.Q(visible=True), name='kitob_visible_rating'),
+            models.Index(fields=['name', 'id'], condition=models.Q(visible=True), name='kitob_visible_name'),
+            models.Index(fields=['published_date', 'id'], condition=models.Q(visible=True), name='kitob_visible_published'),
+        ]
+
     def __str__(self):
         return self.name + " " + ", ".join(str(author) for author in self.author.all())
     
@@ -75,8 +92,7 @@ class Kitob(BaseModel):
     
     def get_average_rating(self):
         """Returns the average rating for this book, or None if no ratings exist."""
-        avg = self.ratings.aggregate(Avg('score'))['score__avg']
-        return round(avg, 1) if avg else None
+        return round(self.rating, 1) if self.rating else None
 class Reservation(BaseModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     book = models.ForeignKey(Kitob, on_delete=models.CASCADE)
@@ -87,6 +103,17 @@ class Reservation(BaseModel):
     approved_at = models.DateTimeField(null=True, blank=True)
     returned_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Every queue query (enqueue, allocation, closing gaps) is pending-only.
+            models.Index(fields=['book', 'place'], condition=models.Q(status='pending'), name='reservation_pending_queue'),
+            models.Index(fields=['user', 'status'], name='reservation_user_status'),
+            models.Index(fields=['status', 'reserved_until'], name='reservation_status_until'),
+            models.Index(fields=['status', 'approved_at'], name='reservation_status_approved'),
+            models.Index(fields=['status', 'reserved_from'], name='reservation_status_from'),
+            models.Index(fields=['status', 'returned_at'], name='reservation_status_returned'),
+        ]
+
     def __str__(self):
         return f'{self.user.username} - {self.book.name}'
 
@@ -108,9 +135,17 @@ class Comment(BaseModel):
     reply_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='replies')
     rating = models.ForeignKey(Rating, null=True, blank=True, on_delete=models.SET_NULL, related_name='comments')
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='child_comments')
+    # Top-level comment of the thread, kept by books/comments.py; null on top-level comments.
+    root = models.ForeignKey('self', null=True, blank=True, editable=False, on_delete=models.CASCADE, related_name='thread_comments')
 
     content = models.TextField()
-    
+
+    class Meta:
+        # The thread endpoint pages through a book's top-level comments.
+        indexes = [
+            models.Index(fields=['book', 'c_at', 'id'], condition=models.Q(root__isnull=True), name='comment_top_level'),
+        ]
+
     def __str__(self):
         return f'{self.user.username} commented on {self.book.name}'
 class Bookmark(BaseModel):
@@ -123,194 +158,193 @@ class Bookmark(BaseModel):
     def __str__(self):
         return f'{self.user.username} bookmarked {self.book.name}'
 
-@receiver(pre_save, sender=Reservation)
-def reservation_pre_save(sender, instance, **kwargs):
-    if instance.pk:
-        try:
-            old = Reservation.objects.get(pk=instance.pk)
-            instance._pre_save_status = old.status
-            instance._pre_save_place = old.place
-        except Reservation.DoesNotExist:
-            instance._pre_save_status = None
-            instance._pre_save_place = None
-    else:
-        instance._pre_save_status = None
-        instance._pre_save_place = None
-
-    # Validate approval conditions
-    if instance.status == 'approved' and instance._pre_save_status != 'approved':
-        # Check user constraints
-        if instance.user.is_banned:
-             raise ValidationError('Cannot approve: User is banned.')
-        
-        # Check max books
-        active_count = Reservation.objects.filter(
-            user=instance.user, 
-            status__in=['approved', 'given']
-        ).exclude(pk=instance.pk).count()
-        
-        if active_count >= instance.user.max_allowed:
-            raise ValidationError(f'Cannot approve: User has reached the limit of {instance.user.max_allowed} books.')
-
-        # Check availability
-        # Note: If we are approving, we are about to reserve a copy.
-        # We must ensure there is a copy to reserve.
-        if instance.book.quantity <= 0:
-            raise ValidationError('Cannot approve reservation: no copies available for this book.')
-
-
-@receiver(post_save, sender=Reservation)
-def reservation_post_save(sender, instance, created, **kwargs):
-    # 1. Assign place for new PENDING reservations only
-    if created and instance.status == 'pending':
-        max_place = (
-            Reservation.objects.filter(book=instance.book, status='pending')
-            .exclude(pk=instance.pk)
-            .aggregate(m=Max('place'))
-        )['m']
-
-        if instance.place is None:
-            instance.place = (max_place or 0) + 1
-            Reservation.objects.filter(pk=instance.pk).update(place=instance.place)
-            # Refresh instance place
-            instance.place = (max_place or 0) + 1
-
-    # 2. Handle Status Transitions
-    prev_status = getattr(instance, '_pre_save_status', None)
-    prev_place = getattr(instance, '_pre_save_place', None)
-    
-    if prev_status != instance.status:
-        now = timezone.now()
-        book_qs = Kitob.objects.filter(pk=instance.book.pk)
-        
-        try:
-            with transaction.atomic():
-                # APPROVED: pending -> approved
-                if instance.status == 'approved' and prev_status != 'approved':
-                    # Remove from Queue: If they were in the queue, remove them and shift others up
-                    if prev_place and prev_place > 0:
-                         Reservation.objects.filter(book=instance.book, status='pending', place__gt=prev_place).update(place=F('place') - 1)
-                         # instance place is cleared below
-                    
-                    # Clear own place as they are no longer "waiting"
-                    Reservation.objects.filter(pk=instance.pk).update(place=None)
-                    
-                    # Decrement quantity
-                    book_qs.update(quantity=F('quantity') - 1)
-                    
-                    # Set approved_at (24h window starts)
-                    Reservation.objects.filter(pk=instance.pk).update(approved_at=now)
-                
-                # GIVEN: approved -> given
-                elif instance.status == 'given' and prev_status == 'approved':
-                    # Set reading timers
-                    read_time = instance.book.read_time or 14
-                    Reservation.objects.filter(pk=instance.pk).update(
-                        reserved_from=now,
-                        reserved_until=now + timezone.timedelta(days=read_time)
-                    )
-                    # Note: Quantity was already decremented on approval.
-                
-                # RETURNED: given -> returned
-                elif instance.status == 'returned' and prev_status == 'given':
-                    # Increment quantity
-                    book_qs.update(quantity=F('quantity') + 1)
-                    # Set returned_at timestamp
-                    Reservation.objects.filter(pk=instance.pk).update(returned_at=now)
-                    # Place is already None/0 from approval step
-
-                # NOT RETURNED: given -> not_returned
-                # (No quantity change, book is still out)
-
-                # CANCELLATION/RESET (e.g. Approved -> Cancelled/Pending/Returned without being given)
-                # If we revert from Approved to something else (except Given), we must restore quantity.
-                elif prev_status == 'approved' and instance.status not in ['given', 'approved']:
-                     book_qs.update(quantity=F('quantity') + 1)
-
-                
-                # Refresh book availability status based on new quantity
-                book = Kitob.objects.select_for_update().get(pk=instance.book.pk)
-                if book.quantity < 0:
-                    book.quantity = 0
-                book.is_available = book.quantity > 0
-                book.save(update_fields=['quantity', 'is_available'])
-
-        except Kitob.DoesNotExist:
-            pass
-
-    # 3. Queue Shifting (Clean up)
-    # Logic handled inside transition block (pending -> approved shifts queue).
-    pass
-
-    # 4. Auto-Approve Logic (For NEW pending request OR when book becomes available)
-    # Trigger: Created Pending OR Book Returned (Quantity became > 0)
-    
-    # We need to re-fetch book quantity because we might have just updated it
-    instance.book.refresh_from_db()
-
-    # We only auto-approve if there is stock available
-    if instance.book.quantity > 0:
-        # Check queue for who is eligible
-        # Criteria: Status pending, lowest place, valid user
-        candidates = Reservation.objects.filter(
-            book=instance.book,
-            status='pending',
-            place__gt=0  # Valid queue position
-        ).order_by('place')
-
-        for candidate in candidates:
-             # Refresh book quantity inside loop as we might have decremented it in previous iteration
-             instance.book.refresh_from_db()
-             if instance.book.quantity <= 0:
-                 break # No more books
-             
-             # Validation check
-             user = candidate.user
-             if user.is_banned:
-                 continue
-             
-             active_count = Reservation.objects.filter(
-                user=user, 
-                status__in=['approved', 'given']
-             ).count()
-             
-             if active_count >= user.max_allowed:
-                 continue
-             
-             # If Valid, Approve
-             # This save() will trigger post_save recursively:
-             # - Decrement quantity
-             # - Shift queue (remove this candidate from place 1, everyone else moves up)
-             # - Set approved_at
-             candidate.status = 'approved'
-             candidate.save()
-
-@receiver(post_delete, sender=Reservation)
-def reservation_post_delete(sender, instance, **kwargs):
-    # Shift queue if a pending reservation with a valid place is deleted
-    if instance.status == 'pending' and instance.place is not None and instance.place > 0:
-         Reservation.objects.filter(book=instance.book, status='pending', place__gt=instance.place).update(place=F('place')-1)
-
-    # If an APPROVED reservation is deleted, we must restore quantity
-    if instance.status == 'approved':
-        try:
-            with transaction.atomic():
-                Kitob.objects.filter(pk=instance.book.pk).update(quantity=F('quantity') + 1)
-                book = Kitob.objects.select_for_update().get(pk=instance.book.pk)
-                book.is_available = book.quantity > 0
-                book.save(update_fields=['quantity', 'is_available'])
-        except Kitob.DoesNotExist:
-            pass
+class KitobSearchDocument(models.Model):
+    """Normalized text of a book used by the full-text index (see books/search.py)."""
+    kitob = models.OneToOneField(Kitob, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    name = models.TextField(blank=True, default='')
+    authors = models.TextField(blank=True, default='')
+    tags = models.TextField(blank=True, default='')
+    content = models.TextField(blank=True, default='')  # PDF text, set by books/pdf.py
+
+class KitobPage(models.Model):
+    """Text of one page of a book's PDF, extracted by books/pdf.py."""
+    kitob = models.ForeignKey(Kitob, on_delete=models.CASCADE, related_name='page_texts')
+    number = models.IntegerField()  # 1-based
+    text = models.TextField(blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kitob', 'number'], name='kitob_page_unique'),
+        ]
+
+class GlobalCounter(models.Model):
+    """Site-wide count kept up to date by signals in books/stats.py."""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name}={self.value}'
+
+class RollupWatermark(models.Model):
+    """Newest ``u_at`` a rollup job has processed."""
+    name = models.CharField(max_length=50, primary_key=True)
+    last_u_at = models.DateTimeField()
+
+class UserDailyStats(models.Model):
+    """Per-user counts of the reservations created on ``day``, by current status."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    total_reservations = models.IntegerField(default=0)
+    active_reservations = models.IntegerField(default=0)
+    pending_reservations = models.IntegerField(default=0)
+    returned_reservations = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='user_daily_stats_unique'),
+        ]
+
+class CirculationFact(models.Model):
+    """
+    Circulation of one book on one day, rebuilt by books/analytics.py.
+    Every column is additive, so any date range is a plain SUM over rows.
+    """
+    day = models.DateField()
+    book = models.ForeignKey(Kitob, on_delete=models.CASCADE, related_name='circulation_facts')
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
+    loans = models.IntegerField(default=0)  # handed out this day
+    returns = models.IntegerField(default=0)  # returned this day
+    loan_time = models.DurationField(default=timedelta)  # summed over this day's returns
+    due = models.IntegerField(default=0)  # loans due back this day
+    overdue = models.IntegerField(default=0)  # of those, returned late or not at all
+    approvals = models.IntegerField(default=0)  # approved this day
+    wait_time = models.DurationField(default=timedelta)  # request-to-approval, summed over this day's approvals
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'book'], name='circulation_fact_unique'),
+        ]
+
+UPLOAD_KIND_CHOICES = (
+    ('pdf', 'PDF'),
+    ('audio', 'Audio'),
+)
+UPLOAD_STATUS_CHOICES = (
+    ('uploading', 'Uploading'),
+    ('verifying', 'Verifying'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+)
+
+class UploadSession(BaseModel):
+    """A resumable upload of a book's PDF or audio file (see books/uploads.py)."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    book = models.ForeignKey(Kitob, on_delete=models.CASCADE, related_name='upload_sessions')
+    kind = models.CharField(max_length=10, choices=UPLOAD_KIND_CHOICES)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.BigIntegerField(default=0)  # bytes stored contiguously from the start
+    status = models.CharField(max_length=10, choices=UPLOAD_STATUS_CHOICES, default='uploading')
+
+    class Meta:
+        # Garbage collection looks for sessions idle since before a cutoff.
+        indexes = [
+            models.Index(fields=['u_at'], name='upload_session_u_at'),
+        ]
+
+EXPORT_KIND_CHOICES = (
+    ('kitob', 'Catalog'),
+    ('reservations', 'Reservations'),
+)
+EXPORT_FORMAT_CHOICES = (
+    ('csv', 'CSV'),
+    ('jsonl', 'JSON Lines'),
+    ('xlsx', 'XLSX'),
+)
+EXPORT_STATUS_CHOICES = (
+    ('pending', 'Pending'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+class ExportJob(BaseModel):
+    """An export written to a file by a Celery worker (see books/exports.py)."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='export_jobs')
+    kind = models.CharField(max_length=20, choices=EXPORT_KIND_CHOICES)
+    file_format = models.CharField(max_length=10, choices=EXPORT_FORMAT_CHOICES)
+    query = models.TextField(blank=True, default='')  # the filter parameters, as a query string
+    status = models.CharField(max_length=10, choices=EXPORT_STATUS_CHOICES, default='pending')
+    rows = models.IntegerField(default=0)
+
+    class Meta:
+        # Expired files are looked up by age.
+        indexes = [
+            models.Index(fields=['c_at'], name='export_job_c_at'),
+        ]
+
+IMPORT_FORMAT_CHOICES = (
+    ('csv', 'CSV'),
+    ('jsonl', 'JSON Lines'),
+    ('marc', 'MARC 21'),
+)
+
+class ImportJob(BaseModel):
+    """A catalog import run by a Celery worker (see books/importer.py)."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='import_jobs')
+    file_format = models.CharField(max_length=10, choices=IMPORT_FORMAT_CHOICES)
+    options = models.JSONField(default=dict, blank=True)  # keyword arguments of Importer
+    status = models.CharField(max_length=10, choices=EXPORT_STATUS_CHOICES, default='pending')
+    report = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['c_at'], name='import_job_c_at'),
+        ]
+
+def apply_rating_delta(book_id, count_delta, sum_delta):
+    """
+    Shift a book's rating aggregates by the given deltas in one UPDATE.
+    The average is derived from the pre-update columns inside the same
+    statement, so concurrent rating writes never lose an increment.
+    """
+    new_count = F('rating_count') + count_delta
+    new_sum = F('rating_sum') + sum_delta
+    Kitob.objects.filter(pk=book_id).update(
+        rating_count=new_count,
+        rating_sum=new_sum,
+        rating=Case(
+            When(rating_count__lte=-count_delta, then=Value(None)),
+            default=Cast(new_sum, FloatField()) / new_count,
+            output_field=FloatField(),
+        ),
+        u_at=timezone.now(),
+    )
+
+@receiver(post_init, sender=Rating)
+def remember_rating_state(sender, instance, **kwargs):
+    # Read through __dict__ so deferred fields are not fetched on every load.
+    instance._original_book_id = instance.__dict__.get('book_id')
+    instance._original_score = instance.__dict__.get('score')
 
 @receiver(post_save, sender=Rating)
-def set_avg_rating(sender,instance,**kwargs):
-    book = instance.book
-    avg_rating = book.ratings.aggregate(Avg('score'))['score__avg']
-    book.rating = round(avg_rating, 1) if avg_rating else None
-    book.save(update_fields=['rating'])
+def set_avg_rating(sender, instance, created, **kwargs):
+    old_book_id = instance._original_book_id
+    old_score = instance._original_score
+    if created or old_book_id is None:
+        apply_rating_delta(instance.book_id, 1, instance.score)
+    elif old_book_id != instance.book_id:
+        apply_rating_delta(old_book_id, -1, -old_score)
+        apply_rating_delta(instance.book_id, 1, instance.score)
+    elif old_score != instance.score:
+        apply_rating_delta(instance.book_id, 0, instance.score - old_score)
+    instance._original_book_id = instance.book_id
+    instance._original_score = instance.score
+
 @receiver(post_delete, sender=Rating)
 def update_avg_rating_on_delete(sender, instance, **kwargs):
-    book = instance.book
-    avg_rating = book.ratings.aggregate(Avg('score'))['score__avg']
-    book.rating = round(avg_rating, 1) if avg_rating else None
-    book.save(update_fields=['rating'])
+    apply_rating_delta(instance._original_book_id or instance.book_id, -1, -(instance._original_score or instance.score))
@@ -1,10 +1,176 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetCursorMixin:
+    """
+    Opt-in keyset pagination for a PageNumberPagination subclass.
+
+    When the request carries ``?cursor=`` (an empty value asks for the first
+    page) the page is selected with ``WHERE (key, id) > (last_key, last_id)``
+    instead of COUNT(*) + OFFSET, so the cost stays flat however deep the
+    client scrolls. The key is the first ordering already applied to the
+    queryset (e.g. by KitobFilter's ``sort`` or an OrderingFilter) when it is
+    listed in ``cursor_fields``, otherwise ``default_cursor_ordering``; ``id``
+    breaks ties. NULL keys sort last in both directions. Requests without the
+    parameter keep the page-number behaviour, and so do querysets ordered
+    first by one of ``page_number_orderings`` (a computed value such as the
+    search rank, which cannot be compared across requests).
+    """
+    cursor_query_param = 'cursor'
+    cursor_fields = ('id',)
+    default_cursor_ordering = '-id'
+    page_number_orderings = ()
+    cursor_by_default = False
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = (
+            (self.cursor_by_default or self.cursor_query_param in request.query_params)
+            and not self.has_page_number_ordering(queryset)
+        )
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.model = queryset.model
+        self.field, self.descending = self.get_cursor_ordering(queryset)
+        position = self.decode_cursor(request)
+        reverse = bool(position and position['r'])
+
+        queryset = queryset.order_by(*self.ordering_expressions(reverse))
+        if position:
+            queryset = queryset.filter(self.position_filter(position['v'], position['id'], reverse))
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.next_position = self.previous_position = None
+        if results:
+            if has_more or reverse:
+                self.next_position = (results[-1], False)
+            if position and (has_more or not reverse):
+                self.previous_position = (results[0], True)
+        return results
+
+    def has_page_number_ordering(self, queryset):
+        order_by = queryset.query.order_by
+        return bool(order_by) and isinstance(order_by[0], str) and order_by[0].lstrip('-') in self.page_number_orderings
+
+    def get_cursor_ordering(self, queryset):
+        ordering = self.default_cursor_ordering
+        for term in queryset.query.order_by:
+            if isinstance(term, str) and term.lstrip('-') in self.cursor_fields:
+                ordering = term
+            break
+        return ordering.lstrip('-'), ordering.startswith('-')
 
-class KitobPagination(PageNumberPagination):
+    def ordering_expressions(self, reverse):
+        descending = self.descending != reverse
+        pk = F('id').desc() if descending else F('id').asc()
+        if self.field == 'id':
+            return [pk]
+        nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        key = F(self.field).desc(**nulls) if descending else F(self.field).asc(**nulls)
+        return [key, pk]
+
+    def position_filter(self, value, pk, reverse):
+        after = 'lt' if self.descending != reverse else 'gt'
+        if self.field == 'id':
+            return Q(**{f'id__{after}': pk})
+        if reverse:
+            # Walking back towards the start: NULLs come first here.
+            if value is None:
+                return Q(**{f'{self.field}__isnull': False}) | Q(**{f'{self.field}__isnull': True, f'id__{after}': pk})
+            return Q(**{f'{self.field}__{after}': value}) | Q(**{self.field: value, f'id__{after}': pk})
+        if value is None:
+            return Q(**{f'{self.field}__isnull': True, f'id__{after}': pk})
+        return (
+            Q(**{f'{self.field}__{after}': value})
+            | Q(**{self.field: value, f'id__{after}': pk})
+            | Q(**{f'{self.field}__isnull': True})
+        )
+
+    def encode_cursor(self, obj, reverse):
+        value = getattr(obj, self.field)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        payload = {'o': self.field, 'v': value, 'id': obj.pk, 'r': reverse}
+        token = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+            if payload['o'] != self.field:
+                raise ValueError('cursor was issued for a different ordering')
+            value = payload['v']
+            if value is not None and self.field != 'id':
+                value = self.model._meta.get_field(self.field).to_python(value)
+            return {'v': value, 'id': int(payload['id']), 'r': bool(payload['r'])}
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.encode_cursor(*self.next_position) if self.next_position else None,
+            'previous': self.encode_cursor(*self.previous_position) if self.previous_position else None,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count']['description'] = 'Omitted when paginating with ?cursor='
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        parameters.append({
+            'name': self.cursor_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Pass an empty value to switch to keyset pagination, then follow next/previous links. '
+                           'Ignored for results ranked by relevance, which are paged by number.',
+            'schema': {'type': 'string'},
+        })
+        return parameters
+
+
+class KitobPagination(KeysetCursorMixin, PageNumberPagination):
     page_size = 10  # Default page size
     page_size_query_param = 'page_size'  # Allow client to set page size with ?page_size=
     max_page_size = 50  # Maximum page size to prevent abuse
-class ReservationPagination(PageNumberPagination):
+    cursor_fields = ('c_at', 'rating', 'name', 'published_date', 'id')
+    default_cursor_ordering = '-c_at'
+    # Relevance-ranked searches (KitobSearchFilter) are paged by number.
+    page_number_orderings = ('search_rank',)
+class ReservationPagination(KeysetCursorMixin, PageNumberPagination):
     page_size = 15
     page_size_query_param = 'page_size'
-    max_page_size = 50
\ No newline at end of file
+    max_page_size = 50
+    cursor_fields = ('id', 'c_at', 'u_at', 'status', 'place', 'reserved_from', 'reserved_until', 'approved_at', 'returned_at')
+    default_cursor_ordering = '-id'
+class CommentThreadPagination(KeysetCursorMixin, PageNumberPagination):
+    # Threads are always paged by keyset over the top-level comments, newest first.
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    cursor_fields = ('c_at', 'id')
+    default_cursor_ordering = '-c_at'
+    cursor_by_default = True
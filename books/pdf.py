@@ -0,0 +1,178 @@
+"""
+PDF ingestion: page count, per-page text and a first-page preview.
+
+Saving a book with a new PDF queues ``books.task.process_pdf`` once the
+transaction commits, so the save never waits for it. The task is routed to
+the ``media`` queue (CELERY_TASK_ROUTES), which is meant for its own small
+worker pool so a huge file cannot hold up notifications and rollups, and a
+worker that grew while parsing one is recycled:
+
+    celery -A config worker -Q media --concurrency 2 --max-tasks-per-child 50
+
+The file is read from storage with pypdf, PAGE_BATCH pages per reader. pypdf
+caches every object it resolves (for scans, that includes the page images),
+so starting a fresh reader for each batch keeps memory flat however long
+the book is. Each page's text is capped at PAGE_TEXT_LIMIT characters and
+upserted as a KitobPage row, then the joined text is indexed for the
+catalog search (``search.index_content``). Scans without a text layer get
+empty pages; the count and preview still work.
+
+The preview is rendered with pypdfium2 when it is installed (optional),
+otherwise the first image embedded in page one (the scan itself, on
+scanned books) is used. Without pypdf nothing is extracted and a warning is
+logged.
+"""
+import io
+import logging
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from PIL import Image
+
+from .cache import bump
+from .models import Kitob, KitobPage
+from . import search
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+PAGE_BATCH = 50
+PAGE_TEXT_LIMIT = 20_000
+PREVIEW_WIDTH = 640
+
+
+def _page_text(page):
+    try:
+        text = page.extract_text() or ''
+    except Exception:
+        # One malformed content stream should not lose the rest of the book.
+        logger.warning("Could not extract text from a page", exc_info=True)
+        return ''
+    return text.replace('\x00', '')[:PAGE_TEXT_LIMIT]
+
+
+def _open(file):
+    file.seek(0)
+    reader = pypdf.PdfReader(file)
+    if reader.is_encrypted:
+        # Many PDFs are "encrypted" with an empty user password.
+        reader.decrypt('')
+    return reader
+
+
+def extract_pages(book_id, file):
+    """Store the text of every page of ``file``; return the page count."""
+    count = len(_open(file).pages)
+    for offset in range(0, count, PAGE_BATCH):
+        reader = _open(file)
+        KitobPage.objects.bulk_create(
+            [
+                KitobPage(kitob_id=book_id, number=number + 1, text=_page_text(reader.pages[number]))
+                for number in range(offset, min(offset + PAGE_BATCH, count))
+            ],
+            update_conflicts=True,
+            unique_fields=['kitob', 'number'],
+            update_fields=['text'],
+        )
+    KitobPage.objects.filter(kitob_id=book_id, number__gt=count).delete()
+    return count
+
+
+def render_preview(file):
+    """Return the first page as JPEG bytes, or None."""
+    image = None
+    if pypdfium2 is not None:
+        file.seek(0)
+        document = pypdfium2.PdfDocument(file)
+        try:
+            page = document[0]
+            image = page.render(scale=PREVIEW_WIDTH / page.get_width()).to_pil()
+        finally:
+            document.close()
+    else:
+        images = _open(file).pages[0].images
+        if images:
+            image = images[0].image
+    if image is None:
+        return None
+    image.thumbnail((PREVIEW_WIDTH, PREVIEW_WIDTH * 4), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=82, optimize=True)
+    return buffer.getvalue()
+
+
+def process(book_id, name):
+    """
+    Extract the page count, text and preview of ``name`` for ``book_id``.
+    Does nothing if the book no longer has that PDF. Returns the page count.
+    """
+    if pypdf is None:
+        logger.warning("pypdf is not installed, skipping PDF processing of book %s", book_id)
+        return None
+    book = Kitob.objects.filter(pk=book_id, pdf=name).only('pk', 'pdf', 'preview').first()
+    if book is None:
+        return None
+
+    with book.pdf.open('rb') as file:
+        count = extract_pages(book_id, file)
+        try:
+            preview = render_preview(file)
+        except Exception:
+            logger.warning("Could not render a preview of book %s", book_id, exc_info=True)
+            preview = None
+
+    previous = book.preview.name
+    if preview:
+        book.preview.save(f'{book_id}.jpg', ContentFile(preview), save=False)
+    now = timezone.now()
+    with transaction.atomic():
+        # The PDF may have been replaced meanwhile; that upload queued its own run.
+        updated = Kitob.objects.filter(pk=book_id, pdf=name).update(pages=count, preview=book.preview.name, u_at=now)
+        if updated:
+            search.index_content(book_id, search.page_texts(book_id))
+            transaction.on_commit(lambda: bump('kitob'))
+    if updated and previous and previous != book.preview.name:
+        book.preview.storage.delete(previous)
+    elif not updated and preview:
+        book.preview.storage.delete(book.preview.name)
+    return count
+
+
+def queue(book_id, name):
+    from .task import process_pdf
+    try:
+        process_pdf.delay(book_id, name)
+    except Exception:
+        logger.warning("Could not queue PDF processing of book %s", book_id, exc_info=True)
+
+
+@receiver(post_init, sender=Kitob, dispatch_uid='pdf-kitob-init')
+def remember_pdf(sender, instance, **kwargs):
+    # Read through __dict__ so a deferred pdf is not fetched on every load.
+    value = instance.__dict__.get('pdf')
+    instance._pdf_was = getattr(value, 'name', value)
+
+
+@receiver(post_save, sender=Kitob, dispatch_uid='pdf-kitob-save')
+def process_new_pdf(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'pdf' not in update_fields):
+        return
+    name = instance.pdf.name
+    if name and (created or name != instance._pdf_was):
+        transaction.on_commit(lambda: queue(instance.pk, name))
+    elif not name and instance._pdf_was:
+        KitobPage.objects.filter(kitob_id=instance.pk).delete()
+        search.index_content(instance.pk, [])
+    instance._pdf_was = name
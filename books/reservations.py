@@ -0,0 +1,329 @@
+"""
+Reservation state machine.
+
+Every transition (approve, give, return, cancel) runs in one transaction and
+changes each table with a conditional UPDATE whose WHERE clause re-checks the
+state it expects: ``status = 'pending'`` for the reservation, ``quantity > 0``
+for the book. Two librarians approving the last copy at the same time
+therefore cannot both succeed; the loser's UPDATE matches no row and its
+transaction is rolled back. No row is read back and re-saved, so no signal
+fires recursively.
+
+    pending --approve--> approved --give--> given --return--> returned
+       |                    |                 |
+       +-----cancel---------+                 +--(overdue)--> not_returned --return--> returned
+                 v
+             cancelled
+
+``Kitob.quantity`` is the number of copies on the shelf: approving takes one,
+returning or cancelling an approval puts it back.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, BooleanField, IntegerField, Count, Max, Subquery, OuterRef
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import bump
+from .models import Kitob, Reservation
+
+ACTIVE_STATUSES = ('approved', 'given')
+RETURNABLE_STATUSES = ('given', 'not_returned')
+CANCELLABLE_STATUSES = ('pending', 'approved')
+
+
+class TransitionError(Exception):
+    """Raised when a reservation cannot move to the requested state."""
+
+
+def change_stock(book_id, delta, now=None):
+    """
+    Add ``delta`` copies to a book in one UPDATE, refusing to go below zero.
+    Returns True if the row was updated.
+    """
+    now = now or timezone.now()
+    queryset = Kitob.objects.filter(pk=book_id)
+    if delta < 0:
+        queryset = queryset.filter(quantity__gte=-delta)
+    updated = queryset.update(
+        quantity=F('quantity') + delta,
+        is_available=Case(When(quantity__gt=-delta, then=Value(True)), default=Value(False), output_field=BooleanField()),
+        u_at=now,
+    )
+    if updated:
+        transaction.on_commit(lambda: bump('kitob', 'stats'))
+    return bool(updated)
+
+
+def close_queue_gap(book_id, place):
+    """Move everyone queued behind ``place`` one step forward."""
+    Reservation.objects.filter(book_id=book_id, status='pending', place__gt=place).update(place=F('place') - 1)
+
+
+def check_eligibility(reservation):
+    user = reservation.user
+    if user.is_banned:
+        raise TransitionError('Cannot approve: User is banned.')
+    active_count = Reservation.objects.filter(user=user, status__in=ACTIVE_STATUSES).exclude(pk=reservation.pk).count()
+    if active_count >= user.max_allowed:
+        raise TransitionError(f'Cannot approve: User has reached the limit of {user.max_allowed} books.')
+
+
+def _load(reservation_id):
+    try:
+        return Reservation.objects.select_related('user', 'book').get(pk=reservation_id)
+    except Reservation.DoesNotExist:
+        raise TransitionError('Reservation not found.')
+
+
+def _move(reservation, from_statuses, **changes):
+    """Conditionally move one reservation; raise if someone else moved it first."""
+    updated = Reservation.objects.filter(pk=reservation.pk, status__in=from_statuses).update(**changes)
+    if not updated:
+        raise TransitionError('Reservation was changed by another request, please retry.')
+
+
+def enqueue(reservation):
+    """Give a new pending reservation the next place in its book's queue and try to serve it."""
+    last_place = (
+        Reservation.objects.filter(book_id=OuterRef('book_id'), status='pending')
+        .order_by().values('book_id').annotate(m=Max('place')).values('m')
+    )
+    Reservation.objects.filter(pk=reservation.pk, place__isnull=True).update(
+        place=Coalesce(Subquery(last_place), 0) + 1
+    )
+    fill_queue(reservation.book_id)
+
+
+def approve(reservation_id, now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        reservation = _load(reservation_id)
+        if reservation.status != 'pending':
+            raise TransitionError('Only pending reservations can be approved.')
+        check_eligibility(reservation)
+        if not change_stock(reservation.book_id, -1, now):
+            raise TransitionError('Cannot approve reservation: no copies available for this book.')
+        _move(reservation, ['pending'], status='approved', place=None, approved_at=now, u_at=now)
+        if reservation.place:
+            close_queue_gap(reservation.book_id, reservation.place)
+    return reservation
+
+
+def give(reservation_id, now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        reservation = _load(reservation_id)
+        if reservation.status != 'approved':
+            raise TransitionError('Reservation must be approved first.')
+        read_time = reservation.book.read_time or 14
+        _move(reservation, ['approved'], status='given', reserved_from=now,
+              reserved_until=now + timedelta(days=read_time), u_at=now)
+    return reservation
+
+
+def return_book(reservation_id, now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        reservation = _load(reservation_id)
+        if reservation.status not in RETURNABLE_STATUSES:
+            raise TransitionError('Only given books can be marked as returned.')
+        _move(reservation, RETURNABLE_STATUSES, status='returned', returned_at=now, u_at=now)
+        change_stock(reservation.book_id, 1, now)
+    fill_queue(reservation.book_id)
+    return reservation
+
+
+def cancel(reservation_id, now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        reservation = _load(reservation_id)
+        if reservation.status not in CANCELLABLE_STATUSES:
+            raise TransitionError('Only pending or approved reservations can be cancelled.')
+        _move(reservation, [reservation.status], status='cancelled', place=None, u_at=now)
+        if reservation.status == 'approved':
+            change_stock(reservation.book_id, 1, now)
+        elif reservation.place:
+            close_queue_gap(reservation.book_id, reservation.place)
+    if reservation.status == 'approved':
+        fill_queue(reservation.book_id)
+    return reservation
+
+
+def release_copies(counts, now=None):
+    """Put copies back on the shelf for many books in one UPDATE. ``counts`` maps book id to copies."""
+    if not counts:
+        return
+    now = now or timezone.now()
+    delta = Case(*[When(pk=book_id, then=Value(n)) for book_id, n in counts.items()], output_field=IntegerField())
+    Kitob.objects.filter(pk__in=counts).update(quantity=F('quantity') + delta, is_available=True, u_at=now)
+    transaction.on_commit(lambda: bump('kitob', 'stats'))
+
+
+def mark_overdue(now=None, batch_size=1000):
+    """
+    Move every given loan past its deadline to not_returned, one set-based
+    UPDATE per batch. Returns (user_id, book name) for each moved loan.
+    """
+    now = now or timezone.now()
+    moved = []
+    overdue = Reservation.objects.filter(status='given', reserved_until__lt=now)
+    while True:
+        with transaction.atomic():
+            batch = list(overdue.select_for_update().values_list('pk', 'user_id', 'book__name')[:batch_size])
+            if not batch:
+                return moved
+            Reservation.objects.filter(pk__in=[row[0] for row in batch], status='given').update(status='not_returned', u_at=now)
+        moved.extend(row[1:] for row in batch)
+
+
+def expire_approvals(deadline, now=None, batch_size=1000):
+    """
+    Cancel approvals not picked up since ``deadline``, return their copies and
+    offer them to the queues. Returns (user_id, book name) for each
+    cancelled reservation.
+    """
+    now = now or timezone.now()
+    cancelled = []
+    books = set()
+    expired = Reservation.objects.filter(status='approved', approved_at__lt=deadline)
+    while True:
+        with transaction.atomic():
+            batch = list(expired.select_for_update().values_list('pk', 'user_id', 'book_id', 'book__name')[:batch_size])
+            if not batch:
+                break
+            Reservation.objects.filter(pk__in=[row[0] for row in batch], status='approved').update(status='cancelled', u_at=now)
+            release_copies(Counter(row[2] for row in batch), now)
+        cancelled.extend((row[1], row[3]) for row in batch)
+        books.update(row[2] for row in batch)
+    allocate(books)
+    return cancelled
+
+
+class AllocationConflict(Exception):
+    """The shelf or the queue changed between planning and applying an allocation."""
+
+
+def plan_allocation(stock, queue, active_loans):
+    """
+    Decide, in memory, which waiting reservations can be approved.
+
+    ``stock`` maps book id to free copies, ``queue`` is the pending
+    reservations (with their user loaded) in (book, place) order, and
+    ``active_loans`` maps user id to approved+given count. The rules match
+    approve(): banned users and users at their limit are skipped and keep
+    their place. Returns the approved reservations and copies taken per book.
+    """
+    active_loans = dict(active_loans)
+    taken = Counter()
+    approvals = []
+    for reservation in queue:
+        book_id, user = reservation.book_id, reservation.user
+        if stock.get(book_id, 0) - taken[book_id] <= 0:
+            continue
+        if user.is_banned or active_loans.get(user.pk, 0) >= user.max_allowed:
+            continue
+        approvals.append(reservation)
+        taken[book_id] += 1
+        active_loans[user.pk] = active_loans.get(user.pk, 0) + 1
+    return approvals, taken
+
+
+def _apply_allocation(queue, approvals, taken, now):
+    # Books: one UPDATE, each row conditional on still having enough copies.
+    enough = Q()
+    for book_id, count in taken.items():
+        enough |= Q(pk=book_id, quantity__gte=count)
+    delta = Case(*[When(pk=book_id, then=Value(count)) for book_id, count in taken.items()], output_field=IntegerField())
+    still_available = Case(
+        *[When(pk=book_id, quantity__gt=count, then=Value(True)) for book_id, count in taken.items()],
+        default=Value(False), output_field=BooleanField(),
+    )
+    if Kitob.objects.filter(enough).update(quantity=F('quantity') - delta, is_available=still_available, u_at=now) != len(taken):
+        raise AllocationConflict()
+
+    # Reservations: one UPDATE for the approvals, conditional on still pending...
+    approved_ids = [reservation.pk for reservation in approvals]
+    moved = Reservation.objects.filter(pk__in=approved_ids, status='pending').update(
+        status='approved', place=None, approved_at=now, u_at=now
+    )
+    if moved != len(approved_ids):
+        raise AllocationConflict()
+
+    # ...and one bulk write renumbering whoever is still waiting.
+    approved_ids = set(approved_ids)
+    renumbered = []
+    places = Counter()
+    for reservation in queue:
+        if reservation.pk in approved_ids:
+            continue
+        places[reservation.book_id] += 1
+        if reservation.place != places[reservation.book_id]:
+            reservation.place = places[reservation.book_id]
+            renumbered.append(reservation)
+    Reservation.objects.bulk_update(renumbered, ['place'], batch_size=1000)
+
+
+def allocate(book_ids, now=None, attempts=3):
+    """
+    Approve waiting reservations for any number of books while copies are on
+    the shelf. Loads the stock, the queue with user ban state and the users'
+    active-loan counts in three queries, plans in memory, then writes one
+    UPDATE per table (plus one bulk renumbering of the queue). If a concurrent
+    request changes the stock or the queue in between, the transaction is
+    rolled back and the allocation is re-planned. Returns the approved ids.
+    """
+    book_ids = set(book_ids)
+    for _ in range(attempts):
+        stamp = now or timezone.now()
+        try:
+            with transaction.atomic():
+                stock = dict(Kitob.objects.filter(pk__in=book_ids, quantity__gt=0).values_list('pk', 'quantity'))
+                if not stock:
+                    return []
+                queue = list(
+                    Reservation.objects.filter(book_id__in=stock, status='pending', place__gt=0)
+                    .select_related('user')
+                    .only('id', 'book_id', 'place', 'user_id', 'user__ban_expires_at', 'user__max_allowed')
+                    .order_by('book_id', 'place')
+                )
+                if not queue:
+                    return []
+                active_loans = (
+                    Reservation.objects.filter(user_id__in={r.user_id for r in queue}, status__in=ACTIVE_STATUSES)
+                    .order_by().values('user_id').annotate(n=Count('id')).values_list('user_id', 'n')
+                )
+                approvals, taken = plan_allocation(stock, queue, active_loans)
+                if not approvals:
+                    return []
+                _apply_allocation(queue, approvals, taken, stamp)
+            transaction.on_commit(lambda: bump('kitob', 'stats'))
+            return [reservation.pk for reservation in approvals]
+        except AllocationConflict:
+            continue
+    return []
+
+
+def fill_queue(book_id):
+    """Approve waiting reservations for one book in queue order while copies are on the shelf."""
+    return allocate([book_id])
+
+
+@receiver(post_save, sender=Reservation)
+def reservation_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.status == 'pending':
+        enqueue(instance)
+
+
+@receiver(post_delete, sender=Reservation)
+def reservation_deleted(sender, instance, **kwargs):
+    """Keep the queue and stock consistent when a reservation row is deleted outright."""
+    if instance.status == 'pending' and instance.place:
+        close_queue_gap(instance.book_id, instance.place)
+    elif instance.status == 'approved':
+        change_stock(instance.book_id, 1)
+        transaction.on_commit(lambda: fill_queue(instance.book_id))
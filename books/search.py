@@ -0,0 +1,269 @@
+"""
+Full-text search over the book catalog.
+
+Every book has a KitobSearchDocument row holding its normalized name, author
+and tag names, and the text of its PDF once books/pdf.py has extracted it.
+At most CONTENT_LIMIT characters of that text are indexed, read a few pages
+at a time. On SQLite the documents are mirrored into an FTS5 table by
+triggers created in migration 0015; on PostgreSQL they are covered by a GIN
+index over a weighted tsvector. Other backends have no index and callers fall
+back to the plain LIKE search.
+
+Normalization folds case, Uzbek Cyrillic to Latin and the various apostrophe
+characters (o‘, oʻ, o') so that "Ўткир", "O‘tkir" and "otkir" all match.
+"""
+import re
+import unicodedata
+
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import Kitob, Author, Tag, KitobSearchDocument, KitobPage
+
+FTS_TABLE = 'books_kitob_fts'
+
+# Field weights used for ranking: a hit in the title outranks an author hit,
+# which outranks a tag hit, which outranks a hit inside the book.
+NAME_WEIGHT, AUTHORS_WEIGHT, TAGS_WEIGHT, CONTENT_WEIGHT = 10.0, 5.0, 2.0, 1.0
+# Characters of PDF text indexed per book, which bounds the row and the memory
+# used to build it.
+CONTENT_LIMIT = 500_000
+# Pages fetched per query while the content is built.
+PAGE_CHUNK_SIZE = 50
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'ё': 'yo', 'ж': 'j',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n',
+    'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f',
+    'х': 'x', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '', 'ь': '',
+    'ы': 'i', 'э': 'e', 'ю': 'yu', 'я': 'ya', 'ў': 'o', 'қ': 'q', 'ғ': 'g',
+    'ҳ': 'h',
+}
+CYRILLIC_VOWELS = set('аеёиоуэюяўъь')
+APOSTROPHES = "'`ʻʼ‘’´"
+_apostrophe_re = re.compile('[%s]' % re.escape(APOSTROPHES))
+_token_re = re.compile(r'\w+')
+
+
+def _transliterate(text):
+    out = []
+    previous = ''
+    for char in text:
+        if char == 'е':
+            # Word-initial or post-vowel "е" is written "ye" in Latin script.
+            out.append('ye' if not previous.isalpha() or previous in CYRILLIC_VOWELS else 'e')
+        else:
+            out.append(CYRILLIC_TO_LATIN.get(char, char))
+        previous = char
+    return ''.join(out)
+
+
+def normalize(text):
+    """Fold text to the lowercase, apostrophe-free Latin form stored in the index."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = _transliterate(text)
+    text = _apostrophe_re.sub('', text)
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return _token_re.findall(normalize(text))
+
+
+def index_available():
+    """Return True when the current database has a search index we can query."""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def index_books(book_ids):
+    """
+    (Re)build the search documents for the given books in a fixed number of
+    queries. The PDF text is left as it is (see ``index_content``).
+    """
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    names = dict(Kitob.objects.filter(pk__in=book_ids).values_list('pk', 'name'))
+    authors, tags = {}, {}
+    author_rows = Kitob.author.through.objects.filter(kitob_id__in=names).values_list('kitob_id', 'author__name')
+    for book_id, name in author_rows:
+        authors.setdefault(book_id, []).append(name)
+    tag_rows = Kitob.tags.through.objects.filter(kitob_id__in=names).values_list('kitob_id', 'tag__name')
+    for book_id, name in tag_rows:
+        tags.setdefault(book_id, []).append(name)
+
+    documents = [
+        KitobSearchDocument(
+            kitob_id=book_id,
+            name=normalize(name),
+            authors=normalize(' '.join(authors.get(book_id, []))),
+            tags=normalize(' '.join(tags.get(book_id, []))),
+        )
+        for book_id, name in names.items()
+    ]
+    KitobSearchDocument.objects.bulk_create(
+        documents,
+        update_conflicts=True,
+        unique_fields=['kitob'],
+        update_fields=['name', 'authors', 'tags'],
+    )
+
+
+def page_texts(book_id):
+    pages = KitobPage.objects.filter(kitob_id=book_id).order_by('number').values_list('text', flat=True)
+    return pages.iterator(chunk_size=PAGE_CHUNK_SIZE)
+
+
+def index_content(book_id, pages):
+    """
+    Store the normalized text of ``pages`` (an iterable of strings) as the
+    book's indexed content. ``pages`` is read only until CONTENT_LIMIT
+    characters are collected, so the rest of a long book is never fetched.
+    """
+    parts, size = [], 0
+    for text in pages:
+        # Trim first so that a huge page is not normalized in full.
+        text = normalize(text[:CONTENT_LIMIT - size])[:CONTENT_LIMIT - size]
+        if text:
+            parts.append(text)
+            size += len(text) + 1
+        if size >= CONTENT_LIMIT:
+            break
+    content = ' '.join(parts)
+    with transaction.atomic():
+        if not KitobSearchDocument.objects.filter(kitob_id=book_id).update(content=content):
+            index_books([book_id])
+            KitobSearchDocument.objects.filter(kitob_id=book_id).update(content=content)
+
+
+def _pg_vector(table):
+    return (
+        f"setweight(to_tsvector('simple', {table}.name), 'A')"
+        f" || setweight(to_tsvector('simple', {table}.authors), 'B')"
+        f" || setweight(to_tsvector('simple', {table}.tags), 'C')"
+        f" || setweight(to_tsvector('simple', {table}.content), 'D')"
+    )
+
+
+def search_queryset(queryset, query):
+    """
+    Narrow a Kitob ``queryset`` to the books matching every term of ``query``
+    as a prefix, joined against the index and annotated with ``search_rank``
+    (lower is better), so the database ranks, counts and pages every match.
+    None when the backend has no index and the caller should fall back to a
+    LIKE search.
+    """
+    if not index_available():
+        return None
+    terms = tokenize(query)
+    if not terms:
+        return queryset.none()
+    kitob = Kitob._meta.db_table
+    if connection.vendor == 'postgresql':
+        documents = KitobSearchDocument._meta.db_table
+        vector = _pg_vector(documents)
+        tsquery = ' & '.join('%s:*' % term for term in terms)
+        return queryset.extra(
+            select={'search_rank': f"-ts_rank({vector}, to_tsquery('simple', %s))"},
+            select_params=[tsquery],
+            tables=[documents],
+            where=[f'{documents}.kitob_id = {kitob}.id', f"{vector} @@ to_tsquery('simple', %s)"],
+            params=[tsquery],
+        )
+    return queryset.extra(
+        select={'search_rank': 'bm25(%s, %s, %s, %s, %s)' % (
+            FTS_TABLE, NAME_WEIGHT, AUTHORS_WEIGHT, TAGS_WEIGHT, CONTENT_WEIGHT)},
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = {kitob}.id', f'{FTS_TABLE} MATCH %s'],
+        params=[' AND '.join('"%s"*' % term for term in terms)],
+    )
+
+
+def search_ids(query, limit=None):
+    """
+    Return the ids of the books matching ``query``, best match first, or None
+    when the backend has no index.
+    """
+    ranked = search_queryset(Kitob.objects.all(), query)
+    if ranked is None:
+        return None
+    ids = ranked.order_by('search_rank', 'pk').values_list('pk', flat=True)
+    return list(ids[:limit] if limit else ids)
+
+
+def rebuild(batch_size=1000):
+    """Drop and regenerate every search document. Returns the number of books indexed."""
+    KitobSearchDocument.objects.all().delete()
+    total = 0
+    batch = []
+    for book_id in Kitob.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=batch_size):
+        batch.append(book_id)
+        if len(batch) >= batch_size:
+            index_books(batch)
+            total += len(batch)
+            batch = []
+    index_books(batch)
+    total += len(batch)
+    for book_id in KitobPage.objects.order_by().values_list('kitob_id', flat=True).distinct().iterator():
+        index_content(book_id, page_texts(book_id))
+    if connection.vendor == 'sqlite' and index_available():
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO %s(%s) VALUES ('optimize')" % (FTS_TABLE, FTS_TABLE))
+    return total
+
+
+# Keep the index in sync. Saves that only touch non-indexed columns (the
+# reservation code updates quantity/is_available constantly) are skipped.
+
+@receiver(post_save, sender=Kitob)
+def reindex_kitob(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and 'name' not in update_fields):
+        return
+    index_books([instance.pk])
+
+
+@receiver(m2m_changed, sender=Kitob.author.through)
+@receiver(m2m_changed, sender=Kitob.tags.through)
+def reindex_kitob_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # pk_set is not provided on clear, so remember the affected books.
+        instance._search_book_ids = list(instance.kitob_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_books([instance.pk])
+    elif action == 'post_clear':
+        index_books(getattr(instance, '_search_book_ids', []))
+    else:
+        index_books(pk_set or [])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Tag)
+def reindex_related_books(sender, instance, created, raw=False, **kwargs):
+    if created or raw:
+        return
+    index_books(instance.kitob_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Tag)
+def remember_related_books(sender, instance, **kwargs):
+    instance._search_book_ids = list(instance.kitob_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Tag)
+def reindex_after_delete(sender, instance, **kwargs):
+    index_books(getattr(instance, '_search_book_ids', []))
@@ -1,5 +1,7 @@
 from rest_framework import serializers
-from .models import Category, Tag, Kitob, Comment, Reservation, Journals, Rating, Bookmark, Author, subCategory
+from django.urls import reverse
+from .models import Category, Tag, Kitob, Comment, Reservation, Journals, Rating, Bookmark, Author, subCategory, UploadSession, ExportJob, ImportJob
+from common.images import SrcsetField
 from users.serializers import UserSerializer
 from users.models import User
 
@@ -20,6 +22,8 @@ class TagSerializer(serializers.ModelSerializer):
 
 class JournalsSerializer(serializers.ModelSerializer):
     """Serializer for the Journals model."""
+    img_srcset = SrcsetField(source='img')
+
     class Meta:
         model = Journals
         fields = '__all__'
@@ -56,6 +60,7 @@ class KitobSerializer(serializers.ModelSerializer):
     average_rating = serializers.SerializerMethodField(read_only=True)
     subcategory = subCategorySerializer(read_only=True)
     author = AuthorSerializer(many=True, read_only=True)
+    img_srcset = SrcsetField(source='img')
     # For write operations (create/update), accept the ID for the foreign key/many-to-many fields.
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=Category.objects.all(), source='category', write_only=True
@@ -71,14 +76,14 @@ class KitobSerializer(serializers.ModelSerializer):
         queryset=Author.objects.all(), source='author', write_only=True
     )
     def get_average_rating(self, obj):
-        """Calculate and return the average rating for the book."""
+        """Return the average rating kept on the book by the rating signals."""
         return obj.get_average_rating()
 
     class Meta:
         model = Kitob
         fields = (
             'id', 'name', 'description', 'author', 'isbn', 'rating', 'is_available','is_frequent', 
-            'quantity','img', 'c_at', 'u_at', 'published_date', 'pdf', 'audio', 'is_physical','pages',
+            'quantity','img', 'img_srcset', 'preview', 'c_at', 'u_at', 'published_date', 'pdf', 'audio', 'is_physical','pages',
             'category', 'tags','subcategory',  'ratings', 'average_rating','has_audio', 'has_pdf',  # Read-only nested fields
             'category_id', 'tag_ids', 'subcategory_id', 'author_ids'  # Write-only ID fields
         )
@@ -96,11 +101,58 @@ class KitobSerializer(serializers.ModelSerializer):
         if request and not request.user.is_authenticated:
             representation['audio'] = None
             representation['pdf'] = None
-            
+        else:
+            # Files are only reachable through the protected endpoint (books/api_media.py).
+            for kind in ('pdf', 'audio'):
+                if representation.get(kind):
+                    url = reverse('kitob-file', kwargs={'pk': instance.pk, 'kind': kind})
+                    representation[kind] = request.build_absolute_uri(url) if request else url
+
         return representation
 
 
 
+class KitobListSerializer(serializers.ModelSerializer):
+    """
+    Compact book representation for the catalog grid (KitobViewSet.list).
+    Ratings are not embedded (see /api/kitob/{id}/ratings/) and the client can
+    narrow the payload further with ?fields=id,name,img,average_rating.
+    Unknown names are ignored; if none of the names is known, every field
+    is returned.
+    """
+    author = AuthorSerializer(many=True, read_only=True)
+    category = CategorySerializer(read_only=True)
+    img_srcset = SrcsetField(source='img')
+    average_rating = serializers.SerializerMethodField()
+    has_audio = serializers.SerializerMethodField()
+    has_pdf = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Kitob
+        fields = (
+            'id', 'name', 'img', 'img_srcset', 'author', 'category', 'rating', 'rating_count', 'average_rating',
+            'is_available', 'is_physical', 'has_audio', 'has_pdf', 'published_date', 'c_at',
+        )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        requested = request.query_params.get('fields') if request else None
+        allowed = {name.strip() for name in requested.split(',')} & set(self.fields) if requested else None
+        if allowed:
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+    def get_average_rating(self, obj):
+        return obj.get_average_rating()
+
+    def get_has_audio(self, obj):
+        return bool(obj.audio)
+
+    def get_has_pdf(self, obj):
+        return bool(obj.pdf)
+
+
 class ReservationSerializer(serializers.ModelSerializer):
     """
     Serializer for the Reservation model.
@@ -110,6 +162,7 @@ class ReservationSerializer(serializers.ModelSerializer):
     book = serializers.StringRelatedField(read_only=True)
     author = serializers.SerializerMethodField()
     img = serializers.ImageField(source='book.img', read_only=True)
+    img_srcset = SrcsetField(source='book.img')
     first_name = serializers.CharField(source='user.first_name', read_only=True)
     last_name = serializers.CharField(source='user.last_name', read_only=True)
 
@@ -118,7 +171,7 @@ class ReservationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Reservation
-        fields = ('id', 'user', 'book', 'author', 'img', 'first_name', 'last_name', 'status', 
+        fields = ('id', 'user', 'book', 'author', 'img', 'img_srcset', 'first_name', 'last_name', 'status', 
                   'place', 'c_at', 'reserved_from', 'reserved_until', 'approved_at', 'returned_at')
                   
         # Make fields read-only if they should be set by the system, not the user directly.
@@ -131,6 +184,38 @@ class CommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = '__all__'
+
+    def validate(self, attrs):
+        view = self.context.get('view')
+        book_id = self.instance.book_id if self.instance else view and view.kwargs.get('kitob_pk')
+        for field in ('reply_to', 'parent'):
+            answered = attrs.get(field)
+            if answered is not None and str(answered.book_id) != str(book_id):
+                raise serializers.ValidationError({field: 'Must be a comment on the same book.'})
+            if self.instance and field in attrs and answered != getattr(self.instance, field):
+                raise serializers.ValidationError({field: 'A comment cannot be moved to another thread.'})
+        return attrs
+
+
+class CommentAuthorSerializer(serializers.ModelSerializer):
+    """The public part of a commenter's profile."""
+    img_srcset = SrcsetField(source='img')
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'first_name', 'last_name', 'img', 'img_srcset')
+
+
+class CommentThreadSerializer(serializers.ModelSerializer):
+    """
+    One comment of a thread (CommentViewSet.thread). The book is given once
+    for the whole response, and replies are nested by books/comments.py.
+    """
+    user = CommentAuthorSerializer(read_only=True)
+
+    class Meta:
+        model = Comment
+        fields = ('id', 'user', 'content', 'rating', 'reply_to', 'parent', 'root', 'c_at', 'u_at')
 class BookmarkSerializer(serializers.ModelSerializer):
     """Serializer for the Bookmark model."""
     user = UserSerializer(read_only=True)
@@ -140,3 +225,36 @@ class BookmarkSerializer(serializers.ModelSerializer):
         model = Bookmark
         fields = ('id', 'user', 'book', 'c_at')
         read_only_fields = ('c_at',)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Serializer for resumable upload sessions (see books/uploads.py)."""
+    book_id = serializers.PrimaryKeyRelatedField(queryset=Kitob.objects.all(), source='book')
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'book_id', 'kind', 'filename', 'size', 'sha256', 'received', 'status', 'c_at', 'u_at')
+        read_only_fields = ('received', 'status', 'c_at', 'u_at')
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    """Serializer for background exports (see books/exports.py)."""
+    download = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = ('id', 'kind', 'file_format', 'query', 'status', 'rows', 'download', 'c_at', 'u_at')
+
+    def get_download(self, obj):
+        if obj.status != 'done':
+            return None
+        url = reverse('export-job-file', kwargs={'pk': obj.pk})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    """Serializer for background catalog imports (see books/importer.py)."""
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'file_format', 'status', 'report', 'c_at', 'u_at')
@@ -0,0 +1,232 @@
+"""
+Statistics behind the profile and main-page endpoints.
+
+Site-wide counts are GlobalCounter rows. The signals below adjust them inside
+the transaction that created or deleted the row, so a rollback undoes both.
+Bulk writes bypass signals; ``reconcile()`` (run nightly and by the
+reconcile_stats command) recounts and fixes any drift.
+
+A user's totals are read in one query: a conditional aggregate over their
+reservations plus a subquery each for bookmarks and ratings. Date-range
+totals are summed from UserDailyStats, which ``refresh_rollup()`` keeps in
+step with the reservations whose ``u_at`` moved past the last run.
+"""
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.signals import post_save, post_delete, post_init
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    Kitob, Category, subCategory, Reservation, Bookmark, Rating,
+    GlobalCounter, RollupWatermark, UserDailyStats,
+)
+
+User = get_user_model()
+
+COUNTERS = {
+    'books': lambda: Kitob.objects.count(),
+    'active_users': lambda: User.objects.filter(is_active=True).count(),
+    'categories': lambda: Category.objects.count() + subCategory.objects.count(),
+}
+
+# Reservation counts shown on the profile, by current status (None = all).
+RESERVATION_STATUSES = {
+    'total_reservations': None,
+    'active_reservations': ('approved', 'given'),
+    'pending_reservations': ('pending',),
+    'returned_reservations': ('returned',),
+}
+
+ROLLUP = 'user_daily_stats'
+# Rows committed by a transaction that started before the last run can carry
+# an older u_at than the watermark; re-reading a short overlap catches them.
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+
+def adjust(name, delta):
+    """Shift a global counter by ``delta``."""
+    if not delta:
+        return
+    if not GlobalCounter.objects.filter(name=name).update(value=F('value') + delta):
+        # First use: seed from a real count, which already includes this change.
+        GlobalCounter.objects.get_or_create(name=name, defaults={'value': COUNTERS[name]()})
+
+
+def global_counts():
+    """Return {counter name: value}, seeding any counter that does not exist yet."""
+    values = dict(GlobalCounter.objects.filter(name__in=COUNTERS).values_list('name', 'value'))
+    for name in COUNTERS.keys() - values.keys():
+        values[name] = GlobalCounter.objects.get_or_create(name=name, defaults={'value': COUNTERS[name]()})[0].value
+    return values
+
+
+def reconcile(dry_run=False):
+    """Recount every global counter; return {name: (stored, actual)} for the ones that drifted."""
+    stored = dict(GlobalCounter.objects.values_list('name', 'value'))
+    drifted = {}
+    for name, count in COUNTERS.items():
+        actual = count()
+        if stored.get(name) != actual:
+            drifted[name] = (stored.get(name), actual)
+            if not dry_run:
+                GlobalCounter.objects.update_or_create(name=name, defaults={'value': actual})
+    return drifted
+
+
+def _count(queryset):
+    return Coalesce(
+        Subquery(queryset.order_by().values('user').annotate(n=Count('pk')).values('n')),
+        Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def user_counts(user_id, start=None, end=None):
+    """
+    Return the profile counts of one user, or None if the user does not exist.
+    With ``start``/``end`` (dates, inclusive) the reservation counts cover the
+    reservations created in that range and come from UserDailyStats.
+    """
+    annotations = {
+        'bookmarks': _count(Bookmark.objects.filter(user=OuterRef('pk'))),
+        'ratings': _count(Rating.objects.filter(user=OuterRef('pk'))),
+    }
+    if start or end:
+        in_range = Q()
+        if start:
+            in_range &= Q(daily_stats__day__gte=start)
+        if end:
+            in_range &= Q(daily_stats__day__lte=end)
+        for name in RESERVATION_STATUSES:
+            annotations[name] = Coalesce(Sum(f'daily_stats__{name}', filter=in_range), Value(0))
+    else:
+        for name, statuses in RESERVATION_STATUSES.items():
+            condition = Q(reservation__status__in=statuses) if statuses else Q(reservation__isnull=False)
+            annotations[name] = Count('reservation', filter=condition)
+    # Prefixed because 'bookmarks' and 'ratings' are also relation names on User.
+    row = User.objects.filter(pk=user_id).annotate(**{f'stat_{name}': value for name, value in annotations.items()})
+    row = row.values(*(f'stat_{name}' for name in annotations)).first()
+    return None if row is None else {name: row[f'stat_{name}'] for name in annotations}
+
+
+def refresh_user_days(pairs):
+    """Recompute the UserDailyStats rows of the given (user_id, day) pairs."""
+    pairs = set(pairs)
+    if not pairs:
+        return 0
+    # Skip users deleted since (their reservations went with them).
+    users = set(User.objects.filter(pk__in={user_id for user_id, _ in pairs}).values_list('pk', flat=True))
+    rows = {
+        (user_id, day): UserDailyStats(user_id=user_id, day=day, **{name: 0 for name in RESERVATION_STATUSES})
+        for user_id, day in pairs if user_id in users
+    }
+    if not rows:
+        return 0
+    counts = (
+        Reservation.objects
+        .filter(user_id__in=users, c_at__date__in={day for _, day in pairs})
+        .annotate(day=TruncDate('c_at'))
+        .values('user_id', 'day')
+        .annotate(**{
+            name: Count('pk', filter=Q(status__in=statuses) if statuses else Q())
+            for name, statuses in RESERVATION_STATUSES.items()
+        })
+        .order_by()
+    )
+    for row in counts:
+        stats = rows.get((row['user_id'], row['day']))
+        if stats is not None:
+            for name in RESERVATION_STATUSES:
+                setattr(stats, name, row[name])
+    UserDailyStats.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=['user', 'day'],
+        update_fields=list(RESERVATION_STATUSES),
+    )
+    return len(rows)
+
+
+def refresh_rollup(batch_size=1000):
+    """Bring UserDailyStats up to date with every reservation changed since the last run."""
+    mark = RollupWatermark.objects.filter(name=ROLLUP).values_list('last_u_at', flat=True).first()
+    changed = Reservation.objects.all()
+    if mark:
+        changed = changed.filter(u_at__gt=mark - WATERMARK_OVERLAP)
+    newest, refreshed, pairs = mark, 0, set()
+    rows = changed.annotate(day=TruncDate('c_at')).values_list('user_id', 'day', 'u_at').order_by()
+    for user_id, day, u_at in rows.iterator(chunk_size=batch_size):
+        pairs.add((user_id, day))
+        newest = max(newest, u_at) if newest else u_at
+        if len(pairs) >= batch_size:
+            refreshed += refresh_user_days(pairs)
+            pairs = set()
+    refreshed += refresh_user_days(pairs)
+    if newest and newest != mark:
+        RollupWatermark.objects.update_or_create(name=ROLLUP, defaults={'last_u_at': newest})
+    return refreshed
+
+
+def rebuild_rollup(batch_size=1000):
+    """Recompute UserDailyStats from scratch."""
+    UserDailyStats.objects.all().delete()
+    RollupWatermark.objects.filter(name=ROLLUP).delete()
+    return refresh_rollup(batch_size)
+
+
+@receiver(post_save, sender=Kitob, dispatch_uid='stats-kitob-save')
+def count_new_book(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        adjust('books', 1)
+
+
+@receiver(post_delete, sender=Kitob, dispatch_uid='stats-kitob-delete')
+def count_deleted_book(sender, instance, **kwargs):
+    adjust('books', -1)
+
+
+@receiver(post_save, sender=Category, dispatch_uid='stats-category-save')
+@receiver(post_save, sender=subCategory, dispatch_uid='stats-subcategory-save')
+def count_new_category(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        adjust('categories', 1)
+
+
+@receiver(post_delete, sender=Category, dispatch_uid='stats-category-delete')
+@receiver(post_delete, sender=subCategory, dispatch_uid='stats-subcategory-delete')
+def count_deleted_category(sender, instance, **kwargs):
+    adjust('categories', -1)
+
+
+@receiver(post_init, sender=User, dispatch_uid='stats-user-init')
+def remember_active_state(sender, instance, **kwargs):
+    # Read through __dict__ so a deferred is_active is not fetched on every load.
+    instance._stats_was_active = instance.__dict__.get('is_active')
+
+
+@receiver(post_save, sender=User, dispatch_uid='stats-user-save')
+def count_active_user(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    was_active = False if created else instance._stats_was_active
+    if was_active is not None:
+        adjust('active_users', int(instance.is_active) - int(was_active))
+    instance._stats_was_active = instance.is_active
+
+
+@receiver(post_delete, sender=User, dispatch_uid='stats-user-delete')
+def count_deleted_user(sender, instance, **kwargs):
+    if instance._stats_was_active:
+        adjust('active_users', -1)
+
+
+@receiver(post_delete, sender=Reservation, dispatch_uid='stats-reservation-delete')
+def refresh_deleted_reservation_day(sender, instance, **kwargs):
+    # A deleted row leaves no u_at behind for refresh_rollup to find.
+    pair = (instance.user_id, timezone.localdate(instance.c_at))
+    transaction.on_commit(lambda: refresh_user_days([pair]))
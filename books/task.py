@@ -1,63 +1,136 @@
-from .models import Reservation
-from django.utils import timezone
-from celery import shared_task
+import logging
+import time
+from contextlib import contextmanager
 from datetime import timedelta
-from users.task import send_notification
+
+from celery import shared_task
+from django.utils import timezone
+
+from users.notifications import create_notifications, DEDUP_WINDOW
+from .models import Reservation
+from . import reservations, stats, analytics, uploads, pdf, exports, importer
+
+logger = logging.getLogger(__name__)
+
+@contextmanager
+def timed_pass(report, name):
+    """Record the row count and wall time of one pass of the periodic job."""
+    entry = report[name] = {'rows': 0}
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['ms'] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info("check_reservation_status %s: %d rows in %.1f ms", name, entry['rows'], entry['ms'])
+
+
+def notify(rows, title, template, dedup_window=DEDUP_WINDOW):
+    """
+    Write one notification per (user_id, book name) row. By default a reminder
+    already sent today is skipped; passes whose rows are one-off status changes
+    pass ``dedup_window=None``, since the same text can belong to another loan.
+    """
+    items = ((user_id, title, template.format(book=book)) for user_id, book in rows)
+    return create_notifications(items, dedup_window=dedup_window)
+
 
 @shared_task
 def check_reservation_status():
     """
     Periodic task to check for overdue books, upcoming deadlines, and expired approvals.
+
+    Each pass is a set-based UPDATE (in batches) plus bulk notification
+    inserts, so the cost depends on the number of rows that change, not on
+    the number of active loans. Returns the row count and time of each pass.
     """
     now = timezone.now()
-    print(f"Running reservation status check at {now}")
-    # 1. Handle Overdue Books (Given / Not Returned)
-    # If deadline passed, status should be 'not_returned'
-    # Send notification is overdue
-    overdue_reservations = Reservation.objects.filter(
-        status='given', 
-        reserved_until__lt=now
-    )
-    for reservation in overdue_reservations:
-        reservation.status = 'not_returned'
-        reservation.save()
-        send_notification.delay(
-            reservation.user.id, 
-            f"Your book '{reservation.book.name}' is overdue. Please return it immediately.",
-            "Book Overdue"
-        )
+    report = {}
 
-    # 2. Warning Notification (1 day before deadline)
-    # Send warning if due date is within 24 hours from now
-    warning_buffer_start = now
-    warning_buffer_end = now + timedelta(days=1)
-    
-    warning_reservations = Reservation.objects.filter(
-        status='given',
-        reserved_until__gt=warning_buffer_start,
-        reserved_until__lt=warning_buffer_end
-    )
-    
-    for reservation in warning_reservations:
-        send_notification.delay(
-            reservation.user.id,
-            f"The book '{reservation.book.name}' is due tomorrow. Please return it on time.",
-            "Return Reminder"
-        )
-        
-    # 3. Handle Expired Approvals (Approved -> Cancelled/Deleted)
-    # If a user doesn't pick up the book within 24 hours of approval.
-    pickup_deadline = now - timedelta(hours=24)
-    expired_reservations = Reservation.objects.filter(
-        status='approved',
-        approved_at__lt=pickup_deadline,
-    )
-    
-    for reservation in expired_reservations:
-        send_notification.delay(
-            reservation.user.id,
-            f"Your reservation for '{reservation.book.name}' has been cancelled because you did not pick it up within 24 hours.",
-            "Reservation Cancelled"
+    # 1. Handle Overdue Books (Given -> Not Returned)
+    with timed_pass(report, 'overdue') as entry:
+        rows = reservations.mark_overdue(now)
+        notify(rows, "Book Overdue", "Your book '{book}' is overdue. Please return it immediately.",
+               dedup_window=None)
+        entry['rows'] = len(rows)
+
+    # 2. Warning Notification (due within the next 24 hours)
+    with timed_pass(report, 'due_soon') as entry:
+        rows = list(
+            Reservation.objects.filter(status='given', reserved_until__gt=now, reserved_until__lt=now + timedelta(days=1))
+            .values_list('user_id', 'book__name')
         )
-        # Deleting trigger post_delete, restores quantity
-        reservation.delete()
\ No newline at end of file
+        notify(rows, "Return Reminder", "The book '{book}' is due tomorrow. Please return it on time.")
+        entry['rows'] = len(rows)
+
+    # 3. Handle Expired Approvals (not picked up within 24 hours -> Cancelled)
+    with timed_pass(report, 'expired_approvals') as entry:
+        rows = reservations.expire_approvals(now - timedelta(hours=24), now)
+        notify(rows, "Reservation Cancelled",
+               "Your reservation for '{book}' has been cancelled because you did not pick it up within 24 hours.",
+               dedup_window=None)
+        entry['rows'] = len(rows)
+
+    return report
+
+
+@shared_task
+def refresh_stats_rollup():
+    """Fold reservations changed since the last run into the per-user daily stats."""
+    return stats.refresh_rollup()
+
+
+@shared_task
+def refresh_circulation_facts():
+    """Rebuild the circulation facts of every day touched since the last run."""
+    return analytics.refresh_facts()
+
+
+@shared_task
+def reconcile_stats_counters():
+    """Recount the global counters; logs and fixes any drift left by bulk writes."""
+    drifted = stats.reconcile()
+    for name, (stored, actual) in drifted.items():
+        logger.warning("Stats counter %s drifted: %s -> %s", name, stored, actual)
+    return drifted
+
+
+@shared_task
+def purge_upload_sessions():
+    """Drop resumable uploads abandoned for longer than CHUNKED_UPLOAD_TTL, with their partial files."""
+    return uploads.purge()
+
+
+@shared_task(soft_time_limit=20 * 60)
+def process_pdf(book_id, name):
+    """Extract page count, page text and preview of a book's PDF (routed to the media queue)."""
+    return pdf.process(book_id, name)
+
+
+@shared_task(soft_time_limit=20 * 60)
+def finish_upload(session_id):
+    """Hash a fully received chunked upload and attach it to its book (routed to the media queue)."""
+    return uploads.finish(session_id)
+
+
+@shared_task
+def run_export(job_id):
+    """Write the file of a background export (see books/exports.py)."""
+    return exports.run(job_id)
+
+
+@shared_task
+def purge_exports():
+    """Delete background exports older than EXPORT_TTL, with their files."""
+    return exports.purge()
+
+
+@shared_task
+def run_import(job_id):
+    """Import the file of a background catalog import (see books/importer.py)."""
+    return importer.run(job_id)
+
+
+@shared_task
+def purge_imports():
+    """Delete background imports older than IMPORT_TTL."""
+    return importer.purge()
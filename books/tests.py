@@ -1,3 +1,1176 @@
-from django.test import TestCase
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction, OperationalError
+from django.db.models import F
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from users.models import User, Notification
+from .models import (
+    Kitob, Reservation, Bookmark, Category, subCategory, RollupWatermark, UploadSession, KitobPage,
+    Author, ExportJob, Comment, Rating, Tag,
+)
+from .api_media import serve_public
+from . import reservations, stats, analytics, uploads, pdf, search, importer, exports
+from .task import check_reservation_status
+
+LOCAL_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'auth': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth'},
+}
+
+
+def make_book(quantity, **kwargs):
+    return Kitob.objects.create(name='Book', quantity=quantity, description='', isbn='1', is_frequent=False, **kwargs)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ReservationTransitionTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user{i}') for i in range(3)]
+
+    def test_new_reservation_is_approved_when_a_copy_is_free(self):
+        book = make_book(1)
+        reservation = Reservation.objects.create(user=self.users[0], book=book)
+        reservation.refresh_from_db()
+        book.refresh_from_db()
+        self.assertEqual(reservation.status, 'approved')
+        self.assertIsNone(reservation.place)
+        self.assertEqual(book.quantity, 0)
+        self.assertFalse(book.is_available)
+
+    def test_queue_is_served_in_order_after_return(self):
+        book = make_book(1)
+        first, second, third = (Reservation.objects.create(user=user, book=book) for user in self.users)
+        second.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual((second.status, second.place), ('pending', 1))
+        self.assertEqual((third.status, third.place), ('pending', 2))
+
+        reservations.give(first.pk)
+        reservations.return_book(first.pk)
+
+        second.refresh_from_db()
+        third.refresh_from_db()
+        book.refresh_from_db()
+        self.assertEqual(second.status, 'approved')
+        self.assertEqual((third.status, third.place), ('pending', 1))
+        self.assertEqual(book.quantity, 0)
+
+    def test_cancelling_an_approval_returns_the_copy(self):
+        book = make_book(1)
+        reservation = Reservation.objects.create(user=self.users[0], book=book)
+        reservations.cancel(reservation.pk)
+        reservation.refresh_from_db()
+        book.refresh_from_db()
+        self.assertEqual(reservation.status, 'cancelled')
+        self.assertEqual(book.quantity, 1)
+        self.assertTrue(book.is_available)
+
+    def test_invalid_transition_is_rejected(self):
+        book = make_book(1)
+        reservation = Reservation.objects.create(user=self.users[0], book=book)
+        with self.assertRaises(reservations.TransitionError):
+            reservations.return_book(reservation.pk)
+
+    def test_user_over_limit_is_skipped(self):
+        self.users[0].max_allowed = 0
+        self.users[0].save()
+        book = make_book(1)
+        reservation = Reservation.objects.create(user=self.users[0], book=book)
+        reservation.refresh_from_db()
+        self.assertEqual(reservation.status, 'pending')
+        with self.assertRaises(reservations.TransitionError):
+            reservations.approve(reservation.pk)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        self.first, self.second = make_book(1), make_book(1)
+        self.users = [User.objects.create(username=f'reader{i}') for i in range(2)]
+
+    def assertAggregates(self, book, count, total, rating):
+        book.refresh_from_db()
+        self.assertEqual((book.rating_count, book.rating_sum), (count, total))
+        if rating is None:
+            self.assertIsNone(book.rating)
+        else:
+            self.assertAlmostEqual(book.rating, rating)
+
+    def test_create_change_move_and_delete(self):
+        rating = Rating.objects.create(book=self.first, user=self.users[0], score=4)
+        other = Rating.objects.create(book=self.first, user=self.users[1], score=1)
+        self.assertAggregates(self.first, 2, 5, 2.5)
+
+        rating.score = 2
+        rating.save()
+        self.assertAggregates(self.first, 2, 3, 1.5)
+
+        # Reloaded, so the move is seen from a fresh instance.
+        rating = Rating.objects.get(pk=rating.pk)
+        rating.book = self.second
+        rating.save()
+        self.assertAggregates(self.first, 1, 1, 1.0)
+        self.assertAggregates(self.second, 1, 2, 2.0)
+
+        other.delete()
+        self.assertAggregates(self.first, 0, 0, None)
+        Rating.objects.get(pk=rating.pk).delete()
+        self.assertAggregates(self.second, 0, 0, None)
+
+    def test_reconcile_ratings_fixes_drift(self):
+        Rating.objects.create(book=self.first, user=self.users[0], score=5)
+        Rating.objects.create(book=self.first, user=self.users[1], score=3)
+        Kitob.objects.filter(pk=self.first.pk).update(rating_count=7, rating_sum=1, rating=0.5)
+        Kitob.objects.filter(pk=self.second.pk).update(rating_count=1, rating_sum=4, rating=4.0)
+
+        output = io.StringIO()
+        call_command('reconcile_ratings', '--dry-run', stdout=output)
+        self.assertIn('would fix 2', output.getvalue())
+        self.assertAggregates(self.first, 7, 1, 0.5)
+
+        output = io.StringIO()
+        call_command('reconcile_ratings', stdout=output)
+        self.assertIn('fixed 2', output.getvalue())
+        self.assertAggregates(self.first, 2, 8, 4.0)
+        self.assertAggregates(self.second, 0, 0, None)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class QueueAllocationTests(TestCase):
+    def test_allocation_uses_a_fixed_number_of_queries(self):
+        books = [make_book(0) for _ in range(3)]
+        users = [User.objects.create(username=f'reader{i}', max_allowed=2) for i in range(6)]
+        users[0].ban_expires_at = timezone.now() + timedelta(days=1)
+        users[0].save()
+        for book in books:
+            for user in users:
+                Reservation.objects.create(user=user, book=book)
+        Kitob.objects.update(quantity=2)
+
+        # stock, queue+users, loan counts, book UPDATE, reservation UPDATE,
+        # queue renumbering, plus the savepoint pair of the transaction.
+        with self.assertNumQueries(8):
+            approved = reservations.allocate([book.pk for book in books])
+
+        self.assertEqual(len(approved), 6)
+        self.assertEqual(Kitob.objects.filter(quantity=0).count(), 3)
+        self.assertFalse(Reservation.objects.filter(user=users[0]).exclude(status='pending').exists())
+        for user in users[1:]:
+            self.assertLessEqual(Reservation.objects.filter(user=user, status='approved').count(), 2)
+        places = Reservation.objects.filter(book=books[0], status='pending').order_by('place').values_list('place', flat=True)
+        self.assertEqual(list(places), [1, 2, 3, 4])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ReservationStatusTaskTests(TestCase):
+    def test_overdue_due_soon_and_expired_passes(self):
+        now = timezone.now()
+        users = [User.objects.create(username=f'reader{i}') for i in range(4)]
+        book = make_book(3)
+        overdue, due_soon, expired = (Reservation.objects.create(user=user, book=book) for user in users[:3])
+        waiting = Reservation.objects.create(user=users[3], book=book)
+        Reservation.objects.filter(pk=overdue.pk).update(status='given', reserved_until=now - timedelta(hours=1))
+        Reservation.objects.filter(pk=due_soon.pk).update(status='given', reserved_until=now + timedelta(hours=3))
+        Reservation.objects.filter(pk=expired.pk).update(approved_at=now - timedelta(hours=30))
+
+        report = check_reservation_status()
+
+        self.assertEqual({name: entry['rows'] for name, entry in report.items()},
+                         {'overdue': 1, 'due_soon': 1, 'expired_approvals': 1})
+        statuses = dict(Reservation.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[overdue.pk], 'not_returned')
+        self.assertEqual(statuses[due_soon.pk], 'given')
+        self.assertEqual(statuses[expired.pk], 'cancelled')
+        self.assertEqual(statuses[waiting.pk], 'approved')
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_status_changes_are_notified_for_every_loan(self):
+        user = User.objects.create(username='reader')
+        first, second = make_book(1), make_book(1)
+        for book in (first, second):
+            reservation = Reservation.objects.create(user=user, book=book)
+            Reservation.objects.filter(pk=reservation.pk).update(
+                status='given', reserved_until=timezone.now() - timedelta(hours=1))
+            check_reservation_status()
+        # Both books are named 'Book', so the two notices have the same text.
+        self.assertEqual(Notification.objects.filter(user=user, title='Book Overdue').count(), 2)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ConcurrentApprovalTests(TransactionTestCase):
+    """Many librarians approving at once must never hand out more copies than exist."""
+    copies = 3
+    requests = 12
+
+    def test_concurrent_approvals_never_oversell(self):
+        book = make_book(0)
+        users = [User.objects.create(username=f'reader{i}') for i in range(self.requests)]
+        pending = [Reservation.objects.create(user=user, book=book).pk for user in users]
+        Kitob.objects.filter(pk=book.pk).update(quantity=self.copies, is_available=True)
+
+        barrier = threading.Barrier(self.requests)
+        approved = []
+
+        def approve(reservation_id):
+            try:
+                barrier.wait()
+                for _ in range(500):
+                    try:
+                        reservations.approve(reservation_id)
+                        approved.append(reservation_id)
+                        return
+                    except reservations.TransitionError:
+                        return
+                    except OperationalError:
+                        # SQLite's shared-cache test database reports lock
+                        # contention instead of waiting; back off and retry.
+                        time.sleep(random.uniform(0.001, 0.02))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=approve, args=(pk,)) for pk in pending]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        book.refresh_from_db()
+        self.assertEqual(len(approved), self.copies)
+        self.assertEqual(Reservation.objects.filter(book=book, status='approved').count(), self.copies)
+        self.assertEqual(book.quantity, 0)
+        self.assertFalse(book.is_available)
+
+
+class QueryPlanTests(TestCase):
+    """Each hot query must be answered from an index, not a table scan."""
+
+    def assertUsesIndex(self, queryset, index_name):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Test tables are tiny; make the planner show what it would pick at scale.
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn(index_name, plan, msg=f"{queryset.query}\n{plan}")
+
+    def test_reservation_queries(self):
+        now = timezone.now()
+        cases = [
+            (Reservation.objects.filter(book_id__in=[1, 2], status='pending', place__gt=0).order_by('book_id', 'place'),
+             'reservation_pending_queue'),
+            (Reservation.objects.filter(book_id=1, status='pending', place__gt=3), 'reservation_pending_queue'),
+            (Reservation.objects.filter(user_id__in=[1, 2], status__in=reservations.ACTIVE_STATUSES),
+             'reservation_user_status'),
+            (Reservation.objects.filter(status='given', reserved_until__lt=now), 'reservation_status_until'),
+            (Reservation.objects.filter(status='approved', approved_at__lt=now), 'reservation_status_approved'),
+        ]
+        for queryset, index_name in cases:
+            with self.subTest(index_name):
+                self.assertUsesIndex(queryset, index_name)
+
+    def test_catalog_sorts(self):
+        visible = Kitob.objects.filter(visible=True)
+        for field, index_name in (
+            ('c_at', 'kitob_visible_c_at'),
+            ('rating', 'kitob_visible_rating'),
+            ('name', 'kitob_visible_name'),
+            ('published_date', 'kitob_visible_published'),
+        ):
+            with self.subTest(field):
+                # The same ordering KeysetCursorMixin applies.
+                self.assertUsesIndex(visible.order_by(F(field).desc(nulls_last=True), F('id').desc()), index_name)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class KitobQueryCountTests(TestCase):
+    """The catalog endpoints take the same number of queries however many books, authors, tags and ratings there are."""
+
+    def make_books(self, count):
+        category = Category.objects.create(name='Fiction')
+        subcategory = subCategory.objects.create(name='Novels', category=category)
+        users = [User.objects.create(username=f'reader{i}') for i in range(3)]
+        books = []
+        for i in range(count):
+            book = make_book(1, category=category, subcategory=subcategory)
+            book.author.add(*(Author.objects.create(name=f'Author {i}.{j}') for j in range(3)))
+            book.tags.add(*(Tag.objects.create(name=f'Tag {i}.{j}') for j in range(3)))
+            for user in users:
+                Rating.objects.create(book=book, user=user, score=4)
+            books.append(book)
+        return books
+
+    def get(self, url):
+        caches['default'].clear()
+        response = APIClient().get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def check_queries(self, count):
+        books = self.make_books(count)
+        # COUNT, the page of books with their categories, the authors.
+        with self.assertNumQueries(3):
+            response = self.get('/api/kitob/')
+        self.assertEqual(len(response.data['results']), count)
+        # The book with category and subcategory, authors, tags, ratings with their users.
+        with self.assertNumQueries(4):
+            response = self.get(f'/api/kitob/{books[-1].pk}/')
+        self.assertEqual((len(response.data['author']), len(response.data['ratings'])), (3, 3))
+
+    def test_one_book(self):
+        self.check_queries(1)
+
+    def test_many_books(self):
+        self.check_queries(8)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.category = Category.objects.create(name='Fiction')
+        self.book = make_book(1, category=self.category)
+        Kitob.objects.filter(pk=self.book.pk).update(pdf='book_pdfs/novel.pdf')
+        self.url = f'/api/kitob/{self.book.pk}/'
+        self.client = APIClient()
+
+    def test_hit_is_served_without_queries(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_saves_bump_the_namespace(self):
+        self.assertEqual(self.client.get(self.url).data['name'], 'Book')
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['name'], 'Fiction')
+
+        self.book.name = 'Renamed'
+        self.book.save()
+        self.assertEqual(self.client.get(self.url).data['name'], 'Renamed')
+
+        self.category.name = 'Poetry'
+        self.category.save()
+        self.assertEqual(self.client.get(self.url).data['category']['name'], 'Poetry')
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['name'], 'Poetry')
+
+    def test_matching_etag_gets_304(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.book.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_anonymous_and_authenticated_callers_do_not_share_entries(self):
+        member = APIClient()
+        member.force_authenticate(User.objects.create(username='student', role='student'))
+        anonymous = self.client.get(self.url)
+        authenticated = member.get(self.url)
+        self.assertIsNone(anonymous.data['pdf'])
+        self.assertTrue(authenticated.data['pdf'].endswith(f'/api/kitob/{self.book.pk}/file/pdf/'))
+        self.assertNotEqual(anonymous['ETag'], authenticated['ETag'])
+        self.assertEqual(authenticated['Cache-Control'].split(',')[0], 'private')
+        # Both entries are cached now; each caller still gets its own.
+        self.assertIsNone(self.client.get(self.url).data['pdf'])
+        self.assertIsNotNone(member.get(self.url).data['pdf'])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CatalogPayloadTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.book = make_book(1)
+        self.client = APIClient()
+
+    def test_fields_narrow_the_list(self):
+        for fields, expected in (
+            ('id,name', {'id', 'name'}),
+            (' id , name ,bogus', {'id', 'name'}),
+        ):
+            with self.subTest(fields=fields):
+                results = self.client.get('/api/kitob/', {'fields': fields}).data['results']
+                self.assertEqual(set(results[0]), expected)
+        # Nothing known to narrow to: the full representation.
+        full = set(self.client.get('/api/kitob/').data['results'][0])
+        self.assertEqual(set(self.client.get('/api/kitob/', {'fields': 'bogus'}).data['results'][0]), full)
+        self.assertIn('average_rating', full)
+
+    def test_ratings_are_paginated_and_cached(self):
+        users = [User.objects.create(username=f'reader{i}') for i in range(3)]
+        ratings = [Rating.objects.create(book=self.book, user=user, score=i + 1) for i, user in enumerate(users)]
+        url = f'/api/kitob/{self.book.pk}/ratings/'
+
+        first = self.client.get(url, {'page_size': 2})
+        self.assertEqual(first.data['count'], 3)
+        self.assertEqual([rating['id'] for rating in first.data['results']], [ratings[2].pk, ratings[1].pk])
+        second = self.client.get(first.data['next'])
+        self.assertEqual([rating['id'] for rating in second.data['results']], [ratings[0].pk])
+
+        with self.assertNumQueries(0):
+            again = self.client.get(url, {'page_size': 2})
+        self.assertEqual(again.data, first.data)
+        # A new rating bumps the cache.
+        Rating.objects.create(book=self.book, user=User.objects.create(username='late'), score=5)
+        self.assertEqual(self.client.get(url, {'page_size': 2}).data['count'], 4)
+        self.assertEqual(self.client.get('/api/kitob/0/ratings/').status_code, 404)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        # Ties on both nullable keys, broken by id.
+        values = [(None, None), (3.0, '2001-01-01'), (None, '2003-01-01'), (3.0, None), (5.0, '2001-01-01')]
+        self.books = []
+        for rating, published in values:
+            book = make_book(1)
+            Kitob.objects.filter(pk=book.pk).update(rating=rating, published_date=published)
+            self.books.append(book.pk)
+        self.client = APIClient()
+
+    def walk(self, params):
+        """Follow next links to the end and previous links back; return the pages seen going forward."""
+        response = self.client.get('/api/kitob/', {**params, 'cursor': '', 'page_size': 2})
+        self.assertIsNone(response.data['previous'])
+        pages = [[book['id'] for book in response.data['results']]]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, 200)
+            pages.append([book['id'] for book in response.data['results']])
+        back = [pages[-1]]
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            back.insert(0, [book['id'] for book in response.data['results']])
+        self.assertEqual(back, pages)
+        return pages
+
+    def test_pages_follow_the_default_order_both_ways(self):
+        pages = self.walk({})
+        self.assertEqual(pages, [self.books[:-3:-1], self.books[2:0:-1], self.books[:1]])
+        self.assertNotIn('count', self.client.get('/api/kitob/', {'cursor': ''}).data)
+
+    def test_nullable_keys_sort_last_with_ties_broken_by_id(self):
+        b = self.books
+        self.assertEqual(sum(self.walk({'sort': 'rating-high'}), []), [b[4], b[3], b[1], b[2], b[0]])
+        self.assertEqual(sum(self.walk({'sort': 'rating-low'}), []), [b[1], b[3], b[4], b[0], b[2]])
+        self.assertEqual(sum(self.walk({'sort': 'published-date-high'}), []), [b[2], b[4], b[1], b[3], b[0]])
+        self.assertEqual(sum(self.walk({'sort': 'published-date-low'}), []), [b[1], b[4], b[2], b[0], b[3]])
+
+    def test_bad_cursors_are_not_found(self):
+        first = self.client.get('/api/kitob/', {'cursor': '', 'page_size': 2}).data['next']
+        token = first.split('cursor=')[1].split('&')[0]
+        for cursor in ('garbage', token[:-4], token + 'AAAA'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/api/kitob/', {'cursor': cursor}).status_code, 404)
+        # A cursor issued for another ordering is refused too.
+        self.assertEqual(self.client.get('/api/kitob/', {'cursor': token, 'sort': 'rating-high'}).status_code, 404)
+
+    def test_pages_are_read_without_count(self):
+        next_url = self.client.get('/api/kitob/', {'cursor': '', 'page_size': 2}).data['next']
+        caches['default'].clear()
+        # The page of books and the prefetch of their authors.
+        with self.assertNumQueries(2), CaptureQueriesContext(connection) as queries:
+            self.client.get(next_url)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql'].upper()])
+
+    def test_ranked_search_is_paged_by_number(self):
+        if not search.index_available():
+            self.skipTest('needs the full-text index')
+        names = ['Sarob', 'Sarob va Sarob', 'Boshqa Sarob kitob', 'Sarob haqida']
+        for pk, name in zip(self.books, names):
+            Kitob.objects.filter(pk=pk).update(name=name)
+        search.index_books(self.books)
+        ranked = [book['id'] for book in self.client.get('/api/kitob/', {'search': 'sarob'}).data['results']]
+
+        response = self.client.get('/api/kitob/', {'search': 'sarob', 'cursor': '', 'page_size': 2})
+        self.assertEqual(response.data['count'], 4)
+        paged = [book['id'] for book in response.data['results']]
+        paged += [book['id'] for book in self.client.get(response.data['next']).data['results']]
+        self.assertEqual(paged, ranked)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CatalogSearchTests(TestCase):
+    def test_matches_are_ranked_and_counted_by_the_database(self):
+        if not search.index_available():
+            self.skipTest('needs the full-text index')
+        by_author = make_book(1)
+        by_author.author.add(Author.objects.create(name='Sarob Qahhor'))
+        by_name = make_book(1)
+        Kitob.objects.filter(pk=by_name.pk).update(name='Sarob')
+        others = Kitob.objects.bulk_create(
+            [Kitob(name=f'Sarob {i}', quantity=1, description='', isbn='1', is_frequent=False) for i in range(1100)]
+        )
+        search.index_books([by_name.pk] + [book.pk for book in others])
+
+        response = APIClient().get('/api/kitob/', {'search': 'sarob', 'page_size': 50})
+        self.assertEqual(response.status_code, 200)
+        # Every match is counted; nothing is cut off at a fixed number of ids.
+        self.assertEqual(response.data['count'], 1102)
+        self.assertEqual(response.data['results'][0]['id'], by_name.pk)
+        self.assertEqual(search.search_ids('sarob qahhor'), [by_author.pk])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class StatsTests(TestCase):
+    def test_global_counters_follow_signals(self):
+        start = stats.global_counts()
+        book = make_book(1)
+        category = Category.objects.create(name='Fiction')
+        subCategory.objects.create(name='Novels', category=category)
+        user = User.objects.create(username='reader')
+        self.assertEqual(stats.global_counts(), {
+            'books': start['books'] + 1,
+            'active_users': start['active_users'] + 1,
+            'categories': start['categories'] + 2,
+        })
+
+        user.is_active = False
+        user.save()
+        category.delete()  # cascades to the subcategory
+        book.delete()
+        self.assertEqual(stats.global_counts(), start)
+        self.assertEqual(stats.reconcile(), {})
+
+    def test_profile_counts_in_one_query(self):
+        user = User.objects.create(username='reader')
+        books = [make_book(1) for _ in range(3)]
+        for book in books:
+            Reservation.objects.create(user=user, book=book)
+        Reservation.objects.filter(book=books[0]).update(status='returned')
+        Bookmark.objects.create(user=user, book=books[0])
+
+        with self.assertNumQueries(1):
+            counts = stats.user_counts(user.pk)
+        self.assertEqual(counts, {
+            'bookmarks': 1, 'ratings': 0, 'total_reservations': 3,
+            'active_reservations': 2, 'pending_reservations': 0, 'returned_reservations': 1,
+        })
+        self.assertIsNone(stats.user_counts(999999))
+
+    def test_date_range_counts_come_from_the_rollup(self):
+        user = User.objects.create(username='reader')
+        today = timezone.localdate()
+        old, recent, deleted = (Reservation.objects.create(user=user, book=make_book(1)) for _ in range(3))
+        Reservation.objects.filter(pk=old.pk).update(c_at=timezone.now() - timedelta(days=10))
+        stats.refresh_rollup()
+
+        counts = stats.user_counts(user.pk, start=today - timedelta(days=1), end=today)
+        self.assertEqual(counts['total_reservations'], 2)
+
+        Reservation.objects.filter(pk=recent.pk).update(status='returned', u_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            Reservation.objects.get(pk=deleted.pk).delete()
+        stats.refresh_rollup()
+        counts = stats.user_counts(user.pk, start=today - timedelta(days=1), end=today)
+        self.assertEqual((counts['total_reservations'], counts['returned_reservations']), (1, 1))
+        self.assertEqual(stats.user_counts(user.pk, end=today - timedelta(days=5))['total_reservations'], 1)
+
+    def test_malformed_dates_are_refused(self):
+        user = User.objects.create(username='reader')
+        url = '/api/user-profile-stats/'
+        for params in ({'start_date': '2024/01/01'}, {'end_date': 'yesterday'}, {'start_date': '2024-02-30'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(url, {'user_id': user.pk, **params}).status_code, 400)
+        response = self.client.get(url, {'user_id': user.pk, 'start_date': '2024-01-01', 'end_date': ''})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CirculationAnalyticsTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Fiction')
+        self.book = make_book(2, category=self.category, read_time=7)
+        self.users = [User.objects.create(username=f'reader{i}') for i in range(2)]
+        self.day = timezone.now() - timedelta(days=20)
+
+    def lend(self, user, returned_after=None):
+        reservation = Reservation.objects.create(user=user, book=self.book)
+        Reservation.objects.filter(pk=reservation.pk).update(c_at=self.day - timedelta(hours=2), approved_at=self.day)
+        reservations.give(reservation.pk, now=self.day)
+        if returned_after is not None:
+            reservations.return_book(reservation.pk, now=self.day + returned_after)
+        return reservation
+
+    def test_facts_answer_range_queries(self):
+        self.lend(self.users[0], returned_after=timedelta(days=4))
+        self.lend(self.users[1])  # never returned, due 7 days later
+        analytics.refresh_facts()
+
+        start = timezone.localdate(self.day)
+        totals, rows = analytics.circulation(start, start + timedelta(days=10))
+        self.assertEqual((totals['loans'], totals['returns'], totals['due'], totals['overdue']), (2, 1, 2, 1))
+        self.assertEqual(totals['avg_loan_days'], 4)
+        self.assertEqual(totals['overdue_rate'], 0.5)
+        self.assertEqual(totals['avg_wait_hours'], 2)
+        self.assertEqual([row['day'] for row in rows], [start, start + timedelta(days=4), start + timedelta(days=7)])
+
+        _, by_category = analytics.circulation(start, start, 'category')
+        self.assertEqual(by_category[0]['category__name'], 'Fiction')
+        self.assertEqual(by_category[0]['loans'], 2)
+
+    def test_changes_are_folded_in_incrementally(self):
+        reservation = self.lend(self.users[0])
+        analytics.refresh_facts()
+        # Past the overlap window nothing is re-read.
+        Reservation.objects.update(u_at=timezone.now() - timedelta(hours=2))
+        RollupWatermark.objects.update(last_u_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(analytics.refresh_facts(), 0)
+
+        reservations.return_book(reservation.pk, now=self.day + timedelta(days=2))
+        # The transition ran with a back-dated now; a real one stamps the current time.
+        Reservation.objects.filter(pk=reservation.pk).update(u_at=timezone.now())
+        analytics.refresh_facts()
+        totals, _ = analytics.circulation(timezone.localdate(self.day), timezone.localdate())
+        self.assertEqual((totals['returns'], totals['overdue']), (1, 0))
+
+    def test_endpoint_is_for_librarians(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        self.assertEqual(client.get('/api/analytics/circulation/').status_code, 403)
+
+        librarian = User.objects.create(username='librarian', role='librarian')
+        client.force_authenticate(librarian)
+        response = client.get('/api/analytics/circulation/', {'group_by': 'book'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['group_by'], 'book')
+        self.assertEqual(client.get('/api/analytics/circulation/', {'group_by': 'shelf'}).status_code, 400)
+        for group_by in ('book', 'category'):
+            for limit in (-1, 0):
+                response = client.get('/api/analytics/circulation/', {'group_by': group_by, 'limit': limit})
+                self.assertEqual(response.status_code, 400)
+        response = client.get('/api/analytics/circulation/', {'group_by': 'book', 'limit': 10 ** 9})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ProtectedMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root, MEDIA_ACCEL=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.book = make_book(1)
+        self.book.audio.save('chapter.mp3', ContentFile(bytes(range(256)) * 4))
+        self.url = f'/api/kitob/{self.book.pk}/file/audio/'
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='reader'))
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_anonymous_users_are_refused(self):
+        self.assertEqual(APIClient().get(self.url).status_code, 401)
+
+    def test_serializer_points_at_the_endpoint(self):
+        response = self.client.get(f'/api/kitob/{self.book.pk}/')
+        self.assertTrue(response.data['audio'].endswith(self.url))
+
+    def test_full_and_ranged_downloads(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(len(self.body(response)), 1024)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=256-511')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 256-511/1024')
+        self.assertEqual(self.body(response), bytes(range(256)))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(response['Content-Range'], 'bytes 1014-1023/1024')
+        self.assertEqual(len(self.body(response)), 10)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_conditional_requests(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A stale If-Range gets the whole file instead of the range.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_hidden_books_are_served_to_staff_only(self):
+        Kitob.objects.filter(pk=self.book.pk).update(visible=False)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_authenticate(User.objects.create(username='librarian', role='librarian'))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_media_url_does_not_serve_protected_files(self):
+        request = RequestFactory().get('/media/')
+        for path in (self.book.audio.name, f'./{self.book.audio.name}', f'book_images/../{self.book.audio.name}'):
+            with self.assertRaises(Http404):
+                serve_public(request, path, document_root=self.media_root)
+
+    def test_front_end_server_hand_off(self):
+        with self.settings(MEDIA_ACCEL='nginx', MEDIA_ACCEL_PREFIX='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.book.audio.name}')
+        self.assertEqual(response.content, b'')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = override_settings(MEDIA_ROOT=os.path.join(root, 'media'), CHUNKED_UPLOAD_DIR=os.path.join(root, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.book = make_book(1)
+        self.data = os.urandom(1000)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='librarian', role='librarian'))
+
+    def open_session(self, sha256=None):
+        response = self.client.post('/api/uploads/', {
+            'book_id': self.book.pk, 'kind': 'audio', 'filename': 'part one.mp3', 'size': len(self.data),
+            'sha256': sha256 or hashlib.sha256(self.data).hexdigest(),
+        })
+        self.assertEqual(response.status_code, 201)
+        return f"/api/uploads/{response.data['id']}/"
+
+    def put(self, url, first, last):
+        return self.client.generic('PUT', url, self.data[first:last + 1], content_type='application/octet-stream',
+                                   HTTP_CONTENT_RANGE=f'bytes {first}-{last}/{len(self.data)}')
+
+    def put_last(self, url, first, last):
+        """Send the final chunk, then run the verification it queues."""
+        with mock.patch('books.task.finish_upload.delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            response = self.put(url, first, last)
+        self.assertEqual((response.status_code, response.data['status']), (202, 'verifying'))
+        delay.assert_called_once_with(str(response.data['id']))
+        uploads.finish(response.data['id'])
+        return self.client.get(url)
+
+    def test_chunks_are_resumed_and_attached(self):
+        url = self.open_session()
+        self.assertEqual(self.put(url, 0, 399).data['received'], 400)
+        # A repeated or skipped chunk is refused with the offset to resume from.
+        response = self.put(url, 0, 399)
+        self.assertEqual((response.status_code, response.data['received']), (409, 400))
+        self.assertEqual(self.put(url, 800, 999).status_code, 409)
+        self.assertEqual(self.client.get(url).data['received'], 400)
+
+        response = self.put_last(url, 400, 999)
+        self.assertEqual(response.data['status'], 'complete')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.audio.name, 'book_audios/part_one.mp3')
+        with self.book.audio.open('rb') as audio:
+            self.assertEqual(audio.read(), self.data)
+        self.assertEqual(os.listdir(uploads.upload_dir()), [])
+
+    def test_checksum_mismatch_fails_the_upload(self):
+        url = self.open_session(sha256='0' * 64)
+        self.assertEqual(self.put_last(url, 0, 999).data['status'], 'failed')
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.audio)
+
+    def test_empty_chunk_is_refused(self):
+        url = self.open_session()
+        response = self.client.put(url, HTTP_CONTENT_RANGE=f'bytes 0-99/{len(self.data)}')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).data['received'], 0)
+
+    def test_purge_removes_abandoned_sessions(self):
+        self.open_session()
+        self.put(self.open_session(), 0, 99)
+        self.assertEqual(uploads.purge(), 0)
+        self.assertEqual(uploads.purge(now=timezone.now() + timedelta(days=2)), 2)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(uploads.upload_dir()), [])
+
+    def test_only_book_editors_upload(self):
+        client = APIClient()
+        for username, role in (('student', 'student'), ('admin', 'admin')):
+            client.force_authenticate(User.objects.create(username=username, role=role))
+            self.assertEqual(client.post('/api/uploads/', {}).status_code, 403)
+            self.assertEqual(client.get(self.open_session()).status_code, 403)
+
+
+def text_pdf(pages):
+    """A minimal PDF with one line of Helvetica text per page."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in pages:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'
+    out, offsets = b'%PDF-1.4\n', []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n{body}\nendobj\n'.encode()
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return out
+
+
+@skipUnless(pdf.pypdf, 'pypdf is not installed')
+@override_settings(CACHES=LOCAL_CACHE)
+class PdfProcessingTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_upload_queues_processing_and_text_is_searchable(self):
+        book = make_book(1)
+        with mock.patch.object(pdf, 'queue') as queue:
+            with self.captureOnCommitCallbacks(execute=True):
+                book.pdf.save('novel.pdf', ContentFile(text_pdf(['Chapter one', 'Mirzo Ulugbek observatory', 'The end'])))
+        queue.assert_called_once_with(book.pk, book.pdf.name)
+
+        with mock.patch.object(pdf, 'PAGE_BATCH', 2):
+            self.assertEqual(pdf.process(book.pk, book.pdf.name), 3)
+        book.refresh_from_db()
+        self.assertEqual(book.pages, 3)
+        self.assertEqual(list(KitobPage.objects.filter(kitob=book).values_list('number', 'text')),
+                         [(1, 'Chapter one'), (2, 'Mirzo Ulugbek observatory'), (3, 'The end')])
+        if search.index_available():
+            self.assertEqual(search.search_ids('observatory'), [book.pk])
+            # Renaming the book keeps its indexed content.
+            book.name = 'Renamed'
+            book.save()
+            self.assertEqual(search.search_ids('ulugbek'), [book.pk])
+
+    def test_scanned_pdf_gets_a_preview(self):
+        buffer = io.BytesIO()
+        pages = [Image.new('RGB', (1200, 1600), color) for color in ('white', 'gray')]
+        pages[0].save(buffer, 'PDF', save_all=True, append_images=pages[1:])
+        book = make_book(1)
+        with mock.patch.object(pdf, 'queue'):
+            book.pdf.save('scan.pdf', ContentFile(buffer.getvalue()))
+
+        self.assertEqual(pdf.process(book.pk, book.pdf.name), 2)
+        book.refresh_from_db()
+        with book.preview.open('rb') as preview:
+            self.assertEqual(Image.open(preview).size, (640, 853))
+
+    def test_stale_runs_do_nothing(self):
+        book = make_book(1)
+        self.assertIsNone(pdf.process(book.pk, 'book_pdfs/gone.pdf'))
+
+    def test_indexed_content_stops_at_the_limit(self):
+        book = make_book(1)
+        read = []
+
+        def pages():
+            for number in range(100):
+                read.append(number)
+                yield 'word ' * 20
+
+        with mock.patch.object(search, 'CONTENT_LIMIT', 250):
+            search.index_content(book.pk, pages())
+        content = book.search_document.content
+        self.assertLessEqual(len(content), 250)
+        self.assertTrue(content.startswith('word word'))
+        self.assertEqual(len(read), 3)
+
+
+def marc_record(fields):
+    """Encode {tag: [(code, value), ...]} as one ISO 2709 record."""
+    directory, data = b'', b''
+    for tag, subfields in fields.items():
+        field = b'  ' + b''.join(b'\x1f' + code.encode() + value.encode() for code, value in subfields) + b'\x1e'
+        directory += f'{tag}{len(field):04d}{len(data):05d}'.encode()
+        data += field
+    base = 24 + len(directory) + 1
+    length = base + len(data) + 1
+    leader = f'{length:05d}nam a22{base:05d}   4500'.encode()
+    return leader + directory + b'\x1e' + data + b'\x1d'
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        self.fiction = Category.objects.create(name='Fiction')
+        self.author = Author.objects.create(name='Abdulla Qodiriy')
+        Kitob.objects.filter(pk=make_book(1).pk).update(isbn='978-0-00-000001-1')
+
+    def test_csv_upserts_lookups_and_links_books(self):
+        data = (
+            'name,isbn,authors,tags,category,subcategory,quantity\n'
+            'Otkan kunlar,9780000000028,abdulla  QODIRIY;Cholpon,classic|novel,fiction,Historical,3\n'
+            'Kecha va kunduz,,Cholpon,novel,Poetry,,0\n'
+            'Duplicate,978-0000000011,,,,,\n'
+            ',123,,,,,\n'
+            'Bad quantity,,,,,,many\n'
+        ).encode()
+        before = stats.global_counts()
+        with self.captureOnCommitCallbacks(execute=True):
+            report = importer.import_catalog(io.BytesIO(data), 'csv', batch_size=1)
+
+        self.assertEqual((report['read'], report['created'], report['duplicates'], report['rejected']), (5, 2, 1, 2))
+        self.assertEqual([r['record'] for r in report['rejects']], [4, 5])
+        self.assertEqual((report['authors'], report['tags'], report['categories'], report['subcategories']), (1, 2, 1, 1))
+        book = Kitob.objects.get(name='Otkan kunlar')
+        self.assertEqual(book.category, self.fiction)
+        self.assertEqual(book.subcategory.category, self.fiction)
+        self.assertEqual(sorted(book.author.values_list('name', flat=True)), ['Abdulla Qodiriy', 'Cholpon'])
+        self.assertEqual(Author.objects.filter(name='Cholpon').count(), 1)
+        self.assertFalse(Kitob.objects.get(name='Kecha va kunduz').is_available)
+        counts = stats.global_counts()
+        self.assertEqual(counts['books'], before['books'] + 2)
+        self.assertEqual(counts['categories'], before['categories'] + 2)
+        self.assertEqual(stats.reconcile(dry_run=True), {})
+        if search.index_available():
+            self.assertEqual(search.search_ids('cholpon kecha'), [Kitob.objects.get(name='Kecha va kunduz').pk])
+
+    def test_marc_records(self):
+        record = marc_record({
+            '020': [('a', '9780000000035 (hbk.)')],
+            '100': [('a', 'Navoiy, Alisher,')],
+            '245': [('a', 'Xamsa :'), ('b', 'besh doston /')],
+            '264': [('c', 'c2011.')],
+            '300': [('a', '712 p. ;')],
+            '650': [('a', 'Poetry.')],
+            '700': [('a', 'Cholpon.')],
+        })
+        report = importer.import_catalog(io.BytesIO(record * 2), 'marc', default_category='Poetry')
+        self.assertEqual((report['created'], report['duplicates']), (1, 1))
+        book = Kitob.objects.get(isbn='9780000000035')
+        self.assertEqual((book.name, book.pages, book.published_date.year), ('Xamsa : besh doston', 712, 2011))
+        self.assertEqual(sorted(book.author.values_list('name', flat=True)), ['Cholpon', 'Navoiy, Alisher'])
+        self.assertEqual(list(book.tags.values_list('name', flat=True)), ['Poetry'])
+
+    def test_malformed_marc_record_is_rejected_alone(self):
+        first = marc_record({'245': [('a', 'Sarob')]})
+        second = marc_record({'245': [('a', 'Qutlug qon')]})
+        # A directory entry whose length is not a number.
+        broken = marc_record({'245': [('a', 'Broken')]}).replace(b'245', b'245x', 1)
+        report = importer.import_catalog(io.BytesIO(first + broken + b'\n' + second), 'marc')
+        self.assertEqual((report['created'], report['rejected']), (2, 1))
+        self.assertEqual(report['rejects'][0]['record'], 2)
+        self.assertTrue(Kitob.objects.filter(name='Qutlug qon').exists())
+
+    def test_endpoint_is_admin_only_and_dry_run_keeps_nothing(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='librarian', role='librarian'))
+        upload = io.BytesIO(b'{"name": "Sarob", "authors": ["Abdulla Qahhor"]}\n')
+        upload.name = 'books.jsonl'
+        self.assertEqual(client.post('/api/import/catalog/', {'file': upload, 'format': 'jsonl'}).status_code, 403)
+
+        client.force_authenticate(User.objects.create(username='admin', role='admin'))
+        upload.seek(0)
+        response = client.post('/api/import/catalog/', {'file': upload, 'format': 'jsonl', 'dry_run': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 1)
+        self.assertFalse(Kitob.objects.filter(name='Sarob').exists())
+        self.assertFalse(Author.objects.filter(name='Abdulla Qahhor').exists())
+
+    def test_large_files_are_imported_in_the_background(self):
+        import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, import_dir, ignore_errors=True)
+        admin = User.objects.create(username='admin', role='admin')
+        client = APIClient()
+        client.force_authenticate(admin)
+        upload = io.BytesIO(b'{"name": "Sarob"}\n{"name": ""}\n')
+        upload.name = 'books.jsonl'
+        with override_settings(IMPORT_DIR=import_dir, IMPORT_INLINE_MAX_BYTES=10), \
+                mock.patch('books.task.run_import.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post('/api/import/catalog/', {'file': upload, 'format': 'jsonl', 'quantity': 3})
+            self.assertEqual(response.status_code, 202)
+            job_id = response.data['id']
+            delay.assert_called_once_with(job_id)
+            self.assertFalse(Kitob.objects.filter(name='Sarob').exists())
+
+            report = importer.run(job_id)
+            self.assertIsNone(importer.run(job_id))
+            self.assertFalse(os.listdir(import_dir))
+        self.assertEqual((report['created'], report['rejected']), (1, 1))
+        self.assertEqual(Kitob.objects.get(name='Sarob').quantity, 3)
+        self.assertTrue(Notification.objects.filter(user=admin, title='Import finished').exists())
+        response = client.get(f'/api/import/jobs/{job_id}/')
+        self.assertEqual((response.data['status'], response.data['report']['created']), ('done', 1))
+
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username='other', role='admin'))
+        self.assertEqual(other.get(f'/api/import/jobs/{job_id}/').status_code, 404)
+        self.assertEqual(importer.purge(now=timezone.now() + timedelta(days=8)), 1)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ExportTests(TestCase):
+    def setUp(self):
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir, ignore_errors=True)
+        settings_override = override_settings(EXPORT_DIR=export_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.fiction = Category.objects.create(name='Fiction')
+        self.book = make_book(2, category=self.fiction)
+        self.book.author.add(Author.objects.create(name='Cholpon'), Author.objects.create(name='Oybek'))
+        make_book(1)
+        self.reader = User.objects.create(username='reader', first_name='Aziz')
+        self.librarian = User.objects.create(username='librarian', role='librarian')
+        self.client = APIClient()
+        self.client.force_authenticate(self.librarian)
+
+    def test_csv_applies_the_catalog_filters_and_reimports(self):
+        self.client.force_authenticate(self.reader)
+        self.assertEqual(self.client.get('/api/export/kitob/').status_code, 403)
+        self.client.force_authenticate(self.librarian)
+
+        hidden = make_book(1, category=self.fiction, visible=False)
+        Kitob.objects.filter(pk=hidden.pk).update(name='=HYPERLINK("http://x")', isbn='2')
+        response = self.client.get(f'/api/export/kitob/?category={self.fiction.pk}&file_format=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment', response['Content-Disposition'])
+        data = b''.join(response.streaming_content)
+        rows = list(csv.DictReader(io.StringIO(data.decode('utf-8-sig'))))
+        # Hidden books are part of the audit export.
+        self.assertEqual([row['id'] for row in rows], [str(self.book.pk), str(hidden.pk)])
+        self.assertEqual(rows[0]['authors'], 'Cholpon; Oybek')
+        self.assertEqual(rows[0]['category'], 'Fiction')
+        self.assertEqual(rows[1]['name'], '\'=HYPERLINK("http://x")')
+
+        Kitob.objects.all().delete()
+        report = importer.import_catalog(io.BytesIO(data), 'csv')
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(sorted(Kitob.objects.get(isbn='1').author.values_list('name', flat=True)), ['Cholpon', 'Oybek'])
+
+    def test_reservation_history_as_jsonl_and_xlsx(self):
+        Reservation.objects.create(user=self.reader, book=self.book, status='returned')
+        Reservation.objects.create(user=self.reader, book=self.book, status='cancelled')
+
+        response = self.client.get('/api/export/reservations/?status=returned&file_format=jsonl')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual((record['username'], record['first_name'], record['status']), ('reader', 'Aziz', 'returned'))
+
+        response = self.client.get('/api/export/reservations/?file_format=xlsx')
+        self.assertEqual(response['Content-Type'], exports.CONTENT_TYPES['xlsx'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as workbook:
+            self.assertIsNone(workbook.testzip())
+            sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row>'), 3)
+        # Newest first, like the reservation list.
+        self.assertLess(sheet.index('>cancelled<'), sheet.index('>returned<'))
+
+        self.assertEqual(self.client.get('/api/export/reservations/?file_format=pdf').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/users/').status_code, 400)
+
+    def test_large_exports_are_written_in_the_background(self):
+        with override_settings(EXPORT_STREAM_MAX_ROWS=1), mock.patch('books.task.run_export.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get('/api/export/kitob/?file_format=jsonl&sort=name-low')
+        self.assertEqual(response.status_code, 202)
+        self.assertIsNone(response.data['download'])
+        job_id = response.data['id']
+        delay.assert_called_once_with(job_id)
+        self.assertEqual(ExportJob.objects.get(pk=job_id).query, 'sort=name-low')
+
+        self.assertEqual(exports.run(job_id), 2)
+        self.assertIsNone(exports.run(job_id))
+        self.assertTrue(Notification.objects.filter(user=self.librarian, title='Export ready').exists())
+        response = self.client.get(f'/api/export/jobs/{job_id}/')
+        self.assertEqual((response.data['status'], response.data['rows']), ('done', 2))
+        response = self.client.get(response.data['download'])
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 2)
+
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username='admin', role='admin'))
+        self.assertEqual(other.get(f'/api/export/jobs/{job_id}/file/').status_code, 404)
+
+        self.assertEqual(exports.purge(now=timezone.now() + timedelta(days=8)), 1)
+        self.assertFalse(os.listdir(exports.export_dir()))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CommentThreadTests(TestCase):
+    def setUp(self):
+        self.book = make_book(1)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='student', role='student'))
+        self.url = f'/api/kitob/{self.book.pk}/comments/'
+
+    def comment(self, content, **data):
+        response = self.client.post(self.url, {'content': content, **data})
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def test_replies_are_nested_under_their_thread_in_three_queries(self):
+        first = self.comment('First')
+        answer = self.comment('Answer', parent=first)
+        self.comment('Answer to the answer', parent=first, reply_to=answer)
+        second = self.comment('Second')
+        self.assertEqual(Comment.objects.get(content='Answer to the answer').root_id, first)
+        self.assertIsNone(Comment.objects.get(pk=second).root_id)
+
+        other = make_book(1)
+        stranger = Comment.objects.create(book=other, user=User.objects.get(username='student'), content='Elsewhere')
+        self.assertEqual(self.client.post(self.url, {'content': 'x', 'reply_to': stranger.pk}).status_code, 400)
+        response = self.client.patch(f'{self.url}{answer}/', {'parent': second})
+        self.assertEqual(response.status_code, 400)
+
+        guest = APIClient()
+        # book, comments page, replies
+        with self.assertNumQueries(3):
+            response = guest.get(f'{self.url}thread/?page_size=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['book'], self.book.pk)
+        self.assertEqual([c['content'] for c in response.data['results']], ['Second'])
+
+        response = guest.get(response.data['next'])
+        [thread] = response.data['results']
+        self.assertEqual(thread['content'], 'First')
+        self.assertNotIn('email', thread['user'])
+        [reply] = thread['replies']
+        self.assertEqual(reply['content'], 'Answer')
+        self.assertEqual([c['content'] for c in reply['replies']], ['Answer to the answer'])
+        self.assertIsNone(response.data['next'])
+
+    def test_threads_of_missing_and_hidden_books_are_not_found(self):
+        self.comment('First')
+        guest = APIClient()
+        self.assertEqual(guest.get(f'/api/kitob/{self.book.pk + 100}/comments/thread/').status_code, 404)
+
+        Kitob.objects.filter(pk=self.book.pk).update(visible=False)
+        self.assertEqual(guest.get(f'{self.url}thread/').status_code, 404)
+        self.assertEqual(self.client.get(f'{self.url}thread/').status_code, 404)
+        librarian = APIClient()
+        librarian.force_authenticate(User.objects.create(username='librarian', role='librarian'))
+        response = librarian.get(f'{self.url}thread/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['content'] for c in response.data['results']], ['First'])
 
-# Create your tests here.
@@ -0,0 +1,234 @@
+"""
+Resumable chunked uploads of book PDFs and audio.
+
+A librarian opens an UploadSession with the file's name, size and SHA-256,
+then PUTs the bytes in order, one chunk per request with a ``Content-Range``
+header. Each chunk is streamed from the request into
+``<CHUNKED_UPLOAD_DIR>/<session id>.part`` in small reads, so memory use does
+not depend on the chunk or file size. ``received`` only advances, with a
+conditional UPDATE, once a chunk is entirely on disk; after a dropped
+connection the client reads the session back and resumes from ``received``.
+
+When the last byte arrives the session turns ``verifying`` and
+``books.task.finish_upload`` is queued on the media queue, so the request
+that sent it never waits for a multi-gigabyte file to be re-read. The task
+hashes the file and, if it matches, moves it into storage and attaches it to
+the book; the client polls the session until it is ``complete`` or
+``failed``. The move is a rename when CHUNKED_UPLOAD_DIR is on the same
+filesystem as MEDIA_ROOT. ``purge()`` runs from Celery beat and removes
+sessions and partial files idle for longer than CHUNKED_UPLOAD_TTL.
+"""
+import hashlib
+import logging
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import Kitob, UploadSession, UPLOAD_KIND_CHOICES
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+HASH_BLOCK = 1024 * 1024
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(Exception):
+    """Raised when an upload session or a chunk is rejected."""
+
+
+class OffsetMismatch(UploadError):
+    """Raised when a chunk does not start where the stored bytes end."""
+
+    def __init__(self, received):
+        super().__init__(f'Expected a chunk starting at byte {received}.')
+        self.received = received
+
+
+class AssembledFile(File):
+    """The finished part file; FileSystemStorage moves it instead of copying."""
+
+    def __init__(self, path, name):
+        super().__init__(open(path, 'rb'), name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def upload_dir():
+    return str(getattr(settings, 'CHUNKED_UPLOAD_DIR', settings.BASE_DIR / 'uploads'))
+
+
+def part_path(session):
+    return os.path.join(upload_dir(), f'{session.pk}.part')
+
+
+def start(user, book, kind, filename, size, sha256):
+    """Open an upload session for ``book.<kind>`` and create its empty part file."""
+    if kind not in dict(UPLOAD_KIND_CHOICES):
+        raise UploadError(f'kind must be one of {", ".join(dict(UPLOAD_KIND_CHOICES))}.')
+    max_size = getattr(settings, 'CHUNKED_UPLOAD_MAX_SIZE', 2 * 1024 ** 3)
+    if not 0 < size <= max_size:
+        raise UploadError(f'size must be between 1 and {max_size} bytes.')
+    sha256 = sha256.lower()
+    if not SHA256_RE.match(sha256):
+        raise UploadError('sha256 must be a hex SHA-256 digest.')
+    filename = get_valid_filename(os.path.basename(filename))[-100:]
+    if not filename:
+        raise UploadError('filename is required.')
+
+    session = UploadSession.objects.create(
+        user=user, book=book, kind=kind, filename=filename, size=size, sha256=sha256,
+    )
+    os.makedirs(upload_dir(), exist_ok=True)
+    open(part_path(session), 'wb').close()
+    return session
+
+
+def parse_content_range(header):
+    """'bytes 0-1023/4096' -> (0, 1023, 4096)."""
+    match = CONTENT_RANGE_RE.match((header or '').strip())
+    if not match:
+        raise UploadError('Content-Range must look like "bytes <first>-<last>/<size>".')
+    first, last, total = map(int, match.groups())
+    if last < first:
+        raise UploadError('Content-Range ends before it starts.')
+    return first, last, total
+
+
+def write_chunk(session, first, last, stream):
+    """
+    Store bytes ``first``..``last`` (inclusive) read from ``stream``. When they
+    complete the file, queue its verification. Returns the updated session.
+    """
+    if session.status != 'uploading':
+        raise UploadError(f'Upload is {session.status}.')
+    if first != session.received:
+        raise OffsetMismatch(session.received)
+    if last >= session.size:
+        raise UploadError(f'Chunk ends past the declared size of {session.size} bytes.')
+    length = last - first + 1
+    max_chunk = getattr(settings, 'CHUNKED_UPLOAD_MAX_CHUNK', 64 * 1024 ** 2)
+    if length > max_chunk:
+        raise UploadError(f'Chunks may be at most {max_chunk} bytes.')
+
+    try:
+        with open(part_path(session), 'r+b') as part:
+            # A retried chunk overwrites whatever a dropped attempt left past `received`.
+            part.seek(first)
+            remaining = length
+            while remaining:
+                data = stream.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                part.write(data)
+                remaining -= len(data)
+    except FileNotFoundError:
+        raise UploadError('Upload session has expired.')
+    if remaining:
+        raise UploadError(f'Chunk ended after {length - remaining} of {length} bytes.')
+
+    received = last + 1
+    status = 'verifying' if received == session.size else 'uploading'
+    updated = UploadSession.objects.filter(pk=session.pk, received=first, status='uploading').update(
+        received=received, status=status, u_at=timezone.now(),
+    )
+    if not updated:
+        # Another request stored this range first.
+        raise OffsetMismatch(UploadSession.objects.values_list('received', flat=True).get(pk=session.pk))
+    session.received, session.status = received, status
+    if status == 'verifying':
+        session_id = session.pk
+        transaction.on_commit(lambda: queue(session_id))
+    return session
+
+
+def queue(session_id):
+    from .task import finish_upload
+    try:
+        finish_upload.delay(str(session_id))
+    except Exception:
+        logger.warning("Could not queue verification of upload %s", session_id, exc_info=True)
+        UploadSession.objects.filter(pk=session_id).update(status='failed', u_at=timezone.now())
+        _remove(os.path.join(upload_dir(), f'{session_id}.part'))
+
+
+def finish(session_id):
+    """Verify and attach a fully received upload; False on a checksum mismatch, None if it is not waiting."""
+    session = UploadSession.objects.filter(pk=session_id, status='verifying').first()
+    if session is None:
+        return None
+    try:
+        complete(session)
+    except UploadError:
+        return False
+    return True
+
+
+def _sha256(path, size):
+    digest = hashlib.sha256()
+    with open(path, 'r+b') as part:
+        part.truncate(size)
+        for block in iter(lambda: part.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete(session):
+    """Check the assembled file against the declared SHA-256 and attach it to the book."""
+    path = part_path(session)
+    if _sha256(path, session.size) != session.sha256:
+        UploadSession.objects.filter(pk=session.pk).update(status='failed', u_at=timezone.now())
+        session.status = 'failed'
+        os.remove(path)
+        raise UploadError('Checksum mismatch, the upload has to be restarted.')
+
+    book = Kitob.objects.get(pk=session.book_id)
+    field = getattr(book, session.kind)
+    previous = field.name
+    assembled = AssembledFile(path, session.filename)
+    try:
+        field.save(session.filename, assembled, save=False)
+    finally:
+        assembled.close()
+    with transaction.atomic():
+        book.save(update_fields=[session.kind, 'u_at'])
+        UploadSession.objects.filter(pk=session.pk).update(status='complete', u_at=timezone.now())
+    session.status = 'complete'
+    if previous and previous != field.name:
+        field.storage.delete(previous)
+    return book
+
+
+def cancel(session):
+    UploadSession.objects.filter(pk=session.pk).delete()
+    _remove(part_path(session))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def purge(ttl=None, now=None):
+    """Delete sessions idle for longer than ``ttl`` and partial files as old; return the session count."""
+    ttl = ttl or getattr(settings, 'CHUNKED_UPLOAD_TTL', timedelta(hours=24))
+    cutoff = (now or timezone.now()) - ttl
+    deleted, _ = UploadSession.objects.filter(u_at__lt=cutoff).delete()
+    # A part file's mtime moves with every chunk, like its session's u_at; this
+    # also catches files whose session went with a deleted book.
+    if os.path.isdir(upload_dir()):
+        for entry in os.scandir(upload_dir()):
+            if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff.timestamp():
+                _remove(entry.path)
+    return deleted
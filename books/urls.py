@@ -5,6 +5,12 @@ from .views import (
     ReservationViewSet, RatingViewSet, BookmarkViewSet, AuthorViewSet
 )
 from .api_stats import profileStats, mainPageStats
+from .api_analytics import circulationAnalytics
+from .api_media import kitobFile
+from .api_images import imageVariant
+from .api_uploads import uploadSessions, uploadSessionDetail
+from .api_import import catalogImport, importJobDetail
+from .api_export import dataExport, exportJobDetail, exportJobFile
 router = DefaultRouter()
 router.register(r'categories', CategoryViewSet, basename='category')
 router.register(r'tags', TagViewSet, basename='tag')
@@ -22,7 +28,18 @@ comment = CommentViewSet.as_view({
 urlpatterns = [
     path('', include(router.urls)),
     path('kitob/<int:kitob_pk>/comments/', comment, name='kitob-comments'),
+    path('kitob/<int:kitob_pk>/comments/thread/', CommentViewSet.as_view({'get': 'thread'}), name='kitob-comment-thread'),
     path('kitob/<int:kitob_pk>/comments/<int:pk>/', CommentViewSet.as_view({'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}), name='comment-detail'),
+    path('kitob/<int:pk>/file/<str:kind>/', kitobFile.as_view(), name='kitob-file'),
+    path('uploads/', uploadSessions.as_view(), name='upload-sessions'),
+    path('uploads/<uuid:pk>/', uploadSessionDetail.as_view(), name='upload-session-detail'),
+    path('import/catalog/', catalogImport.as_view(), name='catalog-import'),
+    path('import/jobs/<uuid:pk>/', importJobDetail.as_view(), name='import-job-detail'),
+    path('export/jobs/<uuid:pk>/', exportJobDetail.as_view(), name='export-job-detail'),
+    path('export/jobs/<uuid:pk>/file/', exportJobFile.as_view(), name='export-job-file'),
+    path('export/<str:kind>/', dataExport.as_view(), name='data-export'),
+    path('images/<int:width>/<str:fmt>/<path:name>', imageVariant.as_view(), name='image-variant'),
     path('user-profile-stats/', profileStats.as_view(), name='profile-stats'),
     path('main-page-stats/', mainPageStats.as_view(), name='main-page-stats'),
+    path('analytics/circulation/', circulationAnalytics.as_view(), name='circulation-analytics'),
 ]
\ No newline at end of file
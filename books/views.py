@@ -10,26 +10,33 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 from django.db import transaction
-from django.db.models import F
+from django.db.models import F, Prefetch
+from django.shortcuts import get_object_or_404
 from drf_spectacular.utils import extend_schema
 from drf_spectacular.openapi import OpenApiParameter
 from drf_spectacular.types import OpenApiTypes
 from .models import Category, Tag, Kitob, Comment, Reservation, Journals, Rating, Bookmark,Author
 from .serializers import (
-    CategorySerializer, TagSerializer, KitobSerializer, CommentSerializer,
-    ReservationSerializer, JournalsSerializer, RatingSerializer, BookmarkSerializer, AuthorSerializer
+    CategorySerializer, TagSerializer, KitobSerializer, KitobListSerializer, CommentSerializer,
+    ReservationSerializer, JournalsSerializer, RatingSerializer, BookmarkSerializer, AuthorSerializer,
+    CommentThreadSerializer,
 )
-from .paginator import KitobPagination, ReservationPagination
+from .paginator import KitobPagination, ReservationPagination, CommentThreadPagination
+from . import search, reservations, comments
+from .reservations import TransitionError
+from .cache import cache_response
+from users.throttling import RoleRateThrottle, SearchRateThrottle, ReservationRateThrottle
 
 class KitobFilter(filters.FilterSet):
-    # AllValuesMultipleFilter automatically handles lists like ?category=1&category=2 
-    # and performs an 'IN' lookup, fixing potential issues in the original code.
-    category = filters.AllValuesMultipleFilter(field_name='category__id')
-    tags = filters.AllValuesMultipleFilter(field_name='tags__id')
+    # Lists like ?category=1&category=2 become an 'IN' lookup. Only the ids
+    # given are checked, unlike AllValuesMultipleFilter, which read every
+    # distinct value of the column on each request to build its choices.
+    category = filters.ModelMultipleChoiceFilter(field_name='category', queryset=Category.objects.all())
+    tags = filters.ModelMultipleChoiceFilter(field_name='tags', queryset=Tag.objects.all())
 
     # Exact matches and standard lookups
     published_date = filters.DateFilter(field_name='published_date')
-    author = filters.AllValuesMultipleFilter(field_name='author')
+    author = filters.ModelMultipleChoiceFilter(field_name='author', queryset=Author.objects.all())
     is_physical = filters.BooleanFilter(field_name='is_physical')
 
     # Custom behavior filters
@@ -91,12 +98,39 @@ class KitobFilter(filters.FilterSet):
         if value in sort_mapping:
             return queryset.order_by(sort_mapping[value])
         return queryset
+class KitobSearchFilter(drf_filters.SearchFilter):
+    """
+    ?search= backed by the full-text index in books/search.py: every term is
+    matched as a prefix and, unless an explicit sort was requested, results
+    come back best match first. Falls back to the regular LIKE search when the
+    database has no index. Ranked results are paged by number even with
+    ?cursor= (see KitobPagination).
+    """
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        if not query.strip():
+            return queryset
+        ranked = search.search_queryset(queryset, query)
+        if ranked is None:
+            return super().filter_queryset(request, queryset, view)
+        if not ranked.query.order_by:
+            ranked = ranked.order_by('search_rank', 'pk')
+        return ranked
+
 class AuthorViewSet(viewsets.ModelViewSet):
     """API endpoint for authors."""
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
     permission_classes = [AllowAny]
 
+    @cache_response('author')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache_response('author')
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 class BookmarkViewSet(viewsets.ModelViewSet):
     """API endpoint for bookmarks."""
     serializer_class = BookmarkSerializer
@@ -114,6 +148,12 @@ class CategoryViewSet(viewsets.ModelViewSet):
         else:
             permission_classes = [LibrarianPermission|SuperAdminPermission]
         return [permission() for permission in permission_classes]
+
+    @cache_response('category')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache_response('category')
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
@@ -147,9 +187,14 @@ class TagViewSet(viewsets.ModelViewSet):
             404: OpenApiTypes.OBJECT,
         }
     )
+    @cache_response('tag')
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
+    @cache_response('tag')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
 @extend_schema(
     description="API endpoint for books (Kitob). Supports filtering, sorting, and searching.",
     summary="Manage books (Kitob).",
@@ -160,9 +205,40 @@ class KitobViewSet(viewsets.ModelViewSet):
     queryset = Kitob.objects.filter(visible=True)
     serializer_class = KitobSerializer  
     pagination_class = KitobPagination
-    filter_backends = [DjangoFilterBackend, drf_filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, KitobSearchFilter]
     filterset_class = KitobFilter
+    throttle_classes = [RoleRateThrottle, SearchRateThrottle]
     search_fields = ['name', 'author__name']
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return KitobListSerializer
+        if self.action == 'ratings':
+            return RatingSerializer
+        return super().get_serializer_class()
+
+    def get_queryset(self):
+        """
+        Load everything the serializer touches in a fixed number of queries:
+        the FKs are joined and the M2Ms (and, for the detail view, ratings)
+        are prefetched. The average rating is read from the denormalized
+        columns on Kitob.
+        """
+        queryset = super().get_queryset()
+        if self.action == 'ratings':
+            return queryset
+        if self.action == 'list':
+            return queryset.select_related('category').prefetch_related('author')
+        return (
+            queryset
+            .select_related('category', 'subcategory')
+            .prefetch_related(
+                'author',
+                'tags',
+                Prefetch('ratings', queryset=Rating.objects.select_related('user')),
+            )
+        )
+
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
             permission_classes = [GuestPermission|StudentPermission|TeacherPermission|LibrarianPermission|SuperAdminPermission]
@@ -170,6 +246,7 @@ class KitobViewSet(viewsets.ModelViewSet):
             permission_classes = [LibrarianPermission|SuperAdminPermission]
         return [permission() for permission in permission_classes]
 
+    @cache_response('kitob')
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
 
@@ -184,11 +261,26 @@ class KitobViewSet(viewsets.ModelViewSet):
             404: OpenApiTypes.OBJECT,
         }
     )
+    @cache_response('kitob')
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
+    @extend_schema(
+        summary="List the ratings of a book.",
+        description="Paginated ratings for one book, newest first. Supports ?cursor= like the book list.",
+        responses={200: RatingSerializer(many=True), 404: OpenApiTypes.OBJECT},
+    )
+    @action(detail=True, methods=['get'], filter_backends=[])
+    @cache_response('kitob')
+    def ratings(self, request, pk=None):
+        book = self.get_object()
+        queryset = Rating.objects.filter(book=book).select_related('user').order_by('-c_at', '-id')
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'ratings']:
             permission_classes = [AllowAny]
         else:
             permission_classes = [IsAuthenticated]
@@ -260,6 +352,7 @@ class ReservationViewSet(viewsets.ModelViewSet):
     filterset_class = ReservationFilter
     search_fields = ['book__name', 'book__author__name']
     ordering_fields = '__all__'
+    throttle_classes = [RoleRateThrottle, ReservationRateThrottle]
     ordering = ['-id']
     ordering_param = 'sort'
     def get_permissions(self):
@@ -301,14 +394,10 @@ class ReservationViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], permission_classes=[LibrarianPermission|AdminPermission|SuperAdminPermission])
     def approve(self, request, pk=None):
         reservation = self.get_object()
-        if reservation.status != 'pending':
-            return Response({'detail': 'Only pending reservations can be approved.'}, status=status.HTTP_400_BAD_REQUEST)
-        
         try:
-            reservation.status = 'approved'
-            reservation.save()
+            reservations.approve(reservation.pk)
             return Response({'detail': 'Reservation approved successfully.'})
-        except Exception as e:
+        except TransitionError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     @extend_schema(
@@ -322,38 +411,45 @@ class ReservationViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], permission_classes=[LibrarianPermission|AdminPermission|SuperAdminPermission])
     def give_book(self, request, pk=None):
         reservation = self.get_object()
-        if reservation.status != 'approved':
-             return Response({'detail': 'Reservation must be approved first.'}, status=status.HTTP_400_BAD_REQUEST)
-        
         try:
-            reservation.status = 'given'
-            reservation.save()
+            reservations.give(reservation.pk)
             return Response({'detail': 'Book given successfully.'}, status=status.HTTP_200_OK)
-        except Exception as e:
+        except TransitionError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     @extend_schema(
         summary="Mark a book as returned.",
         description="""
-        Mark a book as returned.
+        Mark a given (or overdue) book as returned.
         """,
         responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT}
     )
     @action(detail=True, methods=['post'], permission_classes=[LibrarianPermission|AdminPermission|SuperAdminPermission])
     def return_book(self, request, pk=None):
         reservation = self.get_object()
-        
-        if reservation.status != 'given':
-            return Response(
-                {'detail': 'Only given books can be marked as returned.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         try:
-            reservation.status = 'returned'
-            reservation.save()
+            reservations.return_book(reservation.pk)
             return Response({'detail': 'Book returned successfully.'}, status=status.HTTP_200_OK)
-        except Exception as e:
+        except TransitionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @extend_schema(
+        summary="Cancel a reservation.",
+        description="""
+        Cancel a pending or approved reservation. An approved copy goes back on the shelf
+        and is offered to the next person in the queue. Students may only cancel their own reservations.
+        """,
+        responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT, 403: OpenApiTypes.OBJECT}
+    )
+    @action(detail=True, methods=['post'], permission_classes=[StudentPermission|LibrarianPermission|AdminPermission|SuperAdminPermission])
+    def cancel(self, request, pk=None):
+        reservation = self.get_object()
+        if request.user.role == 'student' and not request.user.is_superuser and reservation.user_id != request.user.pk:
+            return Response({'detail': 'You can only cancel your own reservations.'}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            reservations.cancel(reservation.pk)
+            return Response({'detail': 'Reservation cancelled successfully.'}, status=status.HTTP_200_OK)
+        except TransitionError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -421,9 +517,42 @@ class CommentViewSet(viewsets.ModelViewSet):
         return self.queryset.order_by('c_at')
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve', 'create', 'update', 'partial_update', 'destroy']:
+        if self.action == 'thread':
+            permission_classes = [GuestPermission|StudentPermission|TeacherPermission|LibrarianPermission|SuperAdminPermission]
+        elif self.action in ['list', 'retrieve', 'create', 'update', 'partial_update', 'destroy']:
             permission_classes = [StudentPermission|SuperAdminPermission]
         else:
             permission_classes = [SuperAdminPermission]
         return [permission() for permission in permission_classes]
+
+    def perform_create(self, serializer):
+        """The book comes from the URL and the author is the current user."""
+        serializer.save(user=self.request.user, book_id=self.kwargs['kitob_pk'])
+
+    @extend_schema(
+        summary="Retrieve the comment threads of a book.",
+        description="""
+        Top-level comments of a book, newest first, each with its replies nested under `replies`
+        (oldest first, at any depth). Paged by keyset over the top-level comments: follow `next`.
+        The book is given once, as `book`. 404 if the book does not exist or is hidden (staff see hidden books).
+        Costs three queries whatever the size of the threads.
+        """,
+        parameters=[OpenApiParameter(name='cursor', type=OpenApiTypes.STR, description='From the next/previous links')],
+        responses={200: OpenApiTypes.OBJECT},
+    )
+    @action(detail=False, methods=['get'])
+    def thread(self, request, kitob_pk=None):
+        books = Kitob.objects.all()
+        if not (LibrarianPermission | AdminPermission | SuperAdminPermission)().has_permission(request, self):
+            # Hidden books are only reachable by the staff who manage them.
+            books = books.filter(visible=True)
+        get_object_or_404(books, pk=kitob_pk)
+        top_level = Comment.objects.filter(book_id=kitob_pk, root__isnull=True).select_related('user')
+        paginator = CommentThreadPagination()
+        page = paginator.paginate_queryset(top_level, request, view=self)
+        context = self.get_serializer_context()
+        results = comments.thread(page, lambda rows: CommentThreadSerializer(rows, many=True, context=context).data)
+        response = paginator.get_paginated_response(results)
+        response.data = {'book': int(kitob_pk), **response.data}
+        return response
     
\ No newline at end of file
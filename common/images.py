@@ -0,0 +1,154 @@
+"""
+Resized WebP/JPEG variants of uploaded images.
+
+Every tracked ``img`` field gets variants at ``WIDTHS`` in each of
+``FORMATS``, stored under a name derived only from the original's name
+(``variant_name``), so they never need to be looked up:
+
+    book_images/cover.png -> variants/book_images/cover.320w.webp
+
+``track(Model)`` queues ``generate_image_variants`` after an upload commits.
+The queue is an optimisation only: ``imageVariant`` (books/api_images.py)
+builds any variant that is missing on first request and redirects to the
+stored file, so a lost task or an image uploaded before this existed costs
+one slow request. Serializers expose the variants with ``SrcsetField``.
+"""
+import io
+import logging
+import posixpath
+
+from celery import shared_task
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.urls import reverse
+from PIL import Image, ImageOps
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (160, 320, 640, 1280)
+# URL extension -> (Pillow format, save options)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+VARIANT_DIR = 'variants'
+
+# Upload directories of the tracked fields; only these may be resized.
+_sources = set()
+
+
+def variant_name(name, width, fmt):
+    stem, _ = posixpath.splitext(name)
+    return f'{VARIANT_DIR}/{stem}.{width}w.{fmt}'
+
+
+def is_source(name):
+    return bool(name) and name.startswith(tuple(_sources)) and '..' not in name.split('/')
+
+
+def _encode(image, width, fmt):
+    pillow_format, options = FORMATS[fmt]
+    resized = image.copy()
+    # thumbnail() keeps the aspect ratio and never upscales.
+    resized.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+    if pillow_format == 'JPEG' and resized.mode != 'RGB':
+        resized = resized.convert('RGB')
+    elif resized.mode not in ('RGB', 'RGBA'):
+        resized = resized.convert('RGBA')
+    buffer = io.BytesIO()
+    resized.save(buffer, pillow_format, **options)
+    return buffer.getvalue()
+
+
+def generate(name, widths=WIDTHS, formats=tuple(FORMATS), storage=default_storage):
+    """Create the missing variants of ``name``; return the names written."""
+    wanted = [(width, fmt) for width in widths for fmt in formats
+              if not storage.exists(variant_name(name, width, fmt))]
+    if not wanted:
+        return []
+    with storage.open(name, 'rb') as source:
+        image = ImageOps.exif_transpose(Image.open(source))
+        image.load()
+    written = []
+    for width, fmt in wanted:
+        target = variant_name(name, width, fmt)
+        saved = storage.save(target, ContentFile(_encode(image, width, fmt)))
+        if saved != target:
+            # Another worker wrote it first; the storage renamed our copy.
+            storage.delete(saved)
+        written.append(target)
+    return written
+
+
+@shared_task
+def generate_image_variants(name):
+    if not is_source(name):
+        return 0
+    try:
+        return len(generate(name))
+    except (OSError, Image.DecompressionBombError):
+        logger.warning("Could not build variants of %s", name, exc_info=True)
+        return 0
+
+
+def queue(name):
+    try:
+        generate_image_variants.delay(name)
+    except Exception:
+        # The variants are built on first request instead.
+        logger.warning("Could not queue variants of %s", name, exc_info=True)
+
+
+def track(model, field='img'):
+    """Queue variants whenever ``model.<field>`` gets a new file."""
+    _sources.add(model._meta.get_field(field).upload_to)
+    label = model._meta.label_lower
+
+    def remember_image(sender, instance, **kwargs):
+        # Read through __dict__ so a deferred field is not fetched on load.
+        value = instance.__dict__.get(field)
+        instance._images_was = getattr(value, 'name', value)
+
+    def queue_variants(sender, instance, created=False, raw=False, **kwargs):
+        name = getattr(instance, field).name
+        if name and not raw and (created or name != getattr(instance, '_images_was', None)):
+            transaction.on_commit(lambda: queue(name))
+        instance._images_was = name
+
+    post_init.connect(remember_image, sender=model, weak=False, dispatch_uid=f'images-{label}-init')
+    post_save.connect(queue_variants, sender=model, weak=False, dispatch_uid=f'images-{label}-save')
+
+
+class SrcsetField(serializers.Field):
+    """
+    Read-only ``{format: srcset}`` for an image field, e.g.
+    ``{"webp": ".../160/webp/book_images/a.png 160w, ...", "jpg": ...}``;
+    None when there is no image.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        try:
+            return super().get_attribute(instance)
+        except AttributeError:
+            return None
+
+    def to_representation(self, value):
+        name = getattr(value, 'name', value)
+        if not name:
+            return None
+        request = self.context.get('request')
+        srcset = {}
+        for fmt in FORMATS:
+            urls = []
+            for width in WIDTHS:
+                url = reverse('image-variant', kwargs={'width': width, 'fmt': fmt, 'name': name})
+                urls.append(f'{request.build_absolute_uri(url) if request else url} {width}w')
+            srcset[fmt] = ', '.join(urls)
+        return srcset
@@ -0,0 +1,101 @@
+"""
+Read-replica routing.
+
+ReplicaRoutingMiddleware marks GET/HEAD/OPTIONS requests as replica-safe and
+ReplicaRouter then sends their reads to one of ``REPLICA_DATABASES``.
+Everything else reads from the primary:
+
+* unsafe requests, Celery tasks and management commands (nothing is marked);
+* anything inside a transaction, so ``transaction.atomic`` blocks such as
+  the reservation transitions always see their own writes and take their
+  locks on the primary;
+* a client's requests for ``REPLICA_PIN_SECONDS`` after it wrote, so it
+  does not read its own change back from a lagging replica. Clients are
+  told apart by their Authorization header, or their address when
+  anonymous; the pins live in the default cache.
+
+With no replicas configured every read goes to ``default``.
+"""
+import contextlib
+import contextvars
+import hashlib
+import logging
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_KEY = 'dbpin:%s'
+
+_replica_safe = contextvars.ContextVar('replica_safe', default=False)
+
+
+@contextlib.contextmanager
+def use_replicas(enabled=True):
+    """Allow (or, with ``enabled=False``, forbid) replica reads inside the block."""
+    token = _replica_safe.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_safe.reset(token)
+
+
+def replica_for_read():
+    replicas = getattr(settings, 'REPLICA_DATABASES', ())
+    if not replicas or not _replica_safe.get():
+        return DEFAULT_DB_ALIAS
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return replica_for_read()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def client_key(request):
+    identity = request.META.get('HTTP_AUTHORIZATION') or request.META.get('REMOTE_ADDR', '')
+    return PIN_KEY % hashlib.sha1(identity.encode()).hexdigest()
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def is_pinned(self, request):
+        try:
+            return bool(cache.get(client_key(request)))
+        except Exception:
+            logger.warning("Replica pin lookup failed, reading from primary", exc_info=True)
+            return True
+
+    def pin(self, request):
+        try:
+            cache.set(client_key(request), 1, getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+        except Exception:
+            logger.warning("Could not pin client to primary", exc_info=True)
+
+    def __call__(self, request):
+        if not getattr(settings, 'REPLICA_DATABASES', ()):
+            return self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            self.pin(request)
+            return response
+        with use_replicas(not self.is_pinned(request)):
+            return self.get_response(request)
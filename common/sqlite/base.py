@@ -0,0 +1,31 @@
+"""
+SQLite backend tuned for concurrent writers.
+
+* WAL lets readers run alongside the single writer, and synchronous=NORMAL
+  is durable across application crashes (only an OS crash can lose the last
+  commits) while skipping an fsync per transaction.
+* Transactions start with BEGIN IMMEDIATE. A deferred transaction that reads
+  and then writes fails at once with "database is locked" when another
+  writer got in between, because SQLite cannot wait on that lock upgrade;
+  taking the write lock up front makes it wait for ``timeout`` instead.
+
+Django 4.2 has neither ``init_command`` nor ``transaction_mode`` for SQLite,
+hence the subclass. Enabled by ``SQLITE_TUNED`` in settings.
+"""
+from django.db.backends.sqlite3 import base
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
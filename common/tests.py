@@ -1,3 +1,133 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import SimpleTestCase, RequestFactory, TestCase, override_settings
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+
+from books.cache import bump, cache_response
+from books.tests import LOCAL_CACHE, make_book
+from . import images
+from .replicas import ReplicaRoutingMiddleware, replica_for_read, use_replicas
+
+
+@override_settings(CACHES=LOCAL_CACHE, REPLICA_DATABASES=['replica1'], REPLICA_PIN_SECONDS=10)
+class ReplicaRoutingTests(SimpleTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.seen = None
+        self.middleware = ReplicaRoutingMiddleware(self.view)
+
+    def view(self, request):
+        self.seen = replica_for_read()
+        return HttpResponse()
+
+    def request(self, method, token='Bearer a'):
+        self.middleware(getattr(self.factory, method)('/api/kitob/', HTTP_AUTHORIZATION=token))
+        return self.seen
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.request('get'), 'replica1')
+        self.assertEqual(self.request('post'), 'default')
+
+    def test_client_is_pinned_to_primary_after_writing(self):
+        self.request('post')
+        self.assertEqual(self.request('get'), 'default')
+        self.assertEqual(self.request('get', token='Bearer b'), 'replica1')
+
+    def test_reads_inside_a_transaction_use_primary(self):
+        def view(request):
+            with transaction.atomic():
+                self.seen = replica_for_read()
+            return HttpResponse()
+        ReplicaRoutingMiddleware(view)(self.factory.get('/api/kitob/'))
+        self.assertEqual(self.seen, 'default')
+
+    def test_cache_is_filled_from_primary_right_after_a_bump(self):
+        seen = []
+
+        class View:
+            @cache_response('kitob')
+            def list(self, request):
+                seen.append(replica_for_read())
+                return Response({})
+
+        def get(query):
+            with use_replicas():
+                View().list(Request(self.factory.get(f'/api/kitob/?{query}')))
+
+        bump('kitob')
+        get('page=1')
+        self.assertEqual(seen, ['default'])
+        with mock.patch('books.cache.time.time', return_value=time.time() + 60):
+            get('page=2')
+        self.assertEqual(seen, ['default', 'replica1'])
+
+    def test_no_replicas_configured(self):
+        with self.settings(REPLICA_DATABASES=[]):
+            self.assertEqual(self.request('get'), 'default')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, book):
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 1200), 'navy').save(buffer, 'PNG')
+        book.img.save('cover.png', ContentFile(buffer.getvalue()))
+
+    def test_upload_queues_variants_once(self):
+        book = make_book(1)
+        with mock.patch.object(images.generate_image_variants, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.upload(book)
+            with self.captureOnCommitCallbacks(execute=True):
+                book.quantity = 2
+                book.save()
+        delay.assert_called_once_with(book.img.name)
+
+        self.assertEqual(images.generate_image_variants(book.img.name), 8)
+        small = images.variant_name(book.img.name, 160, 'webp')
+        self.assertEqual(small, 'variants/book_images/cover.160w.webp')
+        with default_storage.open(small) as variant:
+            self.assertEqual(Image.open(variant).size, (160, 240))
+        # Widths above the original are not upscaled.
+        with default_storage.open(images.variant_name(book.img.name, 1280, 'jpg')) as variant:
+            self.assertEqual(Image.open(variant).size, (800, 1200))
+
+    def test_missing_variant_is_built_on_first_request(self):
+        book = make_book(1)
+        with mock.patch.object(images.generate_image_variants, 'delay'):
+            self.upload(book)
+        client = APIClient()
+        srcset = client.get(f'/api/kitob/{book.pk}/').data['img_srcset']
+        url = srcset['webp'].split(', ')[1].split(' ')[0]
+        self.assertTrue(url.endswith(f'/api/images/320/webp/{book.img.name}'))
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], default_storage.url(images.variant_name(book.img.name, 320, 'webp')))
+        self.assertTrue(default_storage.exists(images.variant_name(book.img.name, 320, 'webp')))
+        self.assertFalse(default_storage.exists(images.variant_name(book.img.name, 640, 'webp')))
+
+        self.assertEqual(client.get(f'/api/images/321/webp/{book.img.name}').status_code, 404)
+        self.assertEqual(client.get('/api/images/320/webp/book_pdfs/secret.pdf').status_code, 404)
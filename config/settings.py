@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 from celery.schedules import crontab
@@ -59,11 +60,26 @@ REST_FRAMEWORK = {
         'users.permissions.IsNotBanned',  # Enforce ban check globally
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,  # Default page size for pagination
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    # Token buckets per role, see users/throttling.py. No entry means no limit.
+    'DEFAULT_THROTTLE_CLASSES': ['users.throttling.RoleRateThrottle'],
+    'DEFAULT_THROTTLE_RATES': {
+        'requests.guest': '120/min',
+        'requests.student': '300/min',
+        'requests.teacher': '300/min',
+        'requests.librarian': '1200/min',
+        'search.guest': '20/min',
+        'search.student': '60/min',
+        'search.teacher': '60/min',
+        'search.librarian': '300/min',
+        'reservations.student': '20/hour',
+        'reservations.teacher': '20/hour',
+        'reservations.librarian': '200/hour',
+    },
 }
 
 SPECTACULAR_SETTINGS = {
@@ -75,6 +91,7 @@ SPECTACULAR_SETTINGS = {
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'common.replicas.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -111,14 +128,87 @@ PASSWORD_HASHERS = [
 
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
+#
+# DB_ENGINE=sqlite (default) or postgres. With postgres, connections are kept
+# for DB_CONN_MAX_AGE seconds and health-checked before reuse; DB_POOL=pgbouncer
+# is for running behind a transaction-pooling PgBouncer. DB_SQLITE_TUNED=1
+# (default) uses WAL, synchronous=NORMAL and BEGIN IMMEDIATE (common/sqlite).
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+SQLITE_TUNED = os.environ.get('DB_SQLITE_TUNED', '1') == '1'
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'lms'),
+            'USER': os.environ.get('DB_USER', 'lms'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+    if os.environ.get('DB_POOL') == 'pgbouncer':
+        # Each transaction may land on a different server connection, so named
+        # cursors (used by QuerySet.iterator()) cannot outlive it.
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'common.sqlite' if SQLITE_TUNED else 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Seconds a writer waits on the database lock (busy_timeout).
+                'timeout': int(os.environ.get('DB_SQLITE_TIMEOUT', 20)),
+            },
+        }
+    }
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+THROTTLE_REDIS_URL = os.environ.get('THROTTLE_REDIS_URL', 'redis://localhost:6379/1')
+
+# Read replicas (common/replicas.py): DB_REPLICAS is a comma-separated list of
+# replica hosts (postgres) or database files (sqlite). Safe-method requests
+# read from them; a client that wrote reads from the primary for
+# REPLICA_PIN_SECONDS.
+REPLICA_DATABASES = []
+for number, location in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), start=1):
+    alias = f'replica{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        ('HOST' if DB_ENGINE == 'postgres' else 'NAME'): location.strip(),
+        'TEST': {'MIRROR': 'default'},
     }
-}
+    REPLICA_DATABASES.append(alias)
+DATABASE_ROUTERS = ['common.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('DB_REPLICA_PIN_SECONDS', 10))
 
+# Cache (Redis, shared with Celery). Used for the catalog response cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'KEY_PREFIX': 'lms',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'socket_connect_timeout': 1,
+            'socket_timeout': 1,
+        },
+    },
+    # JWT staleness markers (users/authentication.py). Losing one lets a stale
+    # role or ban through until the token expires, so point AUTH_CACHE_URL at a
+    # Redis with maxmemory-policy noeviction, not at the response cache.
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('AUTH_CACHE_URL', 'redis://localhost:6379/2'),
+        'KEY_PREFIX': 'lms',
+        'OPTIONS': {
+            'socket_connect_timeout': 1,
+            'socket_timeout': 1,
+        },
+    },
+}
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -177,13 +267,73 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 
+# File processing runs on its own queue and worker pool (see books/pdf.py).
+CELERY_TASK_ROUTES = {
+    'books.task.process_pdf': {'queue': 'media'},
+    'books.task.finish_upload': {'queue': 'media'},
+    'common.images.generate_image_variants': {'queue': 'media'},
+}
 CELERY_BEAT_SCHEDULE = {
     'check_reservation_status_every_10_min': {
         'task': 'books.task.check_reservation_status',
         'schedule': crontab(minute='*/10'),
     },
+    'refresh_stats_rollup_every_5_min': {
+        'task': 'books.task.refresh_stats_rollup',
+        'schedule': crontab(minute='*/5'),
+    },
+    'refresh_circulation_facts_every_5_min': {
+        'task': 'books.task.refresh_circulation_facts',
+        'schedule': crontab(minute='*/5'),
+    },
+    'purge_refresh_tokens_hourly': {
+        'task': 'users.task.purge_refresh_tokens',
+        'schedule': crontab(minute=15),
+    },
+    'purge_upload_sessions_hourly': {
+        'task': 'books.task.purge_upload_sessions',
+        'schedule': crontab(minute=45),
+    },
+    'purge_exports_daily': {
+        'task': 'books.task.purge_exports',
+        'schedule': crontab(hour=4, minute=0),
+    },
+    'purge_imports_daily': {
+        'task': 'books.task.purge_imports',
+        'schedule': crontab(hour=4, minute=15),
+    },
+    'reconcile_stats_counters_nightly': {
+        'task': 'books.task.reconcile_stats_counters',
+        'schedule': crontab(hour=3, minute=30),
+    },
 }
 
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Book PDFs and audio are served by books/api_media.py. MEDIA_ACCEL=nginx hands
+# the transfer to nginx with X-Accel-Redirect (an `internal` location at
+# MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT); MEDIA_ACCEL=sendfile sets
+# X-Sendfile for Apache/lighttpd. Unset, Django streams the file itself.
+MEDIA_ACCEL = os.environ.get('MEDIA_ACCEL') or None
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+# Resumable uploads of book files (books/uploads.py). Keep CHUNKED_UPLOAD_DIR on
+# the same filesystem as MEDIA_ROOT so finished files are renamed, not copied.
+CHUNKED_UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', BASE_DIR / 'uploads')
+CHUNKED_UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+CHUNKED_UPLOAD_MAX_CHUNK = 64 * 1024 ** 2
+CHUNKED_UPLOAD_TTL = timedelta(hours=24)
+
+# Catalog and reservation exports (books/exports.py). Larger exports are written
+# to EXPORT_DIR by a worker instead of streamed, and kept for EXPORT_TTL.
+EXPORT_DIR = os.environ.get('EXPORT_DIR', BASE_DIR / 'exports')
+EXPORT_STREAM_MAX_ROWS = 100_000
+EXPORT_TTL = timedelta(days=7)
+
+# Catalog imports (books/importer.py). Uploads larger than IMPORT_INLINE_MAX_BYTES
+# are saved to IMPORT_DIR and imported by a worker; the jobs are kept for IMPORT_TTL.
+IMPORT_DIR = os.environ.get('IMPORT_DIR', BASE_DIR / 'imports')
+IMPORT_INLINE_MAX_BYTES = 5 * 1024 ** 2
+IMPORT_TTL = timedelta(days=7)
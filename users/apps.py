@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        # Importing the module connects its signal handlers.
+        from . import authentication  # noqa: F401
+        from common import images
+        from .models import User
+        images.track(User)
@@ -0,0 +1,120 @@
+"""
+JWT authentication without a user query per request.
+
+Access tokens carry the fields the permission classes read (``role``,
+``ban_expires_at``, ``is_superuser``). CachedJWTAuthentication builds the
+request user from those claims as a ``User`` instance whose other fields are
+deferred, so foreign-key assignment and filtering work as usual, any other
+field is loaded on first access, and ``save()`` writes only the loaded
+fields.
+
+Claims go stale when the user row changes, so every change stores a marker
+in the cache with the time it happened. A token issued before the latest
+marker is resolved from the database instead, and refused if it predates
+the user's ``sessions_revoked_at`` (see users/sessions.py). Markers are checked in a
+small in-process cache first (``AUTH_MARKER_LOCAL_TTL`` seconds) and then
+in Redis. If the cache is down the database is used.
+
+Markers live in their own cache alias, ``auth``, not in the response cache.
+A marker that is evicted early means a ban or a role change is not seen
+until the token expires, so that alias must point at a Redis that never
+evicts (``maxmemory-policy noeviction``); the markers are tiny and expire
+with the access-token lifetime on their own.
+"""
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import User
+from . import sessions
+
+logger = logging.getLogger(__name__)
+
+CLAIM_FIELDS = ('role', 'ban_expires_at', 'is_superuser')
+MARKER_KEY = 'authuser:%s'
+MARKER_CACHE = 'auth'
+
+# user id -> (marker, checked_at)
+_local_markers = {}
+
+
+def add_user_claims(token, user):
+    """Copy the fields the permission classes need into ``token``."""
+    token['role'] = user.role
+    token['is_superuser'] = user.is_superuser
+    token['ban_expires_at'] = int(user.ban_expires_at.timestamp()) if user.ban_expires_at else None
+    # ``iat`` has whole seconds only; see sessions.issued_before_revocation.
+    token['issued_at'] = time.time()
+    return token
+
+
+def _marker_ttl():
+    return int(settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds())
+
+
+def user_changed(user_id):
+    """Make tokens issued up to now resolve ``user_id`` from the database."""
+    _local_markers.pop(user_id, None)
+    try:
+        caches[MARKER_CACHE].set(MARKER_KEY % user_id, time.time(), _marker_ttl())
+    except Exception:
+        logger.warning("Could not store auth invalidation marker for user %s", user_id, exc_info=True)
+
+
+def changed_at(user_id):
+    """Time of the last change to ``user_id`` within the token lifetime, 0 if none, None if unknown."""
+    now = time.monotonic()
+    local = _local_markers.get(user_id)
+    if local and now - local[1] < getattr(settings, 'AUTH_MARKER_LOCAL_TTL', 5):
+        return local[0]
+    try:
+        marker = caches[MARKER_CACHE].get(MARKER_KEY % user_id) or 0
+    except Exception:
+        logger.warning("Auth invalidation markers unavailable", exc_info=True)
+        return None
+    _local_markers[user_id] = (marker, now)
+    return marker
+
+
+def user_from_claims(token):
+    ban = token['ban_expires_at']
+    values = {
+        'id': User._meta.pk.to_python(token[api_settings.USER_ID_CLAIM]),
+        'role': token['role'],
+        'is_superuser': token['is_superuser'],
+        'ban_expires_at': datetime.datetime.fromtimestamp(ban, tz=datetime.timezone.utc) if ban is not None else None,
+        'is_active': True,
+    }
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+    return User.from_db(User.objects.db, names, [values[name] for name in names])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        # Tokens issued before the claims existed always take the database path.
+        if all(claim in validated_token for claim in CLAIM_FIELDS):
+            try:
+                user_id = User._meta.pk.to_python(validated_token[api_settings.USER_ID_CLAIM])
+            except KeyError:
+                raise InvalidToken('Token contained no recognizable user identification')
+            marker = changed_at(user_id)
+            if marker is not None and marker < validated_token.get('iat', 0):
+                return user_from_claims(validated_token)
+        user = super().get_user(validated_token)
+        if sessions.issued_before_revocation(user, validated_token):
+            raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+        return user
+
+
+@receiver(post_save, sender=User, dispatch_uid='auth-user-changed')
+@receiver(post_delete, sender=User, dispatch_uid='auth-user-deleted')
+def invalidate_claims(sender, instance, **kwargs):
+    user_changed(instance.pk)
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users.models import User, Notification
+from users.notifications import create_notifications
+from users.task import send_notification
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Compare one send_notification task per message with the batched create_notifications path. "
+            "Tasks run eagerly, so broker round-trips are not included; everything is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--users', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        try:
+            with transaction.atomic():
+                users = User.objects.bulk_create(
+                    User(username=f'bench-notify-{i}') for i in range(options['users'])
+                )
+                user_ids = [user.pk for user in users]
+                items = [(user_ids[i % len(user_ids)], 'Benchmark', f'message {i}') for i in range(count)]
+
+                start = time.perf_counter()
+                for user_id, title, message in items:
+                    send_notification.apply(args=(user_id, message, title))
+                per_message = time.perf_counter() - start
+
+                Notification.objects.filter(user_id__in=user_ids).delete()
+                start = time.perf_counter()
+                create_notifications(items)
+                batched = time.perf_counter() - start
+
+                self.stdout.write(f"{count} notifications for {len(user_ids)} users")
+                for label, seconds in (('one task per message', per_message), ('batched', batched)):
+                    self.stdout.write(f"{label:<22}{seconds * 1000:>10.1f} ms{count / seconds:>12,.0f} msg/s")
+                raise Rollback
+        except Rollback:
+            pass
@@ -0,0 +1,46 @@
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from users import throttling
+
+
+class Command(BaseCommand):
+    help = "Measure the per-request cost of the Redis token-bucket throttle against THROTTLE_REDIS_URL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--clients', type=int, default=100)
+        parser.add_argument('--rate', default='1000/min', help="Rate applied to every simulated client.")
+
+    def handle(self, *args, **options):
+        capacity, duration = throttling.parse_rate(options['rate'])
+        run = uuid.uuid4().hex[:8]
+        keys = [throttling.KEY % (f'bench-{run}', client) for client in range(options['clients'])]
+
+        try:
+            throttling.get_script().registered_client.ping()
+        except throttling.redis.RedisError as exc:
+            self.stderr.write(f"Redis at {settings.THROTTLE_REDIS_URL} is unreachable: {exc}")
+            return
+
+        timings, refused = [], 0
+        for i in range(options['requests']):
+            start = time.perf_counter()
+            allowed, _ = throttling.take(keys[i % len(keys)], capacity, capacity / duration)
+            timings.append((time.perf_counter() - start) * 1e6)
+            refused += not allowed
+        if throttling._failing:
+            self.stderr.write("Redis failed during the run; the timings are of the fallback, not the throttle.")
+            return
+        throttling.get_script().registered_client.delete(*keys)
+
+        timings.sort()
+        self.stdout.write(f"{options['requests']} checks over {len(keys)} clients at {options['rate']}, {refused} refused")
+        self.stdout.write(
+            f"per check: median {statistics.median(timings):.0f} us, "
+            f"p99 {timings[int(len(timings) * 0.99) - 1]:.0f} us, max {timings[-1]:.0f} us"
+        )
@@ -0,0 +1,84 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:30
+
+import base64
+import datetime
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def token_claims(token):
+    """Read jti and exp from a stored JWT without verifying it (it was verified when stored)."""
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))
+
+
+def fill_jti(apps, schema_editor):
+    ActiveRefreshToken = apps.get_model('users', 'ActiveRefreshToken')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stale = []
+    for row in ActiveRefreshToken.objects.only('pk', 'token').iterator():
+        try:
+            claims = token_claims(row.token)
+            row.jti = claims['jti']
+            row.expires_at = datetime.datetime.fromtimestamp(claims['exp'], tz=datetime.timezone.utc)
+        except (IndexError, KeyError, TypeError, ValueError):
+            stale.append(row.pk)
+            continue
+        if row.expires_at <= now:
+            stale.append(row.pk)
+        else:
+            row.save(update_fields=['jti', 'expires_at'])
+    ActiveRefreshToken.objects.filter(pk__in=stale).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_notification_user_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='sessions_revoked_at',
+            field=models.DateTimeField(blank=True, default=None, help_text='Tokens issued before this time are no longer accepted.', null=True),
+        ),
+        migrations.AddField(
+            model_name='activerefreshtoken',
+            name='jti',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='activerefreshtoken',
+            name='expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_jti, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='activerefreshtoken',
+            name='token',
+        ),
+        migrations.AlterField(
+            model_name='activerefreshtoken',
+            name='jti',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='activerefreshtoken',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='activerefreshtoken',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refresh_tokens', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='activerefreshtoken',
+            index=models.Index(fields=['user', 'expires_at'], name='refresh_token_user_expires'),
+        ),
+    ]
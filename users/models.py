@@ -19,6 +19,8 @@ class User(AbstractUser):
                                           help_text="The user is banned until this date and time.")
     max_allowed = models.IntegerField(default=3)
     img = models.ImageField(upload_to='user_images/', null=True, blank=True)
+    sessions_revoked_at = models.DateTimeField(null=True, blank=True, default=None,
+                                               help_text="Tokens issued before this time are no longer accepted.")
     @property
     def is_banned(self):
         """Checks if the user is currently banned."""
@@ -29,15 +31,19 @@ class User(AbstractUser):
 
 
 class ActiveRefreshToken(models.Model):
-    """Stores active refresh tokens for logout / refresh validation."""
+    """Stores active refresh tokens, by their jti claim, for logout / refresh validation."""
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    token = models.TextField(unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='refresh_tokens')
+    jti = models.CharField(max_length=64, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
 
     class Meta:
         verbose_name = "Active Refresh Token"
         verbose_name_plural = "Active Refresh Tokens"
+        indexes = [
+            models.Index(fields=['user', 'expires_at'], name='refresh_token_user_expires'),
+        ]
 
 class Notification(models.Model):
     """Model to store notifications for users."""
@@ -50,4 +56,7 @@ class Notification(models.Model):
     def __str__(self):
         return f'Notification for {self.user.username} at {self.created_at}'
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='notification_user_created'),
+        ]
\ No newline at end of file
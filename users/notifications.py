@@ -0,0 +1,56 @@
+"""
+Batched notification writes.
+
+Callers pass many (user_id, title, message) tuples at once. They are written
+with bulk_create in chunks, and a reminder identical to one the user already
+got within ``dedup_window`` is dropped, so a periodic job can run as often
+as it likes without spamming anyone.
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import Notification, User
+
+DEDUP_WINDOW = timedelta(hours=24)
+CHUNK_SIZE = 1000
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(tuple(item))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def create_notifications(items, dedup_window=DEDUP_WINDOW, chunk_size=CHUNK_SIZE):
+    """
+    Write notifications for an iterable of (user_id, title, message) tuples.
+    Unknown users and duplicates are skipped. Returns the number created.
+    """
+    created = 0
+    for chunk in _chunks(items, chunk_size):
+        wanted = list(dict.fromkeys(chunk))  # drop repeats within the batch, keep order
+        user_ids = {user_id for user_id, _, _ in wanted}
+        known_users = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        already_sent = set()
+        if dedup_window:
+            already_sent = set(
+                Notification.objects.filter(
+                    user_id__in=known_users,
+                    title__in={title for _, title, _ in wanted},
+                    created_at__gte=timezone.now() - dedup_window,
+                ).values_list('user_id', 'title', 'message')
+            )
+        fresh = [
+            Notification(user_id=user_id, title=title, message=message)
+            for user_id, title, message in wanted
+            if user_id in known_users and (user_id, title, message) not in already_sent
+        ]
+        Notification.objects.bulk_create(fresh)
+        created += len(fresh)
+    return created
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import User, Notification
+from common.images import SrcsetField
+from .models import User, Notification, ActiveRefreshToken
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -9,12 +10,13 @@ class UserSerializer(serializers.ModelSerializer):
     """
     # The is_banned property is included as a read-only field.
     is_banned = serializers.BooleanField(read_only=True)
+    img_srcset = SrcsetField(source='img')
 
     class Meta:
         model = User
         fields = (
             'id', 'username', 'password', 'email', 'first_name', 'last_name',
-            'phone_number', 'role', 'is_banned', 'ban_expires_at', 'max_allowed', 'img', 'last_login'
+            'phone_number', 'role', 'is_banned', 'ban_expires_at', 'max_allowed', 'img', 'img_srcset', 'last_login'
         )
         # Make the password write-only so it's not sent back in API responses.
         extra_kwargs = {
@@ -54,4 +56,10 @@ class NotificationSerializer(serializers.ModelSerializer):
     """Serializer for the Notification model."""
     class Meta:
         model = Notification
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class SessionSerializer(serializers.ModelSerializer):
+    """A refresh-token session, identified by the token's jti."""
+    class Meta:
+        model = ActiveRefreshToken
+        fields = ('jti', 'created_at', 'expires_at')
@@ -0,0 +1,79 @@
+"""
+Refresh-token sessions.
+
+Each issued refresh token is one ActiveRefreshToken row keyed by its ``jti``
+claim, with the token's expiry. Lookups are by a short unique key instead of
+the full JWT text.
+
+Revoking all of a user's sessions is a single UPDATE of
+``User.sessions_revoked_at``. Any token issued before that time, refresh or
+access, is refused from then on, however many rows the user has. The rows
+themselves, like expired ones, are deleted in bulk by ``purge()`` from
+Celery beat.
+"""
+import datetime
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import ActiveRefreshToken
+
+
+def _expiry(token):
+    return datetime.datetime.fromtimestamp(token['exp'], tz=datetime.timezone.utc)
+
+
+def register(user, token):
+    """Record a newly issued refresh token."""
+    ActiveRefreshToken.objects.get_or_create(jti=token['jti'], defaults={'user': user, 'expires_at': _expiry(token)})
+
+
+def active(user=None):
+    """Sessions that are neither expired nor revoked, optionally for one user."""
+    sessions = ActiveRefreshToken.objects.filter(
+        Q(user__sessions_revoked_at__isnull=True) | Q(user__sessions_revoked_at__lt=F('created_at')),
+        expires_at__gt=timezone.now(),
+    )
+    return sessions.filter(user=user) if user is not None else sessions
+
+
+def is_active(token):
+    return active().filter(jti=token['jti']).exists()
+
+
+def revoke(token_or_jti):
+    """End one session; returns whether it existed."""
+    jti = token_or_jti if isinstance(token_or_jti, str) else token_or_jti['jti']
+    deleted, _ = ActiveRefreshToken.objects.filter(jti=jti).delete()
+    return bool(deleted)
+
+
+def revoke_all(user):
+    """End every session of ``user``, refresh and access tokens alike, in one UPDATE."""
+    user.sessions_revoked_at = timezone.now()
+    # save() rather than update() so the post_save signal drops cached token claims.
+    user.save(update_fields=['sessions_revoked_at'])
+
+
+def issued_before_revocation(user, token):
+    revoked_at = user.sessions_revoked_at
+    if revoked_at is None:
+        return False
+    if 'issued_at' in token:
+        return token['issued_at'] <= revoked_at.timestamp()
+    # Older tokens only have ``iat``, in whole seconds; one from the second of
+    # the revocation is let through so that logging in again right away works.
+    return token.get('iat', 0) < int(revoked_at.timestamp())
+
+
+def purge(batch_size=5000):
+    """Delete expired and revoked session rows in batches; returns the number deleted."""
+    stale = ActiveRefreshToken.objects.filter(
+        Q(expires_at__lte=timezone.now()) | Q(user__sessions_revoked_at__gte=F('created_at'))
+    )
+    deleted = 0
+    while True:
+        ids = list(stale.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += ActiveRefreshToken.objects.filter(pk__in=ids).delete()[0]
@@ -1,5 +1,8 @@
+from datetime import timedelta
 from celery import shared_task
 from .models import Notification, User
+from .notifications import create_notifications, DEDUP_WINDOW
+from . import sessions
 
 @shared_task
 def send_notification(user_id, message, title="Notification"):
@@ -8,4 +11,15 @@ def send_notification(user_id, message, title="Notification"):
         Notification.objects.create(user=user, message=message, title=title)
         return f"Notification sent to {user.username}"
     except User.DoesNotExist:
-        return "User not found"
\ No newline at end of file
+        return "User not found"
+
+@shared_task
+def send_notifications(items, dedup_window_seconds=None):
+    """Write a batch of [user_id, title, message] notifications in bulk."""
+    window = DEDUP_WINDOW if dedup_window_seconds is None else timedelta(seconds=dedup_window_seconds)
+    return create_notifications(items, dedup_window=window)
+
+@shared_task
+def purge_refresh_tokens():
+    """Delete expired and revoked refresh-token sessions."""
+    return sessions.purge()
@@ -1,3 +1,188 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+
+from books.tests import LOCAL_CACHE
+from .models import User, Notification, ActiveRefreshToken
+from .notifications import create_notifications
+from . import authentication, sessions, throttling
+from .authentication import CachedJWTAuthentication
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class BulkNotificationTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'reader{i}') for i in range(3)]
+
+    def test_batch_is_written_in_few_queries(self):
+        items = [(user.pk, 'Reminder', f'message {i}') for i, user in enumerate(self.users * 10)]
+        # user lookup, dedup lookup, bulk insert
+        with self.assertNumQueries(3):
+            created = create_notifications(items)
+        self.assertEqual(created, 30)
+        self.assertEqual(Notification.objects.count(), 30)
+
+    def test_identical_reminders_are_sent_once_per_window(self):
+        item = (self.users[0].pk, 'Return Reminder', "The book 'X' is due tomorrow.")
+        self.assertEqual(create_notifications([item, item]), 1)
+        self.assertEqual(create_notifications([item]), 0)
+
+        Notification.objects.update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(create_notifications([item]), 1)
+
+    def test_unknown_users_are_skipped(self):
+        created = create_notifications([(self.users[0].pk, 'Hi', 'a'), (999999, 'Hi', 'a')])
+        self.assertEqual(created, 1)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='librarian', password='secret', role='librarian')
+        # Start as if the user row had not changed within the token lifetime.
+        caches['auth'].clear()
+        authentication._local_markers.clear()
+        response = self.client.post('/api/token/', {'username': 'librarian', 'password': 'secret'})
+        self.access = response.json()['access']
+
+    def authenticate(self):
+        request = RequestFactory().get('/api/kitob/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+
+    def test_user_is_built_from_claims_without_a_query(self):
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertEqual((user.pk, user.role, user.is_superuser, user.is_banned), (self.user.pk, 'librarian', False, False))
+        # Fields outside the claims load on first access.
+        self.assertEqual(user.username, 'librarian')
+
+    def test_me_loads_the_user_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/me/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        self.assertEqual(response.json()['username'], 'librarian')
+
+    def test_markers_are_kept_apart_from_the_response_cache(self):
+        self.user.save()
+        caches['default'].clear()
+        authentication._local_markers.clear()
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+    def test_changing_the_user_invalidates_the_claims(self):
+        self.authenticate()
+        self.user.ban_expires_at = timezone.now() + timedelta(days=1)
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = self.authenticate()
+        self.assertTrue(user.is_banned)
+
+    def test_refresh_issues_current_claims(self):
+        refresh = self.client.post('/api/token/', {'username': 'librarian', 'password': 'secret'}).json()['refresh']
+        User.objects.filter(pk=self.user.pk).update(role='admin')
+        response = self.client.post('/api/token/refresh/', {'refresh': refresh})
+        self.access = response.json()['access']
+        caches['auth'].clear()
+        authentication._local_markers.clear()
+        self.assertEqual(self.authenticate().role, 'admin')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RefreshTokenSessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='secret')
+
+    def login(self):
+        return self.client.post('/api/token/', {'username': 'reader', 'password': 'secret'}).json()
+
+    def test_sessions_are_stored_by_jti(self):
+        tokens = self.login()
+        session = ActiveRefreshToken.objects.get(user=self.user)
+        self.assertEqual(len(session.jti), 32)
+        self.assertGreater(session.expires_at, timezone.now())
+
+        response = self.client.post('/api/logout/', {'refresh': tokens['refresh']},
+                                    HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}).status_code, 401)
+
+    def test_revoke_all_ends_refresh_and_access_tokens(self):
+        first, second = self.login(), self.login()
+        auth = {'HTTP_AUTHORIZATION': f"Bearer {second['access']}"}
+        self.assertEqual(len(self.client.get('/api/sessions/', **auth).json()['results']), 2)
+
+        self.assertEqual(self.client.post('/api/sessions/revoke_all/', **auth).status_code, 200)
+        for tokens in (first, second):
+            self.assertEqual(self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}).status_code, 401)
+        self.assertEqual(self.client.get('/api/sessions/', **auth).status_code, 401)
+
+    def test_login_in_the_second_of_revoke_all_works(self):
+        # Revoked at the start of this second; the new token's iat is the same second.
+        with mock.patch.object(sessions.timezone, 'now', return_value=timezone.now().replace(microsecond=0)):
+            sessions.revoke_all(self.user)
+        tokens = self.login()
+        auth = {'HTTP_AUTHORIZATION': f"Bearer {tokens['access']}"}
+        self.assertEqual(self.client.get('/api/sessions/', **auth).status_code, 200)
+        self.assertEqual(self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}).status_code, 200)
+        # Tokens without the sub-second claim fall back to whole seconds.
+        revoked = int(self.user.sessions_revoked_at.timestamp())
+        self.assertFalse(sessions.issued_before_revocation(self.user, {'iat': revoked}))
+        self.assertTrue(sessions.issued_before_revocation(self.user, {'iat': revoked - 1}))
+
+    def test_purge_removes_expired_and_revoked_rows(self):
+        self.login()
+        other = User.objects.create_user(username='other', password='secret')
+        ActiveRefreshToken.objects.create(user=other, jti='expired', expires_at=timezone.now() - timedelta(seconds=1))
+        ActiveRefreshToken.objects.create(user=other, jti='live', expires_at=timezone.now() + timedelta(days=1))
+        sessions.revoke_all(self.user)
+
+        self.assertEqual(sessions.purge(), 2)
+        self.assertEqual(list(ActiveRefreshToken.objects.values_list('jti', flat=True)), ['live'])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RoleRateThrottleTests(TestCase):
+    def tearDown(self):
+        throttling._script = None
+        throttling._down_until = 0.0
+
+    def test_rate_follows_role(self):
+        throttle = throttling.RoleRateThrottle()
+        request = mock.Mock(user=mock.Mock(is_authenticated=False))
+        self.assertEqual(throttle.get_rate(request), '120/min')
+        request.user = User(role='librarian')
+        self.assertEqual(throttle.get_rate(request), '1200/min')
+        request.user = User(role='admin', is_superuser=True)
+        self.assertIsNone(throttle.get_rate(request))
+
+    def test_refused_request_gets_retry_after(self):
+        with mock.patch.object(throttling, 'take', return_value=(False, 2.5)) as take:
+            response = self.client.get('/api/kitob/', {'search': 'alpha'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertEqual([call.args[0] for call in take.call_args_list],
+                         ['lms:throttle:requests:ip:127.0.0.1', 'lms:throttle:search:ip:127.0.0.1'])
+
+    @override_settings(THROTTLE_REDIS_URL='redis://127.0.0.1:1/0')
+    def test_unreachable_redis_lets_requests_through(self):
+        throttling._script = None
+        self.assertEqual(throttling.take('key', 1, 1), (True, 0.0))
+        self.assertGreater(throttling._down_until, 0)
+
+    @override_settings(THROTTLE_REDIS_URL='redis://127.0.0.1:1/0')
+    def test_outage_is_logged_once(self):
+        throttling._script = None
+        with mock.patch.object(throttling, '_failing', False), self.assertLogs('users.throttling') as logs:
+            for _ in range(3):
+                throttling._down_until = 0.0
+                throttling.take('key', 1, 1)
+            throttling._down_until = 0.0
+            throttling._script = mock.Mock(return_value=[1, '0'])
+            self.assertEqual(throttling.take('key', 1, 1), (True, 0.0))
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('unavailable', logs.records[0].getMessage())
+        self.assertNotIn('Traceback', logs.output[0])
+        self.assertEqual(logs.records[1].getMessage(), 'Rate limiter available again')
@@ -0,0 +1,155 @@
+"""
+Role-aware rate limits backed by a Redis token bucket.
+
+Each client gets a bucket per scope, holding up to N tokens and refilled at
+N per period, for a rate of "N/period". A request takes one token, and a
+client with an empty bucket is refused with a Retry-After header. The rate
+is looked up in ``DEFAULT_THROTTLE_RATES`` under ``<scope>.<role>``; guests
+use the ``guest`` role. A missing or None rate means no limit, which is how
+admins and superusers are left alone.
+
+The refill, the take and the expiry run in one Lua script using Redis's own
+clock, so concurrent workers never race and their clocks need not agree.
+The limiter is a guard, not a dependency: if Redis is unreachable, requests
+are let through, and Redis is not tried again for ``RETRY_AFTER_FAILURE``
+seconds so an outage adds no per-request latency. An outage is logged once
+when it starts and once when it ends, not on every retry.
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+KEY = 'lms:throttle:%s:%s'
+RETRY_AFTER_FAILURE = 5
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local refill = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / refill
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill) + 1)
+return {allowed, tostring(wait)}
+"""
+
+_script = None
+_down_until = 0.0
+_failing = False
+
+
+def get_script():
+    global _script
+    if _script is None:
+        client = redis.Redis.from_url(
+            getattr(settings, 'THROTTLE_REDIS_URL', 'redis://localhost:6379/1'),
+            socket_connect_timeout=0.2,
+            socket_timeout=0.2,
+        )
+        _script = client.register_script(TOKEN_BUCKET)
+    return _script
+
+
+def parse_rate(rate):
+    """'100/min' -> (100, 60), like DRF's SimpleRateThrottle."""
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+def take(key, capacity, refill_per_second):
+    """
+    Take one token from ``key``; returns (allowed, seconds until a token is
+    available). Always allowed while Redis is unavailable.
+    """
+    global _down_until, _failing
+    if time.monotonic() < _down_until:
+        return True, 0.0
+    try:
+        allowed, wait = get_script()(keys=[key], args=[capacity, refill_per_second])
+    except redis.RedisError as exc:
+        _down_until = time.monotonic() + RETRY_AFTER_FAILURE
+        if not _failing:
+            logger.warning("Rate limiter unavailable, letting requests through until Redis is back: %s", exc)
+        _failing = True
+        return True, 0.0
+    if _failing:
+        logger.warning("Rate limiter available again")
+        _failing = False
+    return bool(allowed), float(wait)
+
+
+class RoleRateThrottle(BaseThrottle):
+    """Overall request rate per client, by role."""
+    scope = 'requests'
+
+    def applies_to(self, request, view):
+        return True
+
+    def get_role(self, request):
+        user = request.user
+        if not (user and user.is_authenticated):
+            return 'guest'
+        if user.is_superuser:
+            return None
+        return getattr(user, 'role', None)
+
+    def get_rate(self, request):
+        role = self.get_role(request)
+        if role is None:
+            return None
+        return api_settings.DEFAULT_THROTTLE_RATES.get(f'{self.scope}.{role}')
+
+    def get_ident(self, request):
+        user = request.user
+        if user and user.is_authenticated:
+            return f'user:{user.pk}'
+        return f'ip:{super().get_ident(request)}'
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if not self.applies_to(request, view):
+            return True
+        rate = self.get_rate(request)
+        if not rate:
+            return True
+        num_requests, duration = parse_rate(rate)
+        allowed, wait = take(KEY % (self.scope, self.get_ident(request)), num_requests, num_requests / duration)
+        if not allowed:
+            self.retry_after = wait
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class SearchRateThrottle(RoleRateThrottle):
+    """Catalog full-text searches."""
+    scope = 'search'
+
+    def applies_to(self, request, view):
+        return bool(request.query_params.get('search'))
+
+
+class ReservationRateThrottle(RoleRateThrottle):
+    """New reservations."""
+    scope = 'reservations'
+
+    def applies_to(self, request, view):
+        return request.method == 'POST' and getattr(view, 'action', None) == 'create'
@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, getme, LogoutView, NotificationViewSet
+from .views import UserViewSet, getme, LogoutView, NotificationViewSet, SessionViewSet
 
 router = DefaultRouter()
 router.register(r'users', UserViewSet)
 router.register(r'notifications', NotificationViewSet, basename='notification')
+router.register(r'sessions', SessionViewSet, basename='session')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,9 +1,11 @@
 from rest_framework.response import Response
-from rest_framework import viewsets
+from rest_framework import viewsets, mixins
 from rest_framework.decorators import action
 from rest_framework.views import APIView
-from .models import User, ActiveRefreshToken, Notification
-from .serializers import UserSerializer, LogoutSerializer, NotificationSerializer
+from .models import User, Notification
+from .authentication import add_user_claims
+from . import sessions
+from .serializers import UserSerializer, LogoutSerializer, NotificationSerializer, SessionSerializer
 from rest_framework.permissions import IsAuthenticated
 from users.permissions import AdminPermission, SuperAdminPermission
 from drf_spectacular.utils import extend_schema
@@ -44,11 +46,15 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
         return Response({'status': 'all marked as read'})
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
     def validate(self, attrs):
         data = super().validate(attrs)
         refresh_token = data.get('refresh')
         if refresh_token:
-            ActiveRefreshToken.objects.get_or_create(user=self.user, token=str(refresh_token))
+            sessions.register(self.user, RefreshToken(refresh_token))
         return data
 
 
@@ -59,25 +65,28 @@ class CustomTokenObtainPairView(TokenObtainPairView):
 class CustomTokenRefreshSerializer(TokenRefreshSerializer):
     def validate(self, attrs):
         refresh = attrs.get('refresh')
-        if not ActiveRefreshToken.objects.filter(token=refresh).exists():
-            raise InvalidToken('Token has been logged out')
-
         try:
             token_obj = RefreshToken(refresh)
         except TokenError as e:
             raise InvalidToken(e.args[0])
 
+        if not sessions.is_active(token_obj):
+            raise InvalidToken('Token has been logged out')
+
         user_id = token_obj.get('user_id')
         user = User.objects.filter(pk=user_id).first()
 
         data = super().validate(attrs)
+        if user is not None:
+            # The refresh token's claims may be days old; issue current ones.
+            data['access'] = str(add_user_claims(token_obj.access_token, user))
 
         # If a new refresh token is issued (rotation), update the active list.
         new_refresh = data.get('refresh')
         if new_refresh and new_refresh != refresh:
-            ActiveRefreshToken.objects.filter(token=refresh).delete()
+            sessions.revoke(token_obj)
             if user is not None:
-                ActiveRefreshToken.objects.get_or_create(user=user, token=str(new_refresh))
+                sessions.register(user, RefreshToken(new_refresh))
 
         return data
 
@@ -95,8 +104,8 @@ class CustomTokenVerifySerializer(TokenVerifySerializer):
         except TokenError as e:
             raise InvalidToken(e.args[0])
 
-        if getattr(decoded, 'token_type', None) == 'refresh':
-            if not ActiveRefreshToken.objects.filter(token=token).exists():
+        if decoded.get('token_type') == 'refresh':
+            if not sessions.is_active(decoded):
                 raise InvalidToken('Token has been logged out')
 
         return data
@@ -115,7 +124,8 @@ class getme(APIView):
     permission_classes = [IsAuthenticated]
     def get(self, request):
         if request.user.is_authenticated:
-            serializer = UserSerializer(request.user)
+            # request.user is built from the token claims; load the whole row at once.
+            serializer = UserSerializer(User.objects.get(pk=request.user.pk))
             return Response(serializer.data)
         else:
             return Response({'detail': 'Authentication credentials were not provided.'}, status=401)
@@ -135,14 +145,34 @@ class LogoutView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
-        refresh_token = serializer.validated_data['refresh']
-        deleted_count, _ = ActiveRefreshToken.objects.filter(token=refresh_token).delete()
-        if deleted_count == 0:
+        try:
+            refresh_token = RefreshToken(serializer.validated_data['refresh'])
+        except TokenError:
+            refresh_token = None
+        if refresh_token is None or not sessions.revoke(refresh_token):
             return Response({'error': 'Token not found or already logged out'}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'message': 'Successfully logged out'})
 
 
+class SessionViewSet(mixins.ListModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    The current user's active refresh-token sessions. DELETE ends one session,
+    revoke_all ends every session including the access tokens already issued.
+    """
+    serializer_class = SessionSerializer
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'jti'
+
+    def get_queryset(self):
+        return sessions.active(self.request.user).order_by('-created_at')
+
+    @action(detail=False, methods=['post'])
+    def revoke_all(self, request):
+        sessions.revoke_all(request.user)
+        return Response({'status': 'all sessions revoked'})
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.